@@ -1,2 +1,2 @@
 # -*- coding: utf-8 -*-
-__all__=['abstract_codec.py','church.py','churchDecode.py','codec.py','ecc.py','goldman.py','goldmanDecode.py','rules.py','tools.py', 'wukong.py']
+__all__=['abstract_codec.py','bits.py','church.py','churchDecode.py','codec.py','consensus.py','ecc.py','goldman.py','goldmanDecode.py','pool.py','rules.py','tools.py', 'wukong.py']
@@ -1,15 +1,37 @@
 # -*- coding: utf-8 -*-
 from abc import ABC,abstractmethod
-from os import path,stat
+from os import path,stat,truncate,remove
 from typing import Tuple,List
-from datetime import datetime
+from itertools import chain
+from collections import Counter
+from functools import partial, wraps
+from datetime import datetime, timedelta
+import numpy as np
 import logging
 log = logging.getLogger('mylog')
 
-from StorageD.tools import  EncodeParameter, DecodeParameter, FileTools, SplitTools, RsTools, BaseTools, CodecException
+from StorageD.tools import  EncodeParameter, DecodeParameter, FileTools, SplitTools, RsTools, CodecException, BitSegments, \
+    ConstraintChecker, SegmentExecutor, BLOCK_ROWS
+from StorageD.ecc import OuterCode
+from StorageD.consensus import Consensus
+from StorageD.pool import PackedPool
 from StorageD.getPrimerPair import PrimerDesign, getOther
 
-base_list = ['a', 't', 'c', 'g', 'A', 'T', 'C', 'G']
+base_list = ['a', 't', 'c', 'g', 'n', 'A', 'T', 'C', 'G', 'N']
+READ_INDEX_SUFFIX = '.index.npy' # sidecar of the pool, see AbstractEncode.set_pool_format
+
+def shutdown_executor(flow):
+    """
+    shut down the pool of the executor(see set_executor) at the end of an encode or decode flow
+    """
+    @wraps(flow)
+    def run_flow(self, *args, **kwargs):
+        try:
+            return flow(self, *args, **kwargs)
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+    return run_flow
 
 class AbstractEncode(ABC):
     """
@@ -27,6 +49,10 @@ class AbstractEncode(ABC):
             raise CodecException('Output dir not exist : {}'.format(self.output_dir))
         self.file_base_name,self.file_extension =  FileTools.get_file_name_extension(self.input_file_path)
         self.output_file_path = self.output_dir + self.file_base_name + "_{}.fasta".format(tool_name)
+        self.pool_format = 'fasta'
+        self.offset_index = False
+        self.read_index = False
+        self.read_map = None # sequence number of every segment index, -1 for none
         self.codec_param=EncodeParameter(**encode_parameters)
         self.seq_bit_to_base_ratio = seq_bit_to_base_ratio
         self.index_redundancy = index_redundancy
@@ -41,6 +67,7 @@ class AbstractEncode(ABC):
         self.rs_group = 0
         self._check_params()
         self.codec_worker = None
+        self.executor = None
 
     def _check_params(self):
         if self.codec_param.max_homopolymer<=0:
@@ -62,14 +89,118 @@ class AbstractEncode(ABC):
             log.error("set density error, total base is 0")
     
     @abstractmethod
-    def _encode(self, bit_segments: list) -> list:
+    def _encode(self, bit_segments: BitSegments) -> list:
         """
         This part is implemented according to different algorithms
         Processed Binary Sequence(str) List >> Base Sequence(str) List
+        bit_segments is packed, but it could be used as a list of binary strings
         """
         # return base_segments
         pass
+
+    def _get_encode_task(self):
+        """
+        the function encoding a chunk of segments in the executor and the state it needs,
+        task(state, bit_segments) returns what _encode does. The workers get them instead of the codec,
+        task is None to run _encode.
+        """
+        return None, None
     
+    def set_executor(self, workers=None, pool='process', chunk_size=1024):
+        """
+        opt in to encode chunks of segments with _encode(or the task of _get_encode_task) in parallel,
+        results are kept in order. The pool is kept until the end of the encode flow.
+        Codecs pairing segments (e.g. Wukong) only pair segments in the same chunk.
+        @param workers: number of workers, None for the number of CPUs
+        @param pool: 'thread' or 'process'
+        @param chunk_size: number of segments encoded in every call of _encode
+        """
+        self.executor = SegmentExecutor(workers=workers, pool=pool, chunk_size=chunk_size)
+
+    def set_pool_format(self, pool_format='packed', offset_index=False, read_index=False):
+        """
+        format of the output pool
+        @param pool_format: 'fasta', or 'packed'(4 bases per byte, see PackedPool, PackedPool.to_fasta exports FASTA)
+        @param offset_index: write the offset index of the packed pool even if all the sequences have the same length
+        @param read_index: write the sidecar output_file_path+'.index.npy', an int64 array keeping the sequence number
+            (from 0, in the pool) of every segment index and -1 for none, so that decode_range reads only the sequences it needs
+        """
+        if pool_format not in ['fasta', 'packed']:
+            raise CodecException("Unknown pool format : {}".format(pool_format))
+        self.pool_format = pool_format
+        self.offset_index = offset_index
+        self.read_index = read_index
+
+    def _get_pool_path(self, pool_format):
+        return path.splitext(self.output_file_path)[0] + ('.sdpool' if pool_format == 'packed' else '.fasta')
+
+    def _get_read_indexes(self, seq_list):
+        """
+        This part is implemented by codecs supporting the read index
+        Base Sequence(str) List(without primers) >> (sequence numbers in the list, segment indexes) of the segments they hold
+        """
+        raise CodecException("{} does not support the read index".format(self.tool_name))
+
+    def _iter_indexed_blocks(self, seq_blocks):
+        """
+        pass blocks of base sequences through and fill read_map with the indexes of their segments
+        """
+        self.read_map = np.full(self.seq_num, -1, dtype=np.int64)
+        first_read = 0
+        for seq_list in seq_blocks:
+            if len(seq_list)>0:
+                reads, indexes = self._get_read_indexes(seq_list)
+                valid = indexes < self.seq_num # e.g. virtual segments of Wukong
+                self.read_map[indexes[valid]] = first_read + reads[valid]
+            first_read += len(seq_list)
+            yield seq_list
+
+    @staticmethod
+    def _iter_primed_blocks(seq_blocks, left_primer, right_primer):
+        """
+        add primers to blocks of base sequences, the reverse complementary of the right primer at the right
+        """
+        right_primer_reverse = getOther(right_primer)
+        for seq_list in seq_blocks:
+            yield [left_primer + seg + right_primer_reverse for seg in seq_list]
+
+    def _write_pool(self, param_line, seq_blocks, left_primer="", right_primer=""):
+        """
+        write blocks(lists) of base sequences to the output pool in one pass, primers are added on the way
+        @param param_line: the parameter line, with the primers
+        @return: number of sequences, number of bases
+        """
+        if self.read_index:
+            seq_blocks = self._iter_indexed_blocks(seq_blocks)
+        if left_primer or right_primer:
+            seq_blocks = self._iter_primed_blocks(seq_blocks, left_primer, right_primer)
+        if self.pool_format == 'packed':
+            self.output_file_path = self._get_pool_path('packed')
+            return PackedPool.write(self.output_file_path, param_line, seq_blocks, self.offset_index)
+        self.output_file_path = self._get_pool_path('fasta')
+        seq_num, base_num = 0, 0
+        with open(self.output_file_path, 'w') as f:
+            f.write(param_line)
+            for seq_list in seq_blocks:
+                for seg in seq_list:
+                    seq_num += 1
+                    f.write(">seq_{}\n".format(seq_num) + seg + '\n')
+                    base_num += len(seg)
+        return seq_num, base_num
+
+    def _finish_pool(self):
+        """
+        write the read index of the pool
+        """
+        if self.read_map is not None:
+            np.save(self.output_file_path + READ_INDEX_SUFFIX, self.read_map)
+
+    def _run_encode(self, bit_segments):
+        if self.executor is None:
+            return self._encode(bit_segments)
+        task, state = self._get_encode_task()
+        return self.executor.map(self._encode if task is None else partial(task, state), bit_segments)
+
     def _file_to_bin(self):
         """
         get binary string from file
@@ -77,14 +208,24 @@ class AbstractEncode(ABC):
         bin_str = FileTools.file_to_bin(self.input_file_path)
         return bin_str
 
-    def _split_bin(self, binstring:str) -> Tuple[int,int,List]:
+    def _file_to_bytes(self):
+        """
+        get bytes(uint8 array) from file
+        """
+        return FileTools.file_to_bytes(self.input_file_path)
+
+    def _get_split_plan(self, bin_len):
         """
-        split binstring to bin segments
+        get index length, binary segment length, number of segments and rs group from the binary length
         """
-        index_length, bin_split_len, seq_num, rs_group = SplitTools.get_bin_split_length(len(binstring),
-                                                                               self.seq_bit_to_base_ratio,
-                                                                               self.codec_param,
-                                                                               index_redundancy=self.index_redundancy)
+        return SplitTools.get_bin_split_length(bin_len, self.seq_bit_to_base_ratio, self.codec_param,
+                                               index_redundancy=self.index_redundancy)
+
+    def _split_bin(self, binstring) -> Tuple[int,int,int,BitSegments]:
+        """
+        split binstring(or bytes) to bin segments
+        """
+        index_length, bin_split_len, seq_num, rs_group = self._get_split_plan(SplitTools.to_packed(binstring)[1])
         bit_segments = SplitTools.split(binstring, bin_split_len, self.codec_param.add_redundancy,
                                         index_redundancy=self.index_redundancy)
         return bin_split_len, index_length, rs_group, bit_segments
@@ -97,36 +238,77 @@ class AbstractEncode(ABC):
         res_segments = RsTools.add_rs(bit_segments, self.codec_param.rs_num, self.rs_group)
         return res_segments
         
-    def _add_primer(self):
-        log.info('add primer')
-        primer_designer = PrimerDesign([self.output_file_path], iBreakNum=1, iBreakSec=300,iPrimerLen=self.codec_param.primer_length, sBaseDir=self.output_dir, bTimeTempName=False, bLenStrict=True)
+    def _get_block_rows(self, max_memory):
+        """
+        number of segments coded at a time to keep memory use under max_memory bytes
+        """
+        seg_bit_len = self.index_length + self.bin_split_len + 8*self.codec_param.rs_num*self.rs_group
+        # packed and unpacked bits, base string and the python objects holding them
+        row_memory = 4*seg_bit_len + 2*self.codec_param.sequence_length + 200
+        block_unit = SplitTools.get_block_unit(self.codec_param.add_redundancy)
+        return max(block_unit, max_memory // row_memory // block_unit * block_unit) # blocks start at byte boundaries and redundancy groups
+
+    def _get_segment_num(self):
+        """
+        number of segments of the file after _get_split_plan, counted as the decoder does
+        """
+        _, seq_num = SplitTools.get_indexlen_and_segnum(self.total_bit, self.bin_split_len,
+                                                        self.codec_param.add_redundancy,
+                                                        index_redundancy=self.index_redundancy)
+        return seq_num
+
+    def _iter_bit_segments(self, block_rows):
+        """
+        read the file by blocks, yield BitSegments of block_rows segments with rscode
+        """
+        seg_index_length, _ = SplitTools.get_indexlen_and_segnum(self.total_bit, self.bin_split_len,
+                                                                 self.codec_param.add_redundancy,
+                                                                 index_redundancy=self.index_redundancy)
+        with open(self.input_file_path, 'rb') as file:
+            for first_row in range(0, self.seq_num, block_rows):
+                row_num = min(block_rows, self.seq_num - first_row)
+                start, stop = SplitTools.get_block_range(first_row, row_num, self.bin_split_len, self.codec_param.add_redundancy)
+                file.seek(start)
+                data = np.frombuffer(file.read(stop - start), dtype=np.uint8)
+                bit_segments = SplitTools.split_block(data, first_row, row_num, self.bin_split_len, seg_index_length,
+                                                      self.codec_param.add_redundancy)
+                if self.codec_param.rs_num>0:
+                    bit_segments = self._add_rscode(bit_segments)
+                yield bit_segments
+
+    def _iter_base_segments(self, bit_segments_iter):
+        """
+        encode every block of bin segments
+        """
+        encode_time = timedelta(0)
+        for bit_segments in bit_segments_iter:
+            tm_encode = datetime.now()
+            base_segments = self._run_encode(bit_segments)
+            encode_time += datetime.now() - tm_encode
+            self.encode_time = str(encode_time)
+            yield base_segments
+
+    def _design_primer(self, seq_list):
+        """
+        design primers with the base sequences(the pool or a sample of it) as templates
+        @return: left primer, right primer, "" if there is no primer
+        """
+        log.info('design primer')
+        primer_designer = PrimerDesign([], iBreakNum=1, iBreakSec=300,iPrimerLen=self.codec_param.primer_length, sBaseDir=self.output_dir,
+                                       bTimeTempName=False, bLenStrict=True, lTemplateSeq=seq_list)
         res = primer_designer.getPrimer()
         if len(res)>0:
-            left_primer = res.left[0]
-            right_primer = res.right[0]
-            right_primer_reverse = getOther(right_primer) # add reverse complementary at the right
-            pool = []
-            with open(self.output_file_path, 'r') as file:
-                param = self._set_param_line(left_primer, right_primer)
-                pool.append(param)
-                index = 0
-                for line in file.readlines()[1:]:
-                    if line[0] in base_list:
-                        pool.append(">seq_{}\n".format(index+1) + left_primer + line.strip('\n') + right_primer_reverse + '\n')
-                        index += 1
-            with open(self.output_file_path, 'w') as f:
-                f.writelines(pool)
-            return self.output_file_path
-        else:
-            log.error("No primer")
-            return self.output_file_path
+            return res.left[0], res.right[0]
+        log.error("No primer")
+        return "", ""
     
     def _set_param_line(self, left_primer="", right_primer=""):
         param = ">totalBit:{},binSegLen:{},leftPrimer:{},rightPrimer:{},fileExtension:{},bRedundancy:{},RSNum:{}\n".format(
             self.total_bit, self.bin_split_len, left_primer, right_primer, self.file_extension,
-            int(self.codec_param.add_redundancy), int(self.codec_param.rs_num))
+            OuterCode.to_param(OuterCode.get(self.codec_param.add_redundancy)), int(self.codec_param.rs_num))
         return param
         
+    @shutdown_executor
     def common_encode(self):
         """
         common encode flow
@@ -134,9 +316,9 @@ class AbstractEncode(ABC):
         self._check_params()
         tm_run = datetime.now()
         log.debug('read file')
-        bin_str = self._file_to_bin()
+        file_bytes = self._file_to_bytes()
         # split
-        self.bin_split_len, self.index_length, self.rs_group, bit_segments = self._split_bin(bin_str)
+        self.bin_split_len, self.index_length, self.rs_group, bit_segments = self._split_bin(file_bytes)
         self.seq_num = len(bit_segments)
         #add rscode
         if self.codec_param.rs_num>0:
@@ -144,25 +326,89 @@ class AbstractEncode(ABC):
             
         # encode
         tm_encode = datetime.now()
-        base_segments = self._encode(bit_segments)
+        base_segments = self._run_encode(bit_segments)
         self.encode_time = str(datetime.now() - tm_encode)
-        self.total_base = len(base_segments)*len(base_segments[0])
-        
-        param = self._set_param_line()
+
+        # design primers from the segments, they are added while writing
+        left_primer, right_primer = self._design_primer(base_segments) if self.codec_param.add_primer else ("", "")
+        param = self._set_param_line(left_primer, right_primer)
         log.debug('write')
-        with open(self.output_file_path, 'w') as f:
-            f.write(param)
-            for index,seg in enumerate(base_segments):
-                f.write(">seq_{}\n".format(index+1) + seg + '\n')
-        
-        # add primer (blast need fasta file to compare)
-        if self.codec_param.add_primer:
-            self._add_primer()
-            self.total_base += (len(base_segments)*2*self.codec_param.primer_length)
+        _, self.total_base = self._write_pool(param, [base_segments], left_primer, right_primer)
+        self._finish_pool()
             
         self.run_time = str(datetime.now()-tm_run)
         self._set_density()
         return self.output_file_path
+
+    def validate_pool(self, window=150, moving=140):
+        """
+        check homopolymer and GC content of every sequence in the output file (primers included)
+        @return: number of sequences, indexes(from 0) of failed sequences
+        """
+        checker = ConstraintChecker(self.codec_param.max_homopolymer, self.codec_param.min_gc, self.codec_param.max_gc,
+                                    window=window, moving=moving)
+        failed_indexs = []
+        seq_num = 0
+        if PackedPool.is_packed(self.output_file_path):
+            for seq_list in PackedPool(self.output_file_path).iter_blocks():
+                failed_indexs += self._check_seqs(checker, seq_list, seq_num)
+                seq_num += len(seq_list)
+            if len(failed_indexs) > 0:
+                log.warning("{} of {} sequences do not meet the constraints".format(len(failed_indexs), seq_num))
+            return seq_num, failed_indexs
+        with open(self.output_file_path, 'r') as file:
+            seq_list = []
+            for line in file:
+                if line[0] in base_list:
+                    seq_list.append(line.strip())
+                    if len(seq_list) == BLOCK_ROWS:
+                        failed_indexs += self._check_seqs(checker, seq_list, seq_num)
+                        seq_num += len(seq_list)
+                        seq_list = []
+            failed_indexs += self._check_seqs(checker, seq_list, seq_num)
+            seq_num += len(seq_list)
+        if len(failed_indexs) > 0:
+            log.warning("{} of {} sequences do not meet the constraints".format(len(failed_indexs), seq_num))
+        return seq_num, failed_indexs
+
+    @staticmethod
+    def _check_seqs(checker, seq_list, first_index):
+        failed_indexs = []
+        for seq_len in set(len(x) for x in seq_list):
+            rows = [i for i, x in enumerate(seq_list) if len(x) == seq_len]
+            passed = checker.check([seq_list[i] for i in rows])
+            failed_indexs += [first_index + rows[i] for i in np.nonzero(~passed)[0]]
+        return sorted(failed_indexs)
+
+    @shutdown_executor
+    def stream_encode(self, max_memory=512*1024*1024):
+        """
+        encode flow for large files: the file is read, split, coded and written block by block,
+        so the memory used is about max_memory bytes whatever the file size.
+        Codecs that pair segments (e.g. Wukong) only pair segments in the same block.
+        Primers are designed from the first block, a sample of the pool.
+        @param max_memory: memory ceiling in bytes
+        """
+        self._check_params()
+        tm_run = datetime.now()
+        self.index_length, self.bin_split_len, _, self.rs_group = self._get_split_plan(self.total_bit)
+        self.seq_num = self._get_segment_num()
+        block_rows = self._get_block_rows(max_memory)
+        log.debug('block rows: {}'.format(block_rows))
+
+        seq_blocks = self._iter_base_segments(self._iter_bit_segments(block_rows))
+        left_primer, right_primer = "", ""
+        if self.codec_param.add_primer:
+            first_block = next(seq_blocks, [])
+            left_primer, right_primer = self._design_primer(first_block)
+            seq_blocks = chain([first_block], seq_blocks)
+        _, self.total_base = self._write_pool(self._set_param_line(left_primer, right_primer), seq_blocks,
+                                              left_primer, right_primer)
+        self._finish_pool()
+
+        self.run_time = str(datetime.now()-tm_run)
+        self._set_density()
+        return self.output_file_path
     
     
 class AbstractDecode(ABC):
@@ -176,8 +422,15 @@ class AbstractDecode(ABC):
         if not path.exists(self.output_dir):
             raise CodecException('Output dir not exist')
         self.file_base_name,self.file_extension =  path.splitext(path.basename(self.input_file_path))
+        if self.file_extension == '.gz':
+            self.file_base_name,self.file_extension = path.splitext(self.file_base_name)
+        self.param_source = None # parameter line or the file starting with it, see set_input
+        self.min_quality = 0
         self.rs_err_rate = 0.0 # error correction failed
         self.rs_err_indexs = [] # error correction failed
+        self.rs_clean_num = 0 # segments without errors
+        self.rs_corrected_num = 0 # segments with errors corrected
+        self.rs_failed_num = 0 # error correction failed
         self.repaired_rate = 0.0 # missing but repaired segments
         self.miss_err_rate = 0.0 # missing and unrepaired segments
         self.repaired_indexs = [] # missing but repaired segments
@@ -185,11 +438,34 @@ class AbstractDecode(ABC):
         self.run_time = 0.0
         self.index_redundancy = index_redundancy
         self.codec_worker = None
+        self.executor = None
     
+    def set_input(self, param=None, min_quality=0):
+        """
+        options for the input, FASTA or FASTQ(plain or gzip, detected from the file)
+        @param param: the parameter line(">totalBit:...") or a file starting with it(e.g. the encoded FASTA),
+            None for the first line of a FASTA input, or the sidecar file input_file_path+'.param' of a FASTQ input
+        @param min_quality: bases of FASTQ reads with lower Phred scores are decoded as invalid bases(erasures)
+        """
+        self.param_source = param
+        self.min_quality = min_quality
+
+    def _get_param_line(self):
+        param = self.param_source
+        if param is None and PackedPool.is_packed(self.input_file_path):
+            return PackedPool(self.input_file_path).param_line
+        if param is None:
+            param = self.input_file_path + '.param' if FileTools.is_fastq(self.input_file_path) else self.input_file_path
+        if param.startswith('>'):
+            return param
+        if not path.exists(param):
+            raise CodecException("Parameter file not exist : {}".format(param))
+        with FileTools.open_text(param) as file:
+            return file.readline()
+
     def _check_file_param(self, param_list:list):
-        with open(self.input_file_path,'r') as file:
-            first_line = file.readline().strip()
-            param_line = first_line.strip(">").strip(';').split(',')
+        first_line = self._get_param_line().strip()
+        param_line = first_line.strip(">").strip(';').split(',')
 
         param_dict = dict()
         for param in param_line:
@@ -212,7 +488,7 @@ class AbstractDecode(ABC):
         param = {
             'total_bit': int(param_dict['totalBit']),
             'bin_seg_len' : int(param_dict['binSegLen']),
-            'add_redundancy' : bool(int(param_dict['bRedundancy'])),
+            'add_redundancy' : OuterCode.get(param_dict['bRedundancy']),
             'rs_num' :int(param_dict['RSNum']),
             'left_primer_len' : len(param_dict['leftPrimer']),
             'right_primer_len' : len(param_dict['rightPrimer']),
@@ -230,36 +506,124 @@ class AbstractDecode(ABC):
                                                                      index_redundancy=self.index_redundancy)
         return index_length, seq_num
     
-    def _get_base_line_list(self):
-        base_line_list = []
-        with open(self.input_file_path,'r') as file:
-            if self.codec_param.right_primer_len==0:
-                def get_line():
-                    base_line_list.append(line.strip()[self.codec_param.left_primer_len:])
+    def _get_primer_cut(self):
+        """
+        slice bounds of the sequence between the primers
+        """
+        left = self.codec_param.left_primer_len
+        right = -self.codec_param.right_primer_len if self.codec_param.right_primer_len!=0 else None
+        return left, right
+
+    def _iter_read_blocks(self, block_size=1<<22):
+        """
+        read base sequences by blocks of about block_size characters and delete primers
+        @return: iterator of (base sequences, quality strings of FASTQ reads or None), see FileTools.get_phred
+        """
+        left, right = self._get_primer_cut()
+        if PackedPool.is_packed(self.input_file_path):
+            for reads in PackedPool(self.input_file_path).iter_blocks():
+                yield [x[left:right] for x in reads], None
+            return
+        if FileTools.is_fastq(self.input_file_path):
+            for reads, qualities in FileTools.iter_fastq(self.input_file_path, block_size):
+                yield [x[left:right] for x in reads], [x[left:right] for x in qualities]
+            return
+        with FileTools.open_text(self.input_file_path) as file:
+            while True:
+                lines = file.readlines(block_size)
+                if len(lines)==0:
+                    break
+                yield [line.strip()[left:right].strip() for line in lines if line[0] in base_list], None
+
+    def _iter_base_lines(self, with_quality=False):
+        """
+        read base sequences one by one and delete primers,
+        bases of FASTQ reads with Phred scores lower than min_quality are replaced by N
+        @param with_quality: yield (base sequence, quality string or None) instead
+        """
+        for reads, qualities in self._iter_read_blocks():
+            if qualities is not None and self.min_quality>0:
+                reads = FileTools.mask_bases(reads, qualities, self.min_quality)
+            if with_quality:
+                yield from zip(reads, qualities if qualities is not None else [None]*len(reads))
             else:
-                def get_line():
-                    base_line_list.append(line.strip()[self.codec_param.left_primer_len:-self.codec_param.right_primer_len])
-            # del primer
-            for line in file.readlines():
-                if line[0] in base_list:
-                    get_line()
-        base_line_list = [x.strip() for x in base_line_list]
-        return base_line_list
-        
+                yield from reads
+
+    def _get_base_line_list(self):
+        return list(self._iter_base_lines())
+
+    def _get_block_rows(self, max_memory):
+        """
+        number of sequences decoded at a time to keep memory use under max_memory bytes
+        """
+        # base string, packed and unpacked bits and the python objects holding them
+        return max(24, max_memory // (8*self.ori_len + 200))
+
     @abstractmethod
     def _decode(self, base_line_list:list()) -> list():
         """
         The input parameter is a list of base sequences, and the return value is a list of binary sequences
+        (or BitSegments)
         """
         # return bit_segments
         pass
+
+    def _get_decode_task(self):
+        """
+        the function decoding a chunk of sequences in the executor and the state it needs,
+        task(state, base_line_list) returns what _decode does. The workers get them instead of the codec,
+        task is None to run _decode.
+        """
+        return None, None
+
+    def set_executor(self, workers=None, pool='process', chunk_size=1024):
+        """
+        opt in to decode chunks of sequences with _decode(or the task of _get_decode_task) in parallel,
+        results are kept in order. The pool is kept until the end of the decode flow.
+        @param workers: number of workers, None for the number of CPUs
+        @param pool: 'thread' or 'process'
+        @param chunk_size: number of sequences decoded in every call of _decode
+        """
+        self.executor = SegmentExecutor(workers=workers, pool=pool, chunk_size=chunk_size)
+
+    def _run_decode(self, base_line_list, keep_erasures=False):
+        """
+        decode base sequences to BitSegments with _decode,
+        segments with erasures(bits from invalid bases) are dropped if there is no rscode to correct them,
+        unless keep_erasures
+        """
+        if self.executor is None:
+            bit_segments = self._decode(base_line_list)
+        else:
+            task, state = self._get_decode_task()
+            bit_segments = self.executor.map(self._decode if task is None else partial(task, state), base_line_list)
+        if not isinstance(bit_segments, BitSegments):
+            bit_segments = BitSegments.from_strings(bit_segments)
+        if self.codec_param.rs_num==0 and not keep_erasures:
+            has_erasures = bit_segments.has_erasures()
+            if has_erasures.any():
+                log.warning("drop {} segment(s) with invalid bases".format(np.count_nonzero(has_erasures)))
+                bit_segments = bit_segments.take(~has_erasures)
+        return bit_segments
     
+    def _get_indexes(self, bit_segs):
+        """
+        parse the index of every segment
+        """
+        return bit_segs.get_indexes(self.index_length)
+
     def _del_rscode(self, bit_segs):
         log.debug('del rscode')
+        # segments out of the pool(e.g. virtual segments of Wukong) are dropped by their raw indexes first,
+        # rscode would count them as failed or correct them into the index of a real segment
+        bit_segs = bit_segs.take(self._get_indexes(bit_segs) < self.seq_num)
         res_dict = RsTools.del_rs(bit_segs, self.ori_len, self.codec_param.rs_num)
-        err_segs = [bit_segs[i] for i in res_dict.get("err_index")]
+        err_segs = bit_segs.take(res_dict.get("err_index"))
         self.rs_err_rate = res_dict.get("err_rate")
-        err_lists_tmp = [int(bit_segs[i][:self.index_length],2) for i in res_dict["err_index"]]
+        self.rs_clean_num += res_dict.get("clean_num")
+        self.rs_corrected_num += res_dict.get("corrected_num")
+        self.rs_failed_num += res_dict.get("failed_num")
+        err_lists_tmp = self._get_indexes(err_segs).tolist()
         for index in err_lists_tmp:
             if index < self.seq_num:
                 self.rs_err_indexs.append(index)
@@ -275,36 +639,366 @@ class AbstractDecode(ABC):
         return res_dict["res_segments"]
     
     def _bin_to_file(self, bit_str):
+        """
+        @param bit_str: binary string or bytes
+        """
         FileTools.bin_to_file(bit_str, self.output_file_path)
     
-    def common_decode(self):
-        self._parse_param()
+    def _reset_rs_counters(self):
+        self.rs_clean_num, self.rs_corrected_num, self.rs_failed_num = 0, 0, 0
 
-        tm_run = datetime.now()
-        base_line_list = self._get_base_line_list()
-        tm_decode = datetime.now()
-        bit_segments = self._decode(base_line_list)
-        self.decode_time = str(datetime.now() - tm_decode)
-        log.debug('sort')
-        sorted_binstr = BaseTools.sort_segment(bit_segments, self.index_length)
-        sorted_binstr = sorted_binstr[:self.seq_num]
+    def _log_rs_counters(self):
+        log.info("rscode: {} clean, {} corrected, {} failed segments".format(
+            self.rs_clean_num, self.rs_corrected_num, self.rs_failed_num))
 
-        # del rscode
+    def _restore_file(self, bit_segments):
+        """
+        delete rscode, repair, merge and write decoded segments to the output file
+        """
+        # del rscode, segments need no order for it
         if self.codec_param.rs_num>0:
-            validate_bit_segs, err_bit_segs = self._del_rscode(sorted_binstr)
+            validate_bit_segs, err_bit_segs = self._del_rscode(bit_segments)
+            self._log_rs_counters()
         else:
-            validate_bit_segs, err_bit_segs = sorted_binstr, []
+            validate_bit_segs, err_bit_segs = bit_segments, []
         # TODO: err_bit_segs and self.rs_err_indexs may be used to repaire
-        #repair and count missing segments
+        # place segments by their indexes(parsed once, after rscode may correct them), repair and count missing segments
         log.debug('repair')
         validate_bit_segs = self._repair_segment(validate_bit_segs)
         
         log.debug('merge')
-        res_bit_str = SplitTools.merge(validate_bit_segs)
-        res_bit_str = res_bit_str[:self.codec_param.total_bit]
+        res_bit_str = SplitTools.merge(validate_bit_segs, self.codec_param.total_bit)
         
         log.debug('write')
         self._bin_to_file(res_bit_str)
-        
+
+    @shutdown_executor
+    def common_decode(self):
+        self._parse_param()
+        self._reset_rs_counters()
+
+        tm_run = datetime.now()
+        base_line_list = self._get_base_line_list()
+        tm_decode = datetime.now()
+        bit_segments = self._run_decode(base_line_list)
+        self.decode_time = str(datetime.now() - tm_decode)
+        self._restore_file(bit_segments)
+        self.run_time = str(datetime.now() - tm_run)
+        return self.output_file_path
+
+    @shutdown_executor
+    def stream_decode(self, max_memory=512*1024*1024):
+        """
+        decode flow for large pools: sequences are read and decoded block by block,
+        and data segments are written into the memory-mapped output file at index*bin_seg_len,
+        so the memory used is about max_memory bytes plus a few bytes per segment.
+        Different from common_decode, missing segments are left as zeros instead of being skipped.
+        @param max_memory: memory ceiling in bytes
+        """
+        self._parse_param()
+        self._reset_rs_counters()
+        tm_run = datetime.now()
+        outer_code = OuterCode.get(self.codec_param.add_redundancy)
+        chunk_len = SplitTools.get_chunk_len(self.codec_param.bin_seg_len, outer_code)
+        data_num = SplitTools.get_data_id(self.seq_num, outer_code)
+        out_buffer = np.memmap(self.output_file_path, dtype=np.uint8, mode='w+',
+                               shape=(SplitTools.get_buffer_len(data_num, chunk_len),))
+        # parity segments are kept in memory, at the number of parity segments before them
+        parity_segments = np.zeros((self.seq_num - data_num + 1, (chunk_len+7)//8), dtype=np.uint8) if outer_code else None
+        exist = np.zeros(self.seq_num, dtype=bool)
+        decode_time = timedelta(0)
+        rs_err_num, line_num = 0, 0
+
+        base_lines = self._iter_base_lines()
+        block_rows = self._get_block_rows(max_memory)
+        while True:
+            base_line_list = [line for _,line in zip(range(block_rows), base_lines)]
+            if len(base_line_list)==0:
+                break
+            line_num += len(base_line_list)
+            tm_decode = datetime.now()
+            bit_segments = self._run_decode(base_line_list)
+            decode_time += datetime.now() - tm_decode
+            if self.codec_param.rs_num>0 and len(bit_segments)>0:
+                bit_segments, err_bit_segs = self._del_rscode(bit_segments)
+                rs_err_num += len(err_bit_segs)
+            if len(bit_segments)==0:
+                continue
+            indexes = bit_segments.get_indexes(self.index_length)
+            rows = np.nonzero(indexes < self.seq_num)[0]
+            indexes = indexes[rows]
+            data_segments = bit_segments.take(rows).cut(self.index_length, self.index_length + chunk_len)
+            exist[indexes] = True
+            is_data = outer_code.is_data(indexes) if outer_code else np.ones(len(indexes), dtype=bool)
+            data_ids = SplitTools.get_data_id(indexes, outer_code)
+            SplitTools.write_segments(out_buffer, data_ids[is_data], data_segments.take(is_data))
+            if outer_code:
+                parity_segments[(indexes - data_ids)[~is_data]] = data_segments.packed[~is_data]
+            out_buffer.flush()
+        self.decode_time = str(decode_time)
+        self.rs_err_rate = rs_err_num/line_num if line_num>0 else 0.0
+        if self.codec_param.rs_num>0:
+            self._log_rs_counters()
+
+        # repair and count missing segments
+        log.debug('repair')
+        self.repaired_indexs, self.miss_err_indexs = [], []
+        if outer_code is None:
+            self.miss_err_indexs = np.nonzero(~exist)[0].tolist()
+        else:
+            group_len = outer_code.group_len
+            for group in np.unique(np.nonzero(~exist)[0] // group_len).tolist():
+                group_rows = np.arange(group * group_len, min((group + 1) * group_len, self.seq_num))
+                is_data = outer_code.is_data(group_rows)
+                missing = group_rows[is_data & ~exist[group_rows]].tolist()
+                # the last data segment of the XOR redundancy may have no parity segment
+                if len(group_rows) < group_len or len(group_rows) - np.count_nonzero(exist[group_rows]) > outer_code.parity_num:
+                    for seg_index in missing: log.warning("error to repair segment {}".format(seg_index))
+                    self.miss_err_indexs.extend(missing)
+                    continue
+                data_ids = outer_code.get_data_id(group_rows)
+                group_segments = np.zeros((group_len, parity_segments.shape[1]), dtype=np.uint8)
+                group_segments[is_data] = SplitTools.read_segments(out_buffer, data_ids[is_data], chunk_len).packed
+                group_segments[~is_data] = parity_segments[(group_rows - data_ids)[~is_data]]
+                outer_code.repair_group(group_segments, exist[group_rows])
+                missing_rows = is_data & ~exist[group_rows]
+                SplitTools.write_segments(out_buffer, data_ids[missing_rows],
+                                          BitSegments(group_segments[missing_rows], chunk_len))
+                for seg_index in missing: log.info("repair segment {}".format(seg_index))
+                self.repaired_indexs.extend(missing)
+        for index in self.miss_err_indexs: log.warning('missing segment, index:{}'.format(index))
+        self.repaired_rate = len(self.repaired_indexs) / self.seq_num
+        self.miss_err_rate = len(self.miss_err_indexs) / self.seq_num
+
+        log.debug('write')
+        out_buffer.flush()
+        del out_buffer
+        truncate(self.output_file_path, self.codec_param.total_bit // 8)
+        self.run_time = str(datetime.now() - tm_run)
+        return self.output_file_path
+
+    @shutdown_executor
+    def consensus_decode(self, max_memory=512*1024*1024, kmer_len=16, min_match=2, two_pass=False):
+        """
+        decode flow for sequencing reads with many noisy copies of every sequence:
+        reads are read once and decoded block by block, and every bit of a segment takes the majority of its copies
+        (grouped by index, copies with a broken index are assigned by kmer_len-bit words of their data,
+        see Consensus), then the consensus segments are decoded as in common_decode.
+        Copies from FASTQ reads are weighted by their Phred scores, see _get_read_weights.
+        Memory used is about max_memory bytes, the votes(2 bytes per bit of every segment) are memory-mapped
+        to a file next to the output file.
+        Tied bits are erasures for rscode. Decode chunks run in the pool of set_executor if any.
+        @param min_match: number of words a copy with a broken index should share with the segment it is assigned to
+        @param two_pass: read and decode the reads twice, to drop the copies voting for a wrong index
+        """
+        self._parse_param()
+        self._reset_rs_counters()
+        tm_run = datetime.now()
+        decode_time = timedelta(0)
+        consensus = None
+
+        votes_path = self.output_file_path + '.votes'
+        block_rows = self._get_block_rows(max_memory)
+        # the first pass votes by indexes, the second one keeps the copies agreeing with the first consensus
+        for pass_num in range(2 if two_pass else 1):
+            base_lines = self._iter_base_lines(with_quality=True)
+            while True:
+                block = [line for _,line in zip(range(block_rows), base_lines)]
+                if len(block)==0:
+                    break
+                tm_decode = datetime.now()
+                bit_segments, weights = self._decode_weighted([x for x,_ in block], None if block[0][1] is None else [x for _,x in block])
+                decode_time += datetime.now() - tm_decode
+                if self.index_redundancy>0:
+                    # virtual segments(e.g. of Wukong) have indexes from 1<<(index_length-index_redundancy),
+                    # they are no copy of any segment and would be orphans
+                    keep = bit_segments.get_indexes(self.index_length) < 1 << (self.index_length - self.index_redundancy)
+                    bit_segments = bit_segments.take(keep)
+                    weights = weights[keep] if weights is not None else None
+                if consensus is None:
+                    consensus = Consensus(self.seq_num, self.index_length, bit_segments.bit_len, kmer_len=kmer_len, min_match=min_match,
+                                          votes_path=votes_path)
+                consensus.add(bit_segments, weights)
+            if consensus is None:
+                break
+            if pass_num==0 and two_pass:
+                consensus.next_pass()
+        if consensus is None:
+            raise CodecException("No sequence to decode")
+        self.decode_time = str(decode_time)
+        bit_segments = consensus.get_segments(mark_ties=self.codec_param.rs_num>0)
+        self.read_num, self.orphan_num, self.assigned_num = consensus.read_num, consensus.orphan_num, consensus.assigned_num
+        del consensus
+        remove(votes_path)
+        self._restore_file(bit_segments)
+        self.run_time = str(datetime.now() - tm_run)
+        return self.output_file_path
+
+    def _get_read_weights(self, scores, seq_len):
+        """
+        weights of the segments decoded from reads(of at most seq_len bases) in the consensus:
+        the mean Phred score of every read, codecs decoding every base to a bit weigh the bits by their bases instead
+        @param scores: Phred scores(uint8 arrays) of the reads, see FileTools.get_phred
+        @return: weight of every segment, or of every bit of it
+        """
+        return np.array([x.mean() if len(x)>0 else 0.0 for x in scores])
+
+    @staticmethod
+    def _get_base_scores(scores, seq_len):
+        """
+        Phred scores of the reads in a matrix of seq_len columns, 0 for the missing bases of short reads
+        """
+        matrix = np.zeros((len(scores), seq_len), dtype=np.uint8)
+        for row, score in enumerate(scores):
+            matrix[row, :len(score)] = score
+        return matrix
+
+    def _decode_weighted(self, base_line_list, quality_list):
+        """
+        decode the copies for the consensus, with their weights from the qualities of FASTQ reads
+        @param quality_list: quality strings, or None
+        @return: BitSegments(erasures kept), weights or None
+        """
+        weights = None
+        if quality_list is not None:
+            # longer reads are dropped by _decode, they are dropped first to keep the weights in line
+            seq_len = Counter(len(x) for x in base_line_list).most_common(1)[0][0]
+            rows = [i for i, x in enumerate(base_line_list) if len(x)<=seq_len]
+            base_line_list = [base_line_list[i] for i in rows]
+            weights = self._get_read_weights(FileTools.get_phred([quality_list[i] for i in rows]), seq_len)
+        bit_segments = self._run_decode(base_line_list, keep_erasures=True)
+        if weights is not None and (len(weights)!=len(bit_segments) or weights.ndim==2 and weights.shape[1]!=bit_segments.bit_len):
+            log.warning("qualities do not match the decoded segments, the copies are not weighted")
+            weights = None
+        return bit_segments, weights
+
+    def _get_range_rows(self, first_id, stop_id, outer_code):
+        """
+        indexes of the data segments [first_id, stop_id) and of the other segments of their redundancy groups
+        """
+        if outer_code is None:
+            return np.arange(first_id, stop_id, dtype=np.int64)
+        groups = np.arange(first_id // outer_code.data_num, (stop_id - 1) // outer_code.data_num + 1, dtype=np.int64)
+        rows = (groups[:, None] * outer_code.group_len + np.arange(outer_code.group_len)).ravel()
+        return rows[rows < self.seq_num]
+
+    def _iter_range_reads(self, rows, block_rows, read_index):
+        """
+        blocks of base sequences holding the segments of rows:
+        only the sequences found in the read index if it exists, otherwise all the sequences
+        """
+        if read_index is None:
+            read_index = self.input_file_path + READ_INDEX_SUFFIX
+        if not path.exists(read_index):
+            log.warning("No read index : {}, all the sequences are decoded".format(read_index))
+            base_lines = self._iter_base_lines()
+            while True:
+                base_line_list = [line for _,line in zip(range(block_rows), base_lines)]
+                if len(base_line_list)==0:
+                    break
+                yield base_line_list
+            return
+        read_map = np.load(read_index, mmap_mode='r')
+        if len(read_map)!=self.seq_num:
+            raise CodecException("The read index does not match the pool : {}".format(read_index))
+        read_ids = np.unique(read_map[rows])
+        read_ids = read_ids[read_ids >= 0]
+        if len(read_ids)==0:
+            return
+        if PackedPool.is_packed(self.input_file_path):
+            pool = PackedPool(self.input_file_path)
+            left, right = self._get_primer_cut()
+            for start in range(0, len(read_ids), block_rows):
+                yield [pool.read(x, x + 1)[0][left:right] for x in read_ids[start:start + block_rows].tolist()]
+            return
+        # the sequences are read in order until the last one needed
+        first_read = 0
+        for reads, qualities in self._iter_read_blocks():
+            block_ids = read_ids[np.searchsorted(read_ids, first_read):np.searchsorted(read_ids, first_read + len(reads))] - first_read
+            first_read += len(reads)
+            reads = [reads[x] for x in block_ids.tolist()]
+            if qualities is not None and self.min_quality>0:
+                reads = FileTools.mask_bases(reads, [qualities[x] for x in block_ids.tolist()], self.min_quality)
+            if len(reads)>0:
+                yield reads
+            if first_read > read_ids[-1]:
+                break
+
+    @shutdown_executor
+    def decode_range(self, offset, length, max_memory=512*1024*1024, read_index=None):
+        """
+        random access: decode bytes [offset, offset+length) of the original file.
+        The segment with index i holds the file bits from data_id(i)*bin_seg_len, so only the segments of the range
+        and the other segments of their redundancy groups are needed. With the read index written at encode time
+        (see AbstractEncode.set_pool_format) only their sequences are read(seeked in a packed pool) and decoded,
+        otherwise all the sequences are decoded by blocks and the other segments are dropped.
+        Missing segments that cannot be repaired are left as zeros, as in stream_decode.
+        @param max_memory: memory ceiling in bytes of the sequences decoded at a time
+        @param read_index: the read index file, None for input_file_path+'.index.npy'
+        @return: bytes
+        """
+        self._parse_param()
+        self._reset_rs_counters()
+        tm_run = datetime.now()
+        file_len = self.codec_param.total_bit // 8
+        if offset<0 or length<0 or offset+length>file_len:
+            raise CodecException("Byte range [{}, {}) is out of the file of {} bytes".format(offset, offset+length, file_len))
+        if length==0:
+            return b''
+        outer_code = OuterCode.get(self.codec_param.add_redundancy)
+        chunk_len = SplitTools.get_chunk_len(self.codec_param.bin_seg_len, outer_code)
+        rows = self._get_range_rows(offset*8 // chunk_len, -(-(offset+length)*8 // chunk_len), outer_code)
+        first_id = int(SplitTools.get_data_id(rows[0], outer_code))
+
+        # decode the sequences and keep the segments of rows, at their positions in rows
+        seg_data = np.zeros((len(rows), (chunk_len+7)//8), dtype=np.uint8)
+        exist = np.zeros(len(rows), dtype=bool)
+        decode_time = timedelta(0)
+        for base_line_list in self._iter_range_reads(rows, self._get_block_rows(max_memory), read_index):
+            tm_decode = datetime.now()
+            bit_segments = self._run_decode(base_line_list)
+            decode_time += datetime.now() - tm_decode
+            if self.codec_param.rs_num>0 and len(bit_segments)>0:
+                bit_segments, _ = self._del_rscode(bit_segments)
+            if len(bit_segments)==0:
+                continue
+            indexes = bit_segments.get_indexes(self.index_length)
+            pos = np.minimum(np.searchsorted(rows, indexes), len(rows)-1)
+            found = np.nonzero(rows[pos]==indexes)[0]
+            seg_data[pos[found]] = bit_segments.take(found).cut(self.index_length, self.index_length + chunk_len).packed
+            exist[pos[found]] = True
+        self.decode_time = str(decode_time)
+        if self.codec_param.rs_num>0:
+            self._log_rs_counters()
+
+        # repair and count missing segments, the groups of rows are whole except at the end of the pool
+        log.debug('repair')
+        self.repaired_indexs, self.miss_err_indexs = [], []
+        is_data = outer_code.is_data(rows) if outer_code else np.ones(len(rows), dtype=bool)
+        if outer_code is None:
+            self.miss_err_indexs = rows[~exist].tolist()
+        else:
+            group_len = outer_code.group_len
+            for start in np.unique(np.nonzero(~exist)[0] // group_len * group_len).tolist():
+                group = slice(start, start + group_len)
+                missing = rows[group][is_data[group] & ~exist[group]].tolist()
+                if len(rows[group]) == group_len and outer_code.repair_group(seg_data[group], exist[group]):
+                    exist[group] = True
+                    for seg_index in missing: log.info("repair segment {}".format(seg_index))
+                    self.repaired_indexs.extend(missing)
+                else:
+                    for seg_index in missing: log.warning("error to repair segment {}".format(seg_index))
+                    self.miss_err_indexs.extend(missing)
+        for index in self.miss_err_indexs: log.warning('missing segment, index:{}'.format(index))
+        self.repaired_rate = len(self.repaired_indexs) / self.seq_num
+        self.miss_err_rate = len(self.miss_err_indexs) / self.seq_num
+
+        keep = is_data & exist
+        data_ids = SplitTools.get_data_id(rows[is_data], outer_code) - first_id
+        buffer = np.zeros(SplitTools.get_buffer_len(int(data_ids[-1]) + 1, chunk_len), dtype=np.uint8)
+        SplitTools.write_segments(buffer, SplitTools.get_data_id(rows[keep], outer_code) - first_id,
+                                  BitSegments(seg_data[keep], chunk_len))
+        start_bit = offset*8 - first_id*chunk_len
+        res_bytes = np.packbits(np.unpackbits(buffer)[start_bit:start_bit + length*8]).tobytes()
         self.run_time = str(datetime.now() - tm_run)
-        return self.output_file_path
\ No newline at end of file
+        return res_bytes
\ No newline at end of file
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from collections import Counter
+import logging
+
+log = logging.getLogger('mylog')
+
+# rows handled per block when packing or unpacking segments, keep it a multiple of 24
+# so that a block always starts at a byte boundary of the data and at a redundancy triple
+BLOCK_ROWS = 8184
+
+class BitSegments:
+    """
+    Binary segments packed 8 bits per byte.
+    Every row holds one segment of bit_len bits, right-aligned in ceil(bit_len/8) bytes:
+    the first byte is left-padded with zero bits, the same padding ReedSolomon uses,
+    so a row can be handed to RS as it is.
+    erasures optionally marks the bytes decoded from invalid bases, which RS corrects as erasures.
+    It also behaves like a read-only list of '0'/'1' strings, which keeps codecs
+    written for string segments working.
+    """
+
+    def __init__(self, packed, bit_len:int, erasures=None):
+        self.bit_len = bit_len
+        self.packed = np.ascontiguousarray(packed, dtype=np.uint8).reshape(-1, (bit_len + 7) // 8)
+        self.erasures = erasures # bool array with the shape of packed, or None
+
+    @property
+    def pad(self):
+        return -self.bit_len % 8
+
+    @property
+    def byte_len(self):
+        return self.packed.shape[1]
+
+    @classmethod
+    def from_bits(cls, bits):
+        """
+        pack a 2-D array of 0/1 values (one row per segment)
+        """
+        bits = np.asarray(bits, dtype=np.uint8)
+        if bits.ndim == 1:
+            bits = bits.reshape(1, -1)
+        seg_num, bit_len = bits.shape
+        pad = -bit_len % 8
+        if pad:
+            bits = np.concatenate((np.zeros((seg_num, pad), dtype=np.uint8), bits), axis=1)
+        return cls(np.packbits(bits, axis=1), bit_len)
+
+    @classmethod
+    def from_strings(cls, str_list, bit_len=None):
+        """
+        pack a list of '0'/'1' strings, strings whose length is not bit_len are dropped
+        @param bit_len: segment length, the most common length if None
+        """
+        if bit_len is None:
+            bit_len = Counter(len(x) for x in str_list).most_common(1)[0][0] if len(str_list) > 0 else 0
+        kept = [x for x in str_list if len(x) == bit_len]
+        if len(kept) != len(str_list):
+            log.warning("drop {} segment(s) whose length is not {}".format(len(str_list) - len(kept), bit_len))
+        if len(kept) == 0:
+            return cls(np.zeros((0, (bit_len + 7) // 8), dtype=np.uint8), bit_len)
+        bits = np.frombuffer(''.join(kept).encode(), dtype=np.uint8) - ord('0')
+        return cls.from_bits(bits.reshape(len(kept), bit_len))
+
+    @staticmethod
+    def concat(segments_list):
+        bit_len = segments_list[0].bit_len
+        erasures = None
+        if any(x.erasures is not None for x in segments_list):
+            erasures = np.concatenate([x.erasures if x.erasures is not None else np.zeros(x.packed.shape, dtype=bool)
+                                       for x in segments_list])
+        return BitSegments(np.concatenate([x.packed for x in segments_list]), bit_len, erasures)
+
+    def __len__(self):
+        return self.packed.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return BitSegments(self.packed[key], self.bit_len, None if self.erasures is None else self.erasures[key])
+        return (self.row_bits(key) + ord('0')).tobytes().decode()
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def take(self, rows):
+        return BitSegments(self.packed[rows], self.bit_len, None if self.erasures is None else self.erasures[rows])
+
+    def mark_erasures(self, invalid_bits):
+        """
+        mark the bytes holding invalid bits as erasures
+        @param invalid_bits: bool array, shape (rows, bit_len)
+        """
+        invalid_bits = np.asarray(invalid_bits, dtype=bool)
+        if not invalid_bits.any():
+            return
+        padded = np.zeros((len(self), 8 * self.byte_len), dtype=bool)
+        padded[:, self.pad:] = invalid_bits
+        erasures = padded.reshape(len(self), self.byte_len, 8).any(axis=2)
+        self.erasures = erasures if self.erasures is None else self.erasures | erasures
+
+    def has_erasures(self):
+        """
+        bool array, True for the rows with erasures
+        """
+        if self.erasures is None:
+            return np.zeros(len(self), dtype=bool)
+        return self.erasures.any(axis=1)
+
+    def row_bits(self, row):
+        """
+        0/1 array of one segment
+        """
+        return np.unpackbits(self.packed[row])[self.pad:]
+
+    def to_bits(self, start=0, stop=None):
+        """
+        0/1 array of segments, shape (rows, bit_len)
+        """
+        return np.unpackbits(self.packed[start:stop], axis=1)[:, self.pad:]
+
+    def to_strings(self):
+        return list(self)
+
+    def get_indexes(self, index_length):
+        """
+        parse the index at the head of every segment
+        """
+        head_bytes = (self.pad + index_length + 7) // 8
+        head = np.unpackbits(self.packed[:, :head_bytes], axis=1)[:, self.pad:self.pad + index_length]
+        weight = np.left_shift(1, np.arange(index_length - 1, -1, -1, dtype=np.int64))
+        return head.astype(np.int64) @ weight
+
+    def cut(self, start_bit, stop_bit=None):
+        """
+        keep bits [start_bit, stop_bit) of every segment, e.g. cut(index_length) removes the index
+        """
+        stop_bit = self.bit_len if stop_bit is None else stop_bit
+        res = np.empty((len(self), (stop_bit - start_bit + 7) // 8), dtype=np.uint8)
+        for start in range(0, len(self), BLOCK_ROWS):
+            res[start:start + BLOCK_ROWS] = BitSegments.from_bits(
+                self.to_bits(start, start + BLOCK_ROWS)[:, start_bit:stop_bit]).packed
+        return BitSegments(res, stop_bit - start_bit)
@@ -6,8 +6,11 @@ Created on Thu Aug  5 10:37:21 2021
 """
 
 import argparse
+import numpy as np
 from tqdm import tqdm
 
+from StorageD.bits import BitSegments, BLOCK_ROWS
+
 map_dic = {'0':['A', 'C'], '1':['G', 'T']}
 
 
@@ -35,13 +38,45 @@ def seqEncode(bin_seq: str, map_dic: dict =map_dic, rep_num: int = 4) -> str:
     nt_seq = "".join(nt_seq_list)
     return nt_seq
 
+def churchEncodeArray(bits, map_dic: dict =map_dic, rep_num: int = 4):
+    """
+    2-D 0/1 array(a segment per row) >> 2-D uint8 array of base ascii codes, the same as seqEncode for every row.
+    The first base of a bit turns to the second one only after rep_num first bases in a row,
+    so in a run of the same bit, every (rep_num+1)th base is the second one.
+    """
+    bits = np.asarray(bits, dtype=np.uint8)
+    # bases of 2*bit + is_second
+    table = np.frombuffer(''.join(map_dic['0'] + map_dic['1']).encode(), dtype=np.uint8)
+    if rep_num < 1 or len(set(table.tolist())) < 4:
+        # runs may join bases of different bits
+        return np.array([list(seqEncode(''.join(map(str, x)), map_dic, rep_num).encode()) for x in bits.tolist()],
+                        dtype=np.uint8).reshape(bits.shape)
+    cols = np.arange(bits.shape[1])
+    is_start = np.ones(bits.shape, dtype=bool)
+    is_start[:, 1:] = bits[:, 1:] != bits[:, :-1]
+    run_pos = cols - np.maximum.accumulate(np.where(is_start, cols, 0), axis=1)
+    return table[2*bits + (run_pos % (rep_num + 1) == rep_num)]
+
 def churchEncode(bin_seq_list: list, map_dic: dict =map_dic, rep_num: int = 4):
+    """
+    encode a list of binary strings, or BitSegments, by blocks of segments
+    """
     nt_seq_list = []
     pro_bar = tqdm(total=len(bin_seq_list), desc="Encoding")
-    for bin_seq in bin_seq_list:
-        nt_seq = seqEncode(bin_seq, map_dic=map_dic, rep_num=rep_num)
-        nt_seq_list.append(nt_seq)
-        pro_bar.update()
+    for start in range(0, len(bin_seq_list), BLOCK_ROWS):
+        if isinstance(bin_seq_list, BitSegments):
+            bits = bin_seq_list.to_bits(start, start + BLOCK_ROWS)
+            lengths = [bin_seq_list.bit_len] * len(bits)
+        else:
+            # padded at the end, the bases before do not change
+            block = bin_seq_list[start:start + BLOCK_ROWS]
+            lengths = [len(x) for x in block]
+            max_len = max(lengths)
+            bits = (np.frombuffer(''.join(x.ljust(max_len, '0') for x in block).encode(), dtype=np.uint8) - ord('0')).reshape(len(block), max_len)
+        bases = churchEncodeArray(bits, map_dic=map_dic, rep_num=rep_num)
+        text = bases.tobytes().decode()
+        nt_seq_list += [text[i*bases.shape[1]:i*bases.shape[1] + x] for i, x in enumerate(lengths)]
+        pro_bar.update(len(lengths))
     pro_bar.close()
 
     return nt_seq_list
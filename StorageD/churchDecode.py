@@ -6,6 +6,7 @@ Created on Thu Aug  5 10:37:21 2021
 """
 
 import argparse
+import numpy as np
 from tqdm import tqdm
 
 map_dic = {"A":"0", "C":"0", "G":"1", "T":"1"}
@@ -26,13 +27,39 @@ def seqDecode(nt_seq: str, map_dic : dict = map_dic) -> str:
 
     return bin_str
 
+def getDecodeTable(map_dic : dict = map_dic, invalid : str = "0") -> bytes:
+    """
+    translation table of ascii codes to '0'/'1', invalid bases (e.g. N) are translated to invalid
+    """
+    table = bytearray(invalid.encode() * 256)
+    for nt, bit in map_dic.items():
+        table[ord(nt.upper())] = table[ord(nt.lower())] = ord(bit)
+    return bytes(table)
+
+def churchDecodeArray(seq_list: list, map_dic : dict = map_dic):
+    """
+    DNA sequences of the same length >> 2-D 0/1 uint8 array(a segment per row),
+    invalid bases (e.g. N) are read as 0, the caller marks them as erasures
+    """
+    seq_len = len(seq_list[0]) if len(seq_list)>0 else 0
+    text = ''.join(seq_list).encode().translate(getDecodeTable(map_dic))
+    return (np.frombuffer(text, dtype=np.uint8) - ord('0')).reshape(len(seq_list), seq_len)
+
 def churchDecode(seq_list: list, map_dic : dict = map_dic) -> list:
-    bin_list = []
+    """
+    DNA sequences >> binary strings, translated in one pass
+    """
     pro_bar = tqdm(total=len(seq_list), desc="Decoding")
+    seqs = ''.join(seq_list)
+    text = seqs.encode().translate(getDecodeTable(map_dic, invalid="?")).decode()
+    if "?" in text:
+        raise KeyError(seqs[text.index("?")])
+    bin_list = []
+    start = 0
     for nt_seq in seq_list:
-        bin_str = seqDecode(nt_seq)
-        bin_list.append(bin_str)
-        pro_bar.update()
+        bin_list.append(text[start:start + len(nt_seq)])
+        start += len(nt_seq)
+    pro_bar.update(len(seq_list))
     pro_bar.close()
 
     return bin_list
@@ -1,26 +1,49 @@
 # -*- coding: utf-8 -*-
-from datetime import datetime
+from datetime import datetime, timedelta
+from os import remove
 from math import ceil
+from collections import Counter
 import json
+from functools import partial
+import numpy as np
 
-from StorageD.abstract_codec import AbstractEncode,AbstractDecode
-from StorageD.tools import  DecodeParameter, CodecException
+from StorageD.abstract_codec import AbstractEncode,AbstractDecode,shutdown_executor
+from StorageD.tools import  DecodeParameter, CodecException, BitSegments, BaseTools, SplitTools, base_to_num
 from StorageD.wukong import Wukong
 from StorageD.church import churchEncode
-from StorageD.churchDecode import churchDecode
-from StorageD.goldman import goldmanEncode
-from StorageD.goldmanDecode import goldmanDecode
+from StorageD.churchDecode import churchDecodeArray
+from StorageD.goldman import bytesToTernary, encodeNtList, getTritNum, rs_trit_table
+from StorageD.goldmanDecode import decodeNtArray, parseTrits, rsTritsToBytes, tritsToBytes
 
 import logging
 log = logging.getLogger('mylog')
 
+def wukong_encode_task(param, bit_segments):
+    """
+    encode a chunk with a new Wukong(see WukongEncode._get_encode_task)
+    @param param: rule_num and the keyword arguments of Wukong.wukong_encode
+    @return: base segments, number and time of the virtual segments
+    """
+    rule_num, encode_args = param
+    codec_worker = Wukong(rule_num=rule_num)
+    base_segments = codec_worker.wukong_encode(bit_segments=bit_segments, **encode_args)
+    return base_segments, codec_worker.addtion_num, codec_worker.virtual_time
+
+def wukong_decode_task(param, base_line_list):
+    rule_num, processes = param
+    return Wukong(rule_num=rule_num).wukong_decode(base_line_list, processes=processes)
+
 class WukongEncode(AbstractEncode):
     def __init__(self, input_file_path:str, output_dir:str, sequence_length:int, rule_num=0,
                  max_homopolymer=6, min_gc=0.3, max_gc=0.7, rs_num=0,  add_redundancy=False, 
-                 add_primer=False, primer_length=20, same_res=True):
+                 add_primer=False, primer_length=20, same_res=True, processes=None, max_iterations=256, rank_candidates=True):
         self.rule_num = rule_num
+        self.max_iterations = max_iterations # candidate partners of a segment, see Wukong.wukong_encode
+        self.rank_candidates = rank_candidates
         self.same_res = same_res
+        self.processes = processes
         self.virtual_segment = 0
+        self.virtual_time = 0.0
         index_redundancy = 1 #for virtual segments in wukong
         seq_bit_to_base_ratio = 1
         data_len = sequence_length-primer_length if add_primer else sequence_length
@@ -32,23 +55,61 @@ class WukongEncode(AbstractEncode):
                          min_gc=min_gc, max_gc=max_gc, rs_num=rs_num, add_redundancy=add_redundancy, add_primer=add_primer, 
                          primer_length=primer_length)
 
+    def _get_encode_task(self):
+        encode_args = dict(index_length=self.index_length, max_homopolymer=self.codec_param.max_homopolymer,
+                           max_content=self.codec_param.max_gc, min_content=self.codec_param.min_gc, hasseed=self.same_res,
+                           processes=self.processes, max_iterations=self.max_iterations, rank_candidates=self.rank_candidates)
+        return wukong_encode_task, (self.rule_num, encode_args)
+
     def _encode(self, bit_segments):
-        self.codec_worker = Wukong(rule_num=self.rule_num)
-        base_segments = self.codec_worker.wukong_encode(index_length=self.index_length, bit_segments=bit_segments, max_homopolymer=self.codec_param.max_homopolymer,
-                                                    max_content=self.codec_param.max_gc, min_content=self.codec_param.min_gc, hasseed=self.same_res)
-        self.virtual_segment = self.codec_worker.addtion_num
-        return base_segments
+        # in stream_encode, segments are paired within each block, and with an executor within each chunk.
+        # A new worker for every call, as chunks run in threads or processes,
+        # its counts of virtual segments are returned and added up in _run_encode
+        task, param = self._get_encode_task()
+        return task(param, bit_segments)
+
+    def _run_encode(self, bit_segments):
+        if self.executor is None:
+            results = [self._encode(bit_segments)]
+        else:
+            results = self.executor.map_chunks(partial(*self._get_encode_task()), bit_segments)
+        for _, addtion_num, virtual_time in results:
+            self.virtual_segment += addtion_num
+            self.virtual_time += virtual_time
+        return [dnaseq for base_segments, _, _ in results for dnaseq in base_segments]
+
+    def _get_read_indexes(self, seq_list):
+        # a sequence holds two segments, its bases decode to both of them
+        if self.codec_worker is None:
+            self.codec_worker = Wukong(rule_num=self.rule_num)
+        bit_seg_1, bit_seg_2 = self.codec_worker._jioudecode(seq_list)
+        power = 1 << np.arange(self.index_length - 1, -1, -1, dtype=np.int64)
+        indexes = np.stack((bit_seg_1[:, :self.index_length] @ power, bit_seg_2[:, :self.index_length] @ power), axis=1)
+        return np.repeat(np.arange(len(seq_list)), 2), indexes.ravel()
+
+    @property
+    def virtual_speed(self):
+        """
+        virtual segments produced per second
+        """
+        return self.virtual_segment / self.virtual_time if self.virtual_time > 0 else 0.0
     
 class WukongDecode(AbstractDecode):
-    def __init__(self, input_file_path:str, output_dir:str, rule_num=0):
+    def __init__(self, input_file_path:str, output_dir:str, rule_num=0, processes=None):
         self.rule_num = rule_num
+        self.processes = processes
         index_redundancy = 1
         super().__init__(input_file_path, output_dir, index_redundancy=index_redundancy)
 
+    def _get_decode_task(self):
+        return wukong_decode_task, (self.rule_num, self.processes)
+
     def _decode(self, base_line_list):
-        self.codec_worker = Wukong(rule_num=self.rule_num)
-        bit_segments = self.codec_worker.wukong_decode(base_line_list)
-        return bit_segments
+        return wukong_decode_task((self.rule_num, self.processes), base_line_list)
+
+    def _get_read_weights(self, scores, seq_len):
+        # a base holds the bits at its position of both segments
+        return np.repeat(self._get_base_scores(scores, seq_len), 2, axis=0)
 
 ############################################  
 """
@@ -57,6 +118,20 @@ Reference:
 * DOI: 10.1126/science.1226355
 * https://pubmed.ncbi.nlm.nih.gov/22903519/
 """ 
+def church_encode_task(rep_num, bit_segments):
+    return churchEncode(bit_segments, rep_num=rep_num)
+
+def church_decode_task(_, base_line_list):
+    """
+    one base for one bit, short sequences are filled with N, and invalid bases are marked as erasures
+    """
+    seq_len = Counter(len(x) for x in base_line_list).most_common(1)[0][0] if len(base_line_list)>0 else 0
+    seqs = [x.ljust(seq_len, 'N') for x in base_line_list if len(x)<=seq_len]
+    bit_segments = BitSegments.from_bits(churchDecodeArray(seqs).reshape(len(seqs), seq_len))
+    if len(seqs)>0:
+        bit_segments.mark_erasures(base_to_num[BaseTools.seqs_to_array(seqs)]>3)
+    return bit_segments
+
 class ChurchEncode(AbstractEncode):
     def __init__(self, input_file_path:str, output_dir:str, sequence_length:int, max_homopolymer=6, 
                  rs_num=0, add_redundancy=False, add_primer=False, primer_length=20):        
@@ -66,18 +141,31 @@ class ChurchEncode(AbstractEncode):
                          sequence_length=sequence_length, max_homopolymer=max_homopolymer, rs_num=rs_num, add_redundancy=add_redundancy, 
                          add_primer=add_primer, primer_length=primer_length)
     
+    def _get_encode_task(self):
+        return church_encode_task, self.codec_param.max_homopolymer
+
     def _encode(self, bit_segments):
-        base_segments = churchEncode(bit_segments, rep_num=self.codec_param.max_homopolymer)
+        base_segments = church_encode_task(self.codec_param.max_homopolymer, bit_segments)
         return base_segments
+
+    def _get_read_indexes(self, seq_list):
+        bits = churchDecodeArray([x[:self.index_length] for x in seq_list]).astype(np.int64)
+        indexes = bits @ (1 << np.arange(self.index_length - 1, -1, -1, dtype=np.int64))
+        return np.arange(len(seq_list)), indexes
     
 
 class ChurchDecode(AbstractDecode):
     def __init__(self, input_file_path:str, output_dir:str):
         super().__init__(input_file_path, output_dir)
 
+    def _get_decode_task(self):
+        return church_decode_task, None
+
     def _decode(self, base_line_list):
-        bit_segments = churchDecode(base_line_list)
-        return bit_segments
+        return church_decode_task(None, base_line_list)
+
+    def _get_read_weights(self, scores, seq_len):
+        return self._get_base_scores(scores, seq_len)
     
 ############################################ 
 """
@@ -86,64 +174,232 @@ Reference:
 * DOI: 10.1038/nature11875
 * https://www.ncbi.nlm.nih.gov/pubmed/23354052
 """
+def goldman_encode_task(param, bit_segments):
+    """
+    2 bits for a trit of the index and data, 6 trits for a byte of rscode, and the bases rotate from "A"
+    @param param: trits of the index and data, rs_num
+    """
+    trit_num, rs_num = param
+    trit_segments = SplitTools.segments_to_trits(bit_segments, trit_num)
+    if rs_num>0:
+        rs_trits = rs_trit_table[bit_segments.packed[:, -rs_num:]].reshape(len(bit_segments), -1)
+        trit_segments = np.concatenate((trit_segments, rs_trits), axis=1)
+    return encodeNtList(trit_segments)
+
+def goldman_decode_task(param, base_line_list):
+    """
+    short sequences are filled with N, and unknown trits(invalid or repeated bases) are marked as erasures
+    @param param: trits of the index and data, rs_num
+    """
+    trit_num, rs_num = param
+    seq_len = trit_num + 6*rs_num
+    seqs = [x.ljust(seq_len, 'N') for x in base_line_list if len(x)<=seq_len]
+    trit_segments = decodeNtArray(seqs) if len(seqs)>0 else np.zeros((0, seq_len), dtype=np.uint8)
+    bit_segments = SplitTools.trits_to_segments(trit_segments[:, :trit_num])
+    if rs_num>0:
+        rs_bytes, invalid = rsTritsToBytes(trit_segments[:, trit_num:])
+        erasures = bit_segments.erasures if bit_segments.erasures is not None else np.zeros(bit_segments.packed.shape, dtype=bool)
+        bit_segments = BitSegments(np.concatenate((bit_segments.packed, rs_bytes), axis=1),
+                                   bit_segments.bit_len + 8*rs_num,
+                                   np.concatenate((erasures, invalid), axis=1))
+    return bit_segments
+
 class GoldmanEncode(AbstractEncode): 
-    def __init__(self, input_file_path:str, output_dir:str, sequence_length:int):
+    def __init__(self, input_file_path:str, output_dir:str, sequence_length:int, rs_num=0, add_primer=False, primer_length=20):
         """
         Subclass may add some new parameters, 
         and add 'super().__init__(input_file_path, output_dir, **kwargs)' in its __init__.
         """
-        super().__init__(input_file_path, output_dir, 'goldman', **{'sequence_length':sequence_length})
+        self.seg_len = 0 # trits of data in a segment
+        self.add_len = 0 # zeros filled after the trits of the file
+        self.total_trit = 0
+        super().__init__(input_file_path, output_dir, 'goldman', sequence_length=sequence_length, rs_num=rs_num,
+                         add_primer=add_primer, primer_length=primer_length)
         
-    
-    def _encode(self, bit_segments: str) -> list:
-        pass
+    def _get_encode_task(self):
+        return goldman_encode_task, (self.index_length + self.seg_len, self.codec_param.rs_num)
 
-    # rewrite
-    def common_encode(self):
-        tm_run = datetime.now()
-        log.debug('read')
-        bin_str = self._file_to_bin()
-        # encode
-        log.debug('encode')
-        tm_encode = datetime.now()
-        nt_seq_list, self.index_length, self.add_len, ternary_seg_list, ternary_str = goldmanEncode(bin_str, self.codec_param.sequence_length)
-        self.encode_time = str(datetime.now()-tm_encode)
-        
-        self.total_base = len(nt_seq_list)*len(nt_seq_list[0])
-        self.seq_num = len(nt_seq_list)
-        param = ">indexLen:{},addLen:{},fileExtension:{}\n".format(
-            self.index_length, self.add_len, self.file_extension)
-        with open(self.output_file_path, 'w') as f:
-            f.write(param)
-            for index,seg in enumerate(nt_seq_list):
-                f.write(">seq_{}\n".format(index+1) + seg + '\n')
-        
-        self.run_time = str(datetime.now()-tm_run)
-        self._set_density()
-        return self.output_file_path
+    def _encode(self, bit_segments):
+        return goldman_encode_task((self.index_length + self.seg_len, self.codec_param.rs_num), bit_segments)
+
+    def _get_ideal_len(self):
+        """
+        trits of the index and data in a sequence
+        """
+        ideal_len = self.codec_param.sequence_length - 6*self.codec_param.rs_num
+        if self.codec_param.add_primer:
+            ideal_len -= 2*self.codec_param.primer_length
+        return ideal_len
+
+    def _get_split_plan(self, bin_len):
+        # overlapping segments of the trits(see SplitTools.get_overlap_plan), 2 bits for a trit
+        if self.total_trit == 0:
+            self.total_trit = getTritNum(self.input_file_path)
+        self.seg_len, index_length, seq_num, self.add_len = SplitTools.get_overlap_plan(self.total_trit, self._get_ideal_len())
+        if ceil(2*(index_length + self.seg_len)/8) + self.codec_param.rs_num > 255:
+            raise CodecException("Goldman: a segment with rscode should be at most 255 bytes")
+        return index_length, 2*self.seg_len, seq_num, 1
+
+    def _get_segment_num(self):
+        return SplitTools.get_overlap_plan(self.total_trit, self._get_ideal_len())[2]
+
+    def _split_bin(self, file_bytes):
+        trits = bytesToTernary(file_bytes)
+        self.total_trit = len(trits)
+        index_length, bin_split_len, seq_num, rs_group = self._get_split_plan(len(trits))
+        trit_segments = SplitTools.split_overlap(trits, 0, seq_num, self.seg_len, index_length)
+        return bin_split_len, index_length, rs_group, SplitTools.trits_to_segments(trit_segments)
+
+    def _iter_bit_segments(self, block_rows):
+        # the trits of a block overlap the next block by 3/4 of a segment
+        step = self.seg_len // 4
+        trits, trit_start = np.zeros(0, dtype=np.uint8), 0
+        with open(self.input_file_path, 'rb') as file:
+            for first_row in range(0, self.seq_num, block_rows):
+                row_num = min(block_rows, self.seq_num - first_row)
+                start, stop = first_row*step, (first_row + row_num - 1)*step + self.seg_len
+                while trit_start + len(trits) < stop:
+                    data = file.read(max(1, (stop - trit_start - len(trits)) // 5))
+                    if len(data)==0:
+                        break
+                    trits = np.concatenate((trits, bytesToTernary(data)))
+                trit_segments = SplitTools.split_overlap(trits[start - trit_start:stop - trit_start], first_row, row_num,
+                                                         self.seg_len, self.index_length)
+                trits, trit_start = trits[(first_row + row_num)*step - trit_start:], (first_row + row_num)*step
+                bit_segments = SplitTools.trits_to_segments(trit_segments)
+                if self.codec_param.rs_num>0:
+                    bit_segments = self._add_rscode(bit_segments)
+                yield bit_segments
+
+    def _set_param_line(self, left_primer="", right_primer=""):
+        param = ">indexLen:{},segLen:{},segNum:{},addLen:{},leftPrimer:{},rightPrimer:{},fileExtension:{},RSNum:{}\n".format(
+            self.index_length, self.seg_len, self.seq_num, self.add_len, left_primer, right_primer, self.file_extension,
+            int(self.codec_param.rs_num))
+        return param
         
 
 class GoldmanDecode(AbstractDecode):
     def __init__(self, input_file_path:str, output_dir:str):
          super().__init__(input_file_path, output_dir)
+         self.seg_len = 0
+         self.add_len = 0
+         self.seg_num = None # number of segments, None for the pools whose parameter line does not keep it
          
-    def _decode(self):
-        pass
+    def _get_decode_task(self):
+        return goldman_decode_task, (self.index_length + self.seg_len, self.codec_param.rs_num)
+
+    def _decode(self, base_line_list):
+        return goldman_decode_task((self.index_length + self.seg_len, self.codec_param.rs_num), base_line_list)
+
+    def _run_decode(self, base_line_list, keep_erasures=True):
+        # unknown trits are outvoted by the overlapping segments, segments with erasures are kept
+        return super()._run_decode(base_line_list, keep_erasures=True)
+
+    def _get_indexes(self, bit_segs):
+        return SplitTools.get_ternary_indexes(SplitTools.segments_to_trits(bit_segs, self.index_length), self.index_length)
+
+    def _get_sequence_length(self):
+        """
+        the most common length of the first sequences
+        """
+        reads = next(self._iter_read_blocks(), ([], None))[0]
+        if len(reads)==0:
+            raise CodecException("No sequence to decode")
+        return Counter(len(x) for x in reads).most_common(1)[0][0]
 
     # rewrite
     def _parse_param(self):
-        param_dict = self._check_file_param(["indexLen","addLen","fileExtension"])
+        if 'segLen:' in self._get_param_line():
+            param_dict = self._check_file_param(["indexLen","segLen","segNum","addLen","leftPrimer","rightPrimer",
+                                                 "fileExtension","RSNum"])
+            param = {
+                'rs_num' : int(param_dict['RSNum']),
+                'left_primer_len' : len(param_dict['leftPrimer']),
+                'right_primer_len' : len(param_dict['rightPrimer']),
+                'file_extension' : param_dict['fileExtension']
+                }
+        else:
+            # pools without rscode and primers, the segment length comes from the sequences
+            param_dict = self._check_file_param(["indexLen","addLen","fileExtension"])
+            param = {'file_extension' : param_dict['fileExtension']}
+        self.codec_param = DecodeParameter(**param)
         self.index_length = int(param_dict['indexLen'])
         self.add_len = int(param_dict['addLen'])
-        self.file_extension = param_dict['fileExtension']
-        self.codec_param=DecodeParameter(file_extension=self.file_extension)
+        if 'segLen' in param_dict:
+            self.seg_len, self.seg_num = int(param_dict['segLen']), int(param_dict['segNum'])
+        else:
+            self.seg_len, self.seg_num = self._get_sequence_length() - self.index_length, None
+        # the indexes a segment may have
+        self.seq_num = self.seg_num if self.seg_num is not None else 3**self.index_length
+        self.ori_len = 2*(self.index_length + self.seg_len)
         self.output_file_path = self.output_dir + self.file_base_name + "_decode" + self.codec_param.file_extension
-        
-    def common_decode(self):
+
+    def _restore_file(self, bit_segments):
+        """
+        delete rscode, vote for every trit with the overlapping segments and write the bytes to the output file
+        """
+        if self.codec_param.rs_num>0:
+            bit_segments, _ = self._del_rscode(bit_segments)
+            self._log_rs_counters()
+        trit_segments = SplitTools.segments_to_trits(bit_segments, self.index_length + self.seg_len)
+        log.debug('merge')
+        trits = SplitTools.merge_overlap(trit_segments, self.index_length, self.add_len, self.seg_num)
+        log.debug('write')
+        self._bin_to_file(tritsToBytes(trits))
+
+    @shutdown_executor
+    def stream_decode(self, max_memory=512*1024*1024):
+        """
+        decode flow for large pools: sequences are read and decoded block by block,
+        and their trits vote in a memory-mapped array next to the output file(3 counts for every trit),
+        then the trits taking the majority are parsed to bytes block by block.
+        @param max_memory: memory ceiling in bytes
+        """
         self._parse_param()
+        self._reset_rs_counters()
         tm_run = datetime.now()
-        base_line_list = self._get_base_line_list()
-        #decode
-        goldmanDecode(base_line_list, self.output_file_path, self.index_length, self.add_len)
+        step = self.seg_len // 4
+        votes_path = self.output_file_path + '.votes'
+        votes = np.memmap(votes_path, dtype=np.uint16, mode='w+', shape=((self.seq_num - 1)*step + self.seg_len, 3))
+        decode_time = timedelta(0)
+        stop = 0
+
+        base_lines = self._iter_base_lines()
+        block_rows = self._get_block_rows(max_memory)
+        while True:
+            base_line_list = [line for _,line in zip(range(block_rows), base_lines)]
+            if len(base_line_list)==0:
+                break
+            tm_decode = datetime.now()
+            bit_segments = self._run_decode(base_line_list)
+            decode_time += datetime.now() - tm_decode
+            if self.codec_param.rs_num>0 and len(bit_segments)>0:
+                bit_segments, _ = self._del_rscode(bit_segments)
+            trit_segments = SplitTools.segments_to_trits(bit_segments, self.index_length + self.seg_len)
+            stop = max(stop, SplitTools.vote_overlap(votes, trit_segments, self.index_length))
+        self.decode_time = str(decode_time)
+        if self.codec_param.rs_num>0:
+            self._log_rs_counters()
+
+        log.debug('write')
+        total_len = max(0, (len(votes) if self.seg_num is not None else stop) - self.add_len)
+        block_len = max(6, max_memory // 64)
+        with open(self.output_file_path, 'wb') as file:
+            start = 0
+            while start < total_len:
+                block_stop = min(total_len, start + block_len)
+                data, end = parseTrits(SplitTools.get_overlap_trits(votes, start, block_stop))
+                file.write(data)
+                if block_stop==total_len:
+                    break
+                start += end
+        del votes
+        remove(votes_path)
         self.run_time = str(datetime.now() - tm_run)
-        return self.output_file_path
\ No newline at end of file
+        return self.output_file_path
+
+    def consensus_decode(self, max_memory=512*1024*1024, kmer_len=16, min_match=2):
+        raise CodecException("Goldman does not support consensus decode, the overlapping segments vote in common_decode")
+
+    def decode_range(self, offset, length, max_memory=512*1024*1024, read_index=None):
+        raise CodecException("Goldman does not support decode range")
\ No newline at end of file
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import logging
+
+from StorageD.bits import BitSegments, BLOCK_ROWS
+
+log = logging.getLogger('mylog')
+
+VOTE_MAX = np.iinfo(np.int16).max # votes saturate in int16
+
+class Consensus:
+    """
+    Consensus of many noisy copies of every segment.
+    Decoded copies are grouped by their index and vote bit by bit: an int16 vote matrix of seq_num rows
+    keeps +weight for 1 and -weight for 0, so the memory used depends on seq_num instead of the number of reads,
+    and it could be memory-mapped to a file(2 bytes for every bit).
+    Copies whose index is out of range or erased are kept as orphans(up to max_orphans)
+    and are assigned by the kmer_len-bit words they share with the consensus of the data bits.
+    A copy with a wrong index in range would vote for another segment, so the copies could be added twice:
+    after next_pass, a copy differing from the first consensus of its index in more than max_diff of the bits
+    is an orphan instead.
+    """
+
+    def __init__(self, seq_num, index_length, bit_len, kmer_len=16, min_match=2, max_orphans=1<<20, max_diff=0.25,
+                 votes_path=None):
+        """
+        @param votes_path: file of the memory-mapped votes, None to keep them in memory
+        """
+        self.seq_num = seq_num
+        self.index_length = index_length
+        self.bit_len = bit_len
+        self.kmer_len = kmer_len
+        self.min_match = min_match
+        self.max_orphans = max_orphans
+        self.max_diff = max_diff
+        self.reference = None # packed first consensus in next_pass
+        self.reference_exist = None
+        if votes_path is None:
+            self.votes = np.zeros((seq_num, bit_len), dtype=np.int16)
+        else:
+            self.votes = np.memmap(votes_path, dtype=np.int16, mode='w+', shape=(seq_num, bit_len))
+        self.copy_num = np.zeros(seq_num, dtype=np.int64)
+        self.orphans = []
+        self.orphan_weights = []
+        self.orphan_num = 0
+        self.read_num = 0
+        self.assigned_num = 0
+
+    def add(self, bit_segments, weights=None):
+        """
+        vote with a block of decoded copies
+        @param bit_segments: BitSegments of index+data bits, erasures are not counted
+        @param weights: None, integer weight of every copy or of every bit(e.g. Phred scores of the reads)
+        """
+        if len(bit_segments)==0:
+            return
+        if bit_segments.bit_len!=self.bit_len:
+            raise ValueError("Wrong segment length: {}, expected {}".format(bit_segments.bit_len, self.bit_len))
+        self.read_num += len(bit_segments)
+        indexes = bit_segments.get_indexes(self.index_length)
+        valid = indexes < self.seq_num
+        if bit_segments.erasures is not None:
+            valid &= ~self._get_erased_bits(bit_segments)[:, :self.index_length].any(axis=1)
+        if self.reference is not None:
+            valid[valid] = self._get_diff(bit_segments.take(np.nonzero(valid)[0]), indexes[valid]) <= self.max_diff
+        weights = self._get_weights(len(bit_segments), weights)
+        orphan_rows = np.nonzero(~valid)[0][:max(0, self.max_orphans - self.orphan_num)]
+        if len(orphan_rows)>0:
+            self.orphans.append(bit_segments.take(orphan_rows))
+            self.orphan_weights.append(weights[orphan_rows])
+            self.orphan_num += len(orphan_rows)
+        rows = np.nonzero(valid)[0]
+        self._vote(bit_segments.take(rows), indexes[rows], weights[rows])
+
+    def next_pass(self):
+        """
+        keep the consensus as the reference of the copies added again, and clear the votes
+        """
+        exist = self.copy_num>0
+        self.reference = np.concatenate([BitSegments.from_bits((self.votes[start:start + BLOCK_ROWS] > 0).astype(np.uint8)).packed
+                                         for start in range(0, self.seq_num, BLOCK_ROWS)])
+        self.reference_exist = exist
+        self.votes[:] = 0
+        self.copy_num[:] = 0
+        self.orphans, self.orphan_weights = [], []
+        self.orphan_num, self.read_num = 0, 0
+
+    def _get_diff(self, bit_segments, indexes):
+        """
+        fraction of the known bits of the copies differing from the reference of their indexes
+        """
+        diff = bit_segments.packed ^ self.reference[indexes]
+        known = np.full(diff.shape, 0xff, dtype=np.uint8)
+        if bit_segments.erasures is not None:
+            known[bit_segments.erasures] = 0
+        diff_num = np.unpackbits(diff & known, axis=1).sum(axis=1)
+        known_num = np.unpackbits(known, axis=1)[:, bit_segments.pad:].sum(axis=1)
+        # no reference for the indexes without copies in the first pass
+        return np.where(self.reference_exist[indexes], diff_num / np.maximum(known_num, 1), 0)
+
+    def _get_weights(self, row_num, weights):
+        if weights is None:
+            return np.ones((row_num, 1), dtype=np.int32)
+        weights = np.rint(weights).astype(np.int32)
+        return weights.reshape(row_num, -1)
+
+    @staticmethod
+    def _get_erased_bits(bit_segments):
+        return np.repeat(bit_segments.erasures, 8, axis=1)[:, bit_segments.pad:]
+
+    def _vote(self, bit_segments, indexes, weights, start_bit=0):
+        if len(bit_segments)==0:
+            return
+        bits = bit_segments.to_bits()[:, start_bit:]
+        contrib = (2*bits.astype(np.int32) - 1) * (weights if weights.shape[1]==1 else weights[:, start_bit:])
+        if bit_segments.erasures is not None:
+            contrib[self._get_erased_bits(bit_segments)[:, start_bit:]] = 0
+        # the rows voted by the block are added up in int32, then saturate in int16
+        rows, slots = np.unique(indexes, return_inverse=True)
+        row_votes = self.votes[rows, start_bit:].astype(np.int32)
+        np.add.at(row_votes, slots, contrib)
+        self.votes[rows, start_bit:] = np.clip(row_votes, -VOTE_MAX, VOTE_MAX)
+        np.add.at(self.copy_num, indexes, 1)
+
+    def _iter_votes(self, rows):
+        """
+        blocks of rows and their votes
+        """
+        for start in range(0, len(rows), BLOCK_ROWS):
+            block_rows = rows[start:start + BLOCK_ROWS]
+            yield block_rows, np.asarray(self.votes[block_rows])
+
+    def _assign_orphans(self):
+        """
+        assign orphans to segments sharing at least min_match data words at the same positions
+        """
+        if len(self.orphans)==0 or not self.copy_num.any():
+            return
+        orphans = self.orphans[0] if len(self.orphans)==1 else BitSegments.concat(self.orphans)
+        weights = np.concatenate(self.orphan_weights)
+        exist = np.nonzero(self.copy_num>0)[0]
+        word_num = (self.bit_len - self.index_length) // self.kmer_len
+        if word_num==0:
+            return
+        word_cols = self.index_length + np.arange(word_num*self.kmer_len).reshape(word_num, self.kmer_len)
+        power = (1 << np.arange(self.kmer_len - 1, -1, -1)).astype(np.int64)
+
+        def get_keys(bits):
+            # position of the word in the high bits, so that the same word at other positions differs
+            return (bits[:, word_cols].astype(np.int64) @ power) + (np.arange(word_num, dtype=np.int64) << self.kmer_len)
+        keys = np.concatenate([get_keys((votes > 0).astype(np.uint8)).ravel() for _, votes in self._iter_votes(exist)])
+        slots = np.repeat(exist, word_num)
+        # words shared by several segments(e.g. zero filler) tell nothing
+        unique_keys, first, counts = np.unique(keys, return_index=True, return_counts=True)
+        unique_keys, unique_slots = unique_keys[counts==1], slots[first[counts==1]]
+
+        orphan_keys = get_keys(orphans.to_bits())
+        pos = np.minimum(np.searchsorted(unique_keys, orphan_keys), max(len(unique_keys)-1, 0))
+        found = (unique_keys[pos]==orphan_keys) if len(unique_keys)>0 else np.zeros(orphan_keys.shape, dtype=bool)
+        orphan_ids = np.nonzero(found)[0]
+        if len(orphan_ids)==0:
+            return
+        # the segment with the most matched words of every orphan
+        pairs, match_num = np.unique(np.stack((orphan_ids, unique_slots[pos[found]]), axis=1), axis=0, return_counts=True)
+        order = np.lexsort((-match_num, pairs[:, 0]))
+        pairs, match_num = pairs[order], match_num[order]
+        best = np.concatenate(([True], pairs[1:, 0]!=pairs[:-1, 0]))
+        pairs, match_num = pairs[best], match_num[best]
+        pairs = pairs[match_num>=self.min_match]
+        self.assigned_num = len(pairs)
+        # the index bits of orphans are wrong, only their data bits vote
+        self._vote(orphans.take(pairs[:, 0]), pairs[:, 1], weights[pairs[:, 0]], start_bit=self.index_length)
+        self.orphans, self.orphan_weights = [], []
+        log.info("{} of {} orphan copies assigned".format(self.assigned_num, self.orphan_num))
+
+    def get_segments(self, mark_ties=True):
+        """
+        consensus segments of the voted indexes, in index order
+        @param mark_ties: bytes with a tied bit are marked as erasures for rscode
+        @return: BitSegments
+        """
+        self._assign_orphans()
+        exist = np.nonzero(self.copy_num>0)[0]
+        segments_list = []
+        for rows, votes in self._iter_votes(exist):
+            bits = (votes > 0).astype(np.uint8)
+            bits[:, :self.index_length] = (rows[:, None] >> np.arange(self.index_length - 1, -1, -1)) & 1
+            bit_segments = BitSegments.from_bits(bits)
+            if mark_ties:
+                ties = votes == 0
+                ties[:, :self.index_length] = False
+                bit_segments.mark_erasures(ties)
+            segments_list.append(bit_segments)
+        bit_segments = BitSegments.concat(segments_list) if len(segments_list)>0 else \
+            BitSegments.from_bits(np.zeros((0, self.bit_len), dtype=np.uint8))
+        log.info("consensus of {} reads: {} segments, {} copies on average".format(
+            self.read_num, len(exist), self.copy_num[exist].mean() if len(exist)>0 else 0))
+        return bit_segments
@@ -2,14 +2,39 @@
 from reedsolo import RSCodec, ReedSolomonError
 from tqdm import tqdm
 import math
+import numpy as np
+from functools import lru_cache
 import logging
 
+from StorageD.bits import BitSegments
+
 log = logging.getLogger('mylog')
 
 bin_to_str_list = list()
 for i in range(256):
     bin_to_str_list.append(bin(i)[2:].rjust(8,'0'))
 
+def _set_gf_tables(prim=0x11d):
+    """
+    GF(256) tables used by reedsolo(prim 0x11d, generator 2): exp, log and the 256x256 multiplication table
+    """
+    gf_exp = np.zeros(512, dtype=np.int32)
+    gf_log = np.zeros(256, dtype=np.int32)
+    x = 1
+    for i in range(255):
+        gf_exp[i] = x
+        gf_log[x] = i
+        x <<= 1 # multiply by the generator 2
+        if x & 0x100:
+            x ^= prim
+    gf_exp[255:510] = gf_exp[:255]
+    gf_mul = np.zeros((256, 256), dtype=np.uint8)
+    gf_mul[1:, 1:] = gf_exp[gf_log[1:, None] + gf_log[None, 1:]]
+    return gf_exp, gf_log, gf_mul
+
+gf_exp, gf_log, gf_mul = _set_gf_tables()
+
+
 class ReedSolomon():
     def __init__(self, check_bytes:int):
         """
@@ -19,30 +44,160 @@ class ReedSolomon():
         self.check_bytes = check_bytes
         self.tool = RSCodec(check_bytes)
         self.remainder = 0
+        self._set_generator()
+        # segments checked by remove: clean ones, ones with errors corrected and irreparable ones
+        self.clean_num = 0
+        self.corrected_num = 0
+        self.failed_num = 0
         log.debug('ecc check_bytes:{}'.format(check_bytes))
         
-    def insert_one(self, binstring, group=1):
-        # If the binary length is not a multiple of 8, it will be left-padded with zeros
-        self.remainder = 0
-        if len(binstring)%8!=0:
-            self.remainder = 8 - len(binstring) % 8
-            binstring = '0'*self.remainder + binstring
+    def _set_generator(self):
+        """
+        generator polynomial (x - 2^0)...(x - 2^(check_bytes-1)) and its roots, the same as reedsolo
+        """
+        self._roots = gf_exp[:self.check_bytes].astype(np.uint8)
+        generator = np.ones(1, dtype=np.uint8)
+        for root in self._roots:
+            res = np.zeros(len(generator)+1, dtype=np.uint8)
+            res[:-1] = generator
+            res[1:] ^= gf_mul[generator, root]
+            generator = res
+        self._generator = generator
+
+    def _get_parity(self, chunk):
+        """
+        rs code of every row of a 2-D uint8 array, the remainder of the division by the generator polynomial
+        """
+        parity = np.zeros((len(chunk), self.check_bytes), dtype=np.uint8)
+        for column in chunk.T:
+            coef = column ^ parity[:, 0] if self.check_bytes>0 else column
+            parity[:, :-1] = parity[:, 1:]
+            parity[:, -1:] = 0
+            parity ^= gf_mul[coef[:, None], self._generator[None, 1:]]
+        return parity
+
+    def _get_syndromes(self, chunk):
+        """
+        values of every row(a codeword) at the roots of the generator polynomial, all 0 for a clean codeword
+        """
+        syndromes = np.zeros((len(chunk), self.check_bytes), dtype=np.uint8)
+        for column in chunk.T:
+            syndromes = gf_mul[syndromes, self._roots[None, :]] ^ column[:, None]
+        return syndromes
+
+    def encode_matrix(self, data, group=1):
+        """
+        add rs code to every row of a 2-D uint8 array(packed segments of the same length) at once,
+        the output is the same as insert_bytes for every row
+        """
+        blocks = []
+        data_len = self.tool.nsize - self.check_bytes # reedsolo codes long data in chunks
+        for group_slice in self._get_groups(data.shape[1], group):
+            group_data = data[:, group_slice]
+            for start in range(0, group_data.shape[1], data_len):
+                chunk = group_data[:, start:start+data_len]
+                blocks += [chunk, self._get_parity(chunk)]
+        return np.concatenate(blocks, axis=1) if len(blocks)>0 else data[:, :0]
 
-        output_string = ''
+    def decode_matrix(self, codewords, group=1, erasures=None):
+        """
+        check and remove rs code of every row of a 2-D uint8 array at once.
+        The syndromes of all rows are computed first, and only rows with errors are corrected(by reedsolo).
+        @param erasures: bool array with the shape of codewords, known wrong bytes, or None
+        @return: decoded 2-D uint8 array, bool array of the rows decoded
+        """
+        blocks = []
+        has_error = np.zeros(len(codewords), dtype=bool) if erasures is None else erasures.any(axis=1)
+        for group_slice in self._get_groups(codewords.shape[1], group, self.check_bytes):
+            group_code = codewords[:, group_slice]
+            for start in range(0, group_code.shape[1], self.tool.nsize):
+                chunk = group_code[:, start:start+self.tool.nsize]
+                if chunk.shape[1] <= self.check_bytes:
+                    has_error[:] = True
+                    continue
+                has_error |= self._get_syndromes(chunk).any(axis=1)
+                blocks.append(chunk[:, :chunk.shape[1]-self.check_bytes])
+        data = np.concatenate(blocks, axis=1) if len(blocks)>0 else codewords[:, :0].copy()
+        is_succeed = np.ones(len(codewords), dtype=bool)
+        for row in np.nonzero(has_error)[0]:
+            erase_pos = [] if erasures is None else np.nonzero(erasures[row])[0].tolist()
+            decoded = self._correct_bytes(codewords[row], group=group, erase_pos=erase_pos)
+            if decoded is None or len(decoded)!=data.shape[1]:
+                is_succeed[row] = False
+            else:
+                data[row] = np.frombuffer(decoded, dtype=np.uint8)
+        self.clean_num += len(codewords) - np.count_nonzero(has_error)
+        self.corrected_num += np.count_nonzero(has_error & is_succeed)
+        self.failed_num += np.count_nonzero(~is_succeed)
+        return data, is_succeed
+
+    def _get_groups(self, byte_len, group, check_bytes=0):
+        """
+        slices of the groups in a byte string, every group is coded separately
+        """
         if group>=1 and type(group)==int:
-            if group<=len(binstring)/8/255:
+            data_len = byte_len - group*check_bytes
+            if group<=data_len/255:
                 group = 1
-            group_len = math.ceil(len(binstring)/8/group)*8
+            group_len = math.ceil(data_len/group) + check_bytes
+            slices = []
             for i in range(group):
                 last = group_len*(i+1)
-                if last>=len(binstring): last = None
-                group_string = binstring[group_len*i:last]
-                byte_list = bytearray([int(group_string[i:i + 8], 2) for i in range(0, len(group_string), 8)])
-                rs_list = self.tool.encode(byte_list)
-                str_list = [bin_to_str_list[i] for i in rs_list]
-                output_string += ''.join(str_list)
+                if last >= byte_len: last = None
+                slices.append(slice(group_len*i, last))
+            return slices
         else:
             raise Exception("Wrong rs group")
+
+    def insert_bytes(self, byte_list, group=1):
+        """
+        add rs code to a byte string(a packed segment)
+        """
+        output = bytearray()
+        for group_slice in self._get_groups(len(byte_list), group):
+            output += self.tool.encode(bytearray(byte_list[group_slice]))
+        return output
+
+    def remove_bytes(self, byte_list, group=1):
+        """
+        check and remove rs code of a byte string(a packed segment), a clean one is not corrected
+        @return: decoded bytes, None if irreparable
+        """
+        data, is_succeed = self.decode_matrix(np.frombuffer(bytes(byte_list), dtype=np.uint8)[None], group=group)
+        return bytearray(data[0].tobytes()) if is_succeed[0] else None
+
+    def _correct_bytes(self, byte_list, group=1, erase_pos=()):
+        """
+        correct and remove rs code of a byte string by reedsolo
+        @param erase_pos: positions of known wrong bytes
+        @return: decoded bytes, None if irreparable
+        """
+        output = bytearray()
+        for group_slice in self._get_groups(len(byte_list), group, self.check_bytes):
+            start, stop = group_slice.indices(len(byte_list))[:2]
+            group_erase_pos = [x - start for x in erase_pos if start <= x < stop]
+            try:
+                decode_byte_list, full_list, err_pos = self.tool.decode(bytearray(byte_list[group_slice]),
+                                                                        erase_pos=group_erase_pos or None)
+                output += decode_byte_list
+            except ReedSolomonError:
+                # Irreparable
+                return None
+            except IndexError:
+                # No data acquisition
+                return None
+        return output
+
+    def insert_one(self, binstring, group=1):
+        # If the binary length is not a multiple of 8, it will be left-padded with zeros
+        self.remainder = 0
+        if len(binstring)%8!=0:
+            self.remainder = 8 - len(binstring) % 8
+            binstring = '0'*self.remainder + binstring
+
+        byte_list = bytearray([int(binstring[i:i + 8], 2) for i in range(0, len(binstring), 8)])
+        rs_list = self.insert_bytes(byte_list, group=group)
+        output_string = ''.join([bin_to_str_list[i] for i in rs_list])
         return output_string[self.remainder:]
     
     
@@ -53,32 +208,12 @@ class ReedSolomon():
             self.remainder = 8 - len(binstring) % 8
             binstring = '0'*self.remainder + binstring
 
-        data_len = len(binstring) - group*self.check_bytes*8
-        output_string = ""
-        if group>=1 and type(group)==int:
-            if group<=data_len/8/255:
-                group = 1
-            group_len = math.ceil(data_len/8/group)*8 + self.check_bytes*8
-            for i in range(group):
-                last = group_len*(i+1)
-                if last >= len(binstring): last = None
-                group_string = binstring[i*group_len:last]
-                byte_list = bytearray([int(group_string[i:i + 8], 2) for i in range(0, len(group_string), 8)])
-                try:
-                    decode_byte_list, full_list, err_pos = self.tool.decode(byte_list)
-                    if len(err_pos)!=0:
-                        print(err_pos)
-                    str_list = [bin_to_str_list[i] for i in decode_byte_list]
-                    output_string += ''.join(str_list)
-                except ReedSolomonError:
-                    # Irreparable
-                    return {"data": binstring, "type": False}
-                except IndexError:
-                    # No data acquisition
-                    return {"data": binstring, "type": False}
-            return {"data": output_string, "type": True}
-        else:
-            raise Exception("Wrong rs group")
+        byte_list = bytearray([int(binstring[i:i + 8], 2) for i in range(0, len(binstring), 8)])
+        decode_byte_list = self.remove_bytes(byte_list, group=group)
+        if decode_byte_list is None:
+            return {"data": binstring, "type": False}
+        output_string = ''.join([bin_to_str_list[i] for i in decode_byte_list])
+        return {"data": output_string, "type": True}
     
     
     def insert(self, segment_list, group=1):
@@ -86,6 +221,10 @@ class ReedSolomon():
         res_list = list()
         if len(segment_list)==0:
             raise ValueError("Empty data.")
+        # Insert rs codes into packed sequences, padding bits are kept at the head
+        if isinstance(segment_list, BitSegments):
+            res_packed = self.encode_matrix(segment_list.packed, group=group)
+            return BitSegments(res_packed, res_packed.shape[1]*8 - segment_list.pad)
         # Insert rs codes into multiple sequences
         if type(segment_list)==list and type(segment_list[0]==str):
             pro_bar = tqdm(total=len(segment_list), desc="Add RSCode")
@@ -103,6 +242,8 @@ class ReedSolomon():
         log.debug('Check and  remove rs code.')
         if len(segment_list)==0:
             raise ValueError("Empty data.")
+        if isinstance(segment_list, BitSegments):
+            return self._remove_packed(segment_list, oriLen, group)
         bit_segments = []
         error_bit_segments = []
         error_indices = []
@@ -129,3 +270,144 @@ class ReedSolomon():
         else:
             raise ValueError("Input error")
         return {"bit": bit_segments, "e_r": error_rate, "e_i": error_indices, "e_bit": error_bit_segments}
+
+    def _remove_packed(self, segment_list, oriLen, group=1):
+        """
+        remove rs code of BitSegments, the decoded segments keep the last oriLen bits
+        """
+        ori_bytes = math.ceil(oriLen/8)
+        data, is_succeed = self.decode_matrix(segment_list.packed, group=group, erasures=segment_list.erasures)
+        if data.shape[1]*8 < oriLen:
+            data, is_succeed = np.zeros((len(data), ori_bytes), dtype=np.uint8), np.zeros(len(data), dtype=bool)
+        res_packed = data[:, data.shape[1] - ori_bytes:].copy()
+        res_packed[:, 0] &= 0xff >> (-oriLen % 8) # clear padding bits
+        error_indices = np.nonzero(~is_succeed)[0].tolist()
+        return {"bit": BitSegments(res_packed[is_succeed], oriLen), "e_r": len(error_indices)/len(segment_list),
+                "e_i": error_indices, "e_bit": segment_list.take(error_indices)}
+
+
+def _gf_inverse_matrix(matrix):
+    """
+    inverse of a square matrix over GF(256) by Gauss-Jordan elimination
+    """
+    size = len(matrix)
+    work = np.concatenate((np.asarray(matrix, dtype=np.uint8), np.eye(size, dtype=np.uint8)), axis=1)
+    for col in range(size):
+        pivot = col + int(np.nonzero(work[col:, col])[0][0])
+        work[[col, pivot]] = work[[pivot, col]]
+        work[col] = gf_mul[gf_exp[255 - gf_log[work[col, col]]], work[col]]
+        for row in range(size):
+            if row!=col and work[row, col]!=0:
+                work[row] ^= gf_mul[work[row, col], work[col]]
+    return work[:, size:]
+
+
+class OuterCode():
+    def __init__(self, data_num=2, parity_num=1, legacy=False):
+        """
+        Erasure code across segments: every group of data_num data segments is followed by parity_num parity segments,
+        byte j of the parity segments is the rs code of byte j of the data segments(the same code as ReedSolomon),
+        so any parity_num missing segments of a group can be rebuilt.
+        The number of data segments is rounded up to whole groups, and every segment carries a whole number of bytes.
+        legacy is the XOR redundancy(add_redundancy=True): 2 data segments and 1 parity segment(their XOR),
+        segments of any length, and the last data segment has no parity segment when the number is odd.
+        """
+        if data_num<1 or parity_num<1 or data_num+parity_num>255:
+            raise ValueError("Wrong outer code: {} data and {} parity segments".format(data_num, parity_num))
+        self.data_num = data_num
+        self.parity_num = parity_num
+        self.legacy = legacy
+        self.group_len = data_num + parity_num
+        self.tool = ReedSolomon(parity_num)
+
+    @staticmethod
+    def get(redundancy):
+        """
+        @param redundancy: False/True(the XOR redundancy), (data_num, parity_num), OuterCode,
+            or its value in the parameter line("0", "1" or "data_num-parity_num")
+        @return: OuterCode, None for no redundancy
+        """
+        if isinstance(redundancy, OuterCode) or redundancy is None:
+            return redundancy
+        if isinstance(redundancy, str):
+            redundancy = tuple(int(x) for x in redundancy.split('-')) if '-' in redundancy else bool(int(redundancy))
+        if isinstance(redundancy, (tuple, list)):
+            return _get_outer_code(int(redundancy[0]), int(redundancy[1]), False)
+        return _get_outer_code(2, 1, True) if redundancy else None
+
+    @staticmethod
+    def to_param(code):
+        """
+        value in the parameter line
+        """
+        if code is None:
+            return "0"
+        return "1" if code.legacy else "{}-{}".format(code.data_num, code.parity_num)
+
+    def get_chunk_len(self, bin_seg_len):
+        """
+        file bits in a data segment of bin_seg_len bits, the rest bits are zero
+        """
+        return bin_seg_len if self.legacy else bin_seg_len - bin_seg_len%8
+
+    def get_segment_num(self, data_seg_num):
+        if self.legacy:
+            return data_seg_num + data_seg_num//self.data_num*self.parity_num
+        return math.ceil(data_seg_num/self.data_num) * self.group_len
+
+    def get_block_unit(self):
+        """
+        blocks of a multiple of this rows hold whole groups and start at byte boundaries of the file
+        """
+        return 24 if self.legacy else 8*self.group_len
+
+    def get_data_id(self, row):
+        """
+        the number of data segments before the segment with index row
+        """
+        return row//self.group_len*self.data_num + np.minimum(row%self.group_len, self.data_num)
+
+    def is_data(self, row):
+        return row%self.group_len < self.data_num
+
+    def encode(self, data):
+        """
+        parity segments of whole groups
+        @param data: packed data segments, 2-D uint8 array, rows of whole groups
+        @return: packed parity segments, 2-D uint8 array
+        """
+        group_num = len(data)//self.data_num
+        # one codeword per group and byte column
+        columns = data[:group_num*self.data_num].reshape(group_num, self.data_num, data.shape[1]).transpose(0, 2, 1)
+        parity = self.tool._get_parity(columns.reshape(-1, self.data_num))
+        return parity.reshape(group_num, -1, self.parity_num).transpose(0, 2, 1).reshape(-1, data.shape[1])
+
+    def repair_group(self, rows, exist):
+        """
+        rebuild missing segments of a group in place
+        @param rows: packed segments of the group, 2-D uint8 array of group_len rows
+        @param exist: bool array, False for the missing rows(their values are ignored)
+        @return: True if all the missing rows are rebuilt
+        """
+        missing = np.nonzero(~np.asarray(exist, dtype=bool))[0]
+        if len(missing)==0:
+            return True
+        if len(missing)>self.parity_num:
+            return False
+        rows[missing] = 0
+        # syndromes of the known part: sum of missing values * 2^(j*(group_len-1-position)) for every root 2^j
+        syndromes = self.tool._get_syndromes(rows.T)[:, :len(missing)]
+        positions = self.group_len - 1 - missing
+        vandermonde = gf_exp[np.arange(len(missing))[:, None]*positions[None, :] % 255]
+        inverse = _gf_inverse_matrix(vandermonde)
+        for t, row in enumerate(missing):
+            value = np.zeros(rows.shape[1], dtype=np.uint8)
+            for j in range(len(missing)):
+                value ^= gf_mul[inverse[t, j], syndromes[:, j]]
+            rows[row] = value
+        return True
+
+
+@lru_cache(maxsize=16)
+def _get_outer_code(data_num, parity_num, legacy):
+    return OuterCode(data_num, parity_num, legacy)
@@ -5,13 +5,15 @@ Created on Thu Apr 29 15:53:37 2021
 
 @author: cathy
 """
-from os import path,popen,mkdir
+from os import path,popen,mkdir,cpu_count
 sCurrentFilePath = path.dirname(path.abspath(__file__)) + '/'
 
 import random
 import primer3
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from traceback import format_exc
+from contextlib import closing
 import pandas as pd
 
 from StorageD import primer3Setting
@@ -39,7 +41,8 @@ def getTimeStr():
 
 class PrimerDesign:
     def __init__(self, lTemplateFasta, iPrimerLen=20, iPrimer3PairNum=5, iRandTempNumInCycle=5,
-                 iRandTempLen=200, iBreakNum=5, iBreakSec=180, sBaseDir = sCurrentFilePath, bTimeTempName = True, bLenStrict=True):
+                 iRandTempLen=200, iBreakNum=5, iBreakSec=180, sBaseDir = sCurrentFilePath, bTimeTempName = True, bLenStrict=True,
+                 lTemplateSeq=None, iWorkers=None):
         """
         PrimerDesign Class
         @param lTemplateFasta: path list of the template files
@@ -53,6 +56,8 @@ class PrimerDesign:
         @param sBaseDir:
         @param bTimeTempName: whether to name temp files with a timestamp
         @param bLenStrict: Whether the primer length is strictly limited
+        @param lTemplateSeq: template sequences in memory(e.g. the encoded segments or a sample of them), used instead of lTemplateFasta
+        @param iWorkers: number of worker processes running primer3, None for the number of CPUs, 1 to design in this process
         """
         '''
         PrimerDesign Class
@@ -77,12 +82,14 @@ class PrimerDesign:
             
         self._bLenStrict = bLenStrict
         self._lTemplateFasta = lTemplateFasta
+        self._lTemplateSeq = lTemplateSeq
         self._iPrimerLen = iPrimerLen
         self._iPrimer3PairNum = iPrimer3PairNum
         self._iRandTempNumInCycle = iRandTempNumInCycle
         self._iRandTempLen = iRandTempLen
         self._iBreakNum = iBreakNum
         self._iBreakSec = iBreakSec
+        self._iWorkers = iWorkers if iWorkers is not None else (cpu_count() or 1)
         self._basePath = sBaseDir
 
         self._sAllTemplateFastFile = sBaseDir + self._tempFileName + '_allTemplate.fasta'  # Processed template fasta file
@@ -126,11 +133,16 @@ class PrimerDesign:
         :return:
         '''
         try:
-            # Splice all template fasta files
-            getAllTemplateFasta(self._lTemplateFasta,
-                                self._sAllTemplateFastFile)
-            # get the quaternary sequence
-            self._lTemplateAll = getQuaStr(self._sAllTemplateFastFile)
+            if self._lTemplateSeq is not None:
+                # write the templates in memory for blast
+                writeTemplateFasta(self._lTemplateSeq, self._sAllTemplateFastFile)
+                self._lTemplateAll = [seqToQua(sSeq) for sSeq in self._lTemplateSeq]
+            else:
+                # Splice all template fasta files
+                getAllTemplateFasta(self._lTemplateFasta,
+                                    self._sAllTemplateFastFile)
+                # get the quaternary sequence
+                self._lTemplateAll = getQuaStr(self._sAllTemplateFastFile)
             # Get the 5' 6 base and 3' reverse complementary six bases of the template sequence
             self._setTemp6 = self._getTemplate6()
             # use blast to generate template library
@@ -165,35 +177,34 @@ class PrimerDesign:
             self._lPrimerPair = list()
             tm = datetime.now()
             cycle = 0
-            while(1):
-                cycle += 1
-
-                # Each cycle uses 5 random sequences, each generating up to 10 pairs of primers, for a total of 50 pairs
-                lTempPrimerPairTemp = getPrimerPair(
-                    iRandTempNumInCycle, iRandTempLen, self._iPrimerLen, iPrimer3PairNum)
-
-                # Check primer length
-                if self._bLenStrict:
-                    log.debug("check length")
-                    lTempPrimerPair = list()
-                    for (lPrimer,rPrimer) in  lTempPrimerPairTemp:
-                        if len(lPrimer)==self._iPrimerLen and len(rPrimer)==self._iPrimerLen:
-                            lTempPrimerPair.append((lPrimer,rPrimer))
-                else:
-                    lTempPrimerPair = lTempPrimerPairTemp
-                # Check primer 3' six bases
-                self._lPrimerPair += getPrimerPairList(
-                    lTempPrimerPair, self._setTemp6)
-
-                iSec = (datetime.now() - tm).seconds
-                log.info('In the {} cycle, {} pairs of primers have been obtained, and it has taken {}s'.format(
-                    cycle, len(self._lPrimerPair), iSec))
-                if len(self._lPrimerPair) >= iBreakNum or iSec >= iBreakSec:
-                    # Use the last set of results to fill when there are no design results
-                    if len(self._lPrimerPair) == 0:
-                        self._lPrimerPair += lTempPrimerPair
-                        self._succeed = False
-                    break
+            # Each cycle uses 5 random sequences, each generating up to 10 pairs of primers, for a total of 50 pairs
+            # closed however the loop ends, so the queued cycles are cancelled and the running ones waited for
+            with closing(self._iterPrimerPair(iRandTempNumInCycle, iRandTempLen, iPrimer3PairNum)) as iterPrimerPair:
+                for lTempPrimerPairTemp in iterPrimerPair:
+                    cycle += 1
+
+                    # Check primer length
+                    if self._bLenStrict:
+                        log.debug("check length")
+                        lTempPrimerPair = list()
+                        for (lPrimer,rPrimer) in  lTempPrimerPairTemp:
+                            if len(lPrimer)==self._iPrimerLen and len(rPrimer)==self._iPrimerLen:
+                                lTempPrimerPair.append((lPrimer,rPrimer))
+                    else:
+                        lTempPrimerPair = lTempPrimerPairTemp
+                    # Check primer 3' six bases
+                    self._lPrimerPair += getPrimerPairList(
+                        lTempPrimerPair, self._setTemp6)
+
+                    iSec = (datetime.now() - tm).seconds
+                    log.info('In the {} cycle, {} pairs of primers have been obtained, and it has taken {}s'.format(
+                        cycle, len(self._lPrimerPair), iSec))
+                    if len(self._lPrimerPair) >= iBreakNum or iSec >= iBreakSec:
+                        # Use the last set of results to fill when there are no design results
+                        if len(self._lPrimerPair) == 0:
+                            self._lPrimerPair += lTempPrimerPair
+                            self._succeed = False
+                        break
 
             if len(self._lPrimerPair) == 0:
                 log.error("No primer")
@@ -203,6 +214,28 @@ class PrimerDesign:
             log.error("primerDesign failed : {}".format(e) + str(format_exc()))
             raise
 
+    def _iterPrimerPair(self, iRandTempNumInCycle, iRandTempLen, iPrimer3PairNum):
+        '''
+        Primer pairs of every cycle(see getPrimerPair), in the order the cycles finish.
+        With several workers, every cycle runs in a worker process with its own random seed and primer3 settings,
+        2 cycles per worker are kept queued. When the generator is closed, the queued cycles are cancelled
+        and the running ones are waited for, so no worker outlives the design.
+        '''
+        lArgs = [iRandTempNumInCycle, iRandTempLen, self._iPrimerLen, iPrimer3PairNum]
+        if self._iWorkers <= 1:
+            while True:
+                yield getPrimerPair(*lArgs)
+        executor = ProcessPoolExecutor(max_workers=self._iWorkers)
+        try:
+            setFuture = {executor.submit(getPrimerPair, *lArgs, random.getrandbits(64)) for _ in range(2*self._iWorkers)}
+            while True:
+                setDone, setFuture = wait(setFuture, return_when=FIRST_COMPLETED)
+                for future in setDone:
+                    setFuture.add(executor.submit(getPrimerPair, *lArgs, random.getrandbits(64)))
+                    yield future.result()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
     def _getPrimerFasta(self):
         '''
         Generate primer fasta files for blast alignment
@@ -277,25 +310,24 @@ class PrimerDesign:
 # general function
 ##############################################################################
 
-def getPrimerPair(iRandomSeqNum=50, iRandomSeqLen=200, iPrimerLen=20, iPrimer3PairNum=5):
+def getPrimerPair(iRandomSeqNum=50, iRandomSeqLen=200, iPrimerLen=20, iPrimer3PairNum=5, iSeed=None):
     '''
     Design primer pairs using primer3
     @param iRandomSeqNum: Number of random sequences used to generate primers
     @param iPrimer3Num: Number of primer pairs generated using primer3 per random sequence
+    @param iSeed: seed of the random sequences, None for the random module
     @return: List of primer pairs
     '''
     lPrimerPair = list()
     tm = datetime.now()
-    lTemplate = getRandomSeq(iRandomSeqNum, iRandomSeqLen)
-    primer3Setting.setMaxNumber(iPrimer3PairNum)
-    primer3Setting.setPrimerLen(iPrimerLen)
+    lTemplate = getRandomSeq(iRandomSeqNum, iRandomSeqLen, random if iSeed is None else random.Random(iSeed))
+    dSeqArgs, dGlobalArgs = primer3Setting.getArgs(iPrimer3PairNum, iPrimerLen)
 
     for index,sTemplateSeq in enumerate(lTemplate):
         log.debug("{}, {}, {}\n".format(iPrimerLen,index,sTemplateSeq))
-        primer3Setting.setTemplateSeq(sTemplateSeq)
+        dSeqArgs['SEQUENCE_TEMPLATE'] = sTemplateSeq
         # primer3 output result
-        result = primer3.bindings.designPrimers(
-            primer3Setting.seq_args, primer3Setting.global_args)
+        result = primer3.bindings.designPrimers(dSeqArgs, dGlobalArgs)
         # The number of primer pairs generated by primer3
         iPairNum = result['PRIMER_PAIR_NUM_RETURNED']
 
@@ -330,18 +362,19 @@ def check3End(sSeq, iLen=8):
 
 
 # get random dna/rna sequence
-def getRandomSeq(iNumberOfSeq, iRandLen):
+def getRandomSeq(iNumberOfSeq, iRandLen, rng=random):
     '''
     get random sequence
     @param iNumberOfSeq: number of sequences
     @param iRandLen: sequence length
+    @param rng: random module or a random.Random
     @return list of random sequences
     '''
     lList = list()
     for iNum in range(iNumberOfSeq):
         each_Seq = ""
         for k in range(iRandLen - 1):
-            iBaseNum = random.randint(0, 3)
+            iBaseNum = rng.randint(0, 3)
             each_Seq += dNumBase[str(iBaseNum)]
         lList.append(each_Seq)
     return lList
@@ -370,6 +403,16 @@ def getAllTemplateFasta(lFile, sOutputFile):
         f.writelines(lAll)
 
 
+def writeTemplateFasta(lSeq, sOutputFile):
+    """
+    Write template sequences as the merged fasta file
+    @param lSeq: list of base sequences
+    @param sOutputFile: Merged fasta file
+    """
+    with open(sOutputFile, 'w') as f:
+        f.writelines('>join{}\n{}\n'.format(index + 1, sSeq) for index, sSeq in enumerate(lSeq))
+
+
 def getOther(sSeq):
     '''
     Get the reverse complement
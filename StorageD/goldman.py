@@ -6,7 +6,7 @@ Created on Thu Aug  5 10:37:21 2021
 """
 
 import sys, os, argparse
-from tqdm import tqdm
+import numpy as np
 
 
 
@@ -94,88 +94,132 @@ def transHuffman(bin_num):
 
 
 
-def readAsBin(read_file_path):
-    f_path = read_file_path
-    bin_str = ""
-    tmp_list = []
-    with open(f_path, "rb") as f:
-        for _line in f:
-            for _bytes in _line:
-                tmp_list.append(_bytes)
-                _bin_str = bin(_bytes)[2:]
-                _bin_str = "0"*(8-len(_bin_str)) + _bin_str
-                bin_str += _bin_str
-    # print(tmp_list)
-    return bin_str
+# ternary code of every byte(5 trits, or 6 trits from "222" for bytes over 235), padded to 6 trits in trit_table
+ternary_codes = [transHuffman(format(byte, '08b')) for byte in range(256)]
+trit_table = np.zeros((256, 6), dtype=np.uint8)
+trit_mask = np.zeros((256, 6), dtype=bool)
+for _byte, _code in enumerate(ternary_codes):
+    trit_table[_byte, :len(_code)] = [int(x) for x in _code]
+    trit_mask[_byte, :len(_code)] = True
+# rotate_codes_dic as numbers of 'ACGT': the base of trit t after base b is (b+t+1)%4,
+# so the base at every position is the sum of (trit+1) from the start(after "A") modulo 4
+nt_table = np.frombuffer(b'ACGT', dtype=np.uint8)
+# 6 trits of every byte value for the bytes of rscode, which are not Huffman coded
+rs_trit_table = (np.arange(256)[:, None] // 3 ** np.arange(5, -1, -1) % 3).astype(np.uint8)
 
-def transTernaryNum(bin_str):
-    ternary_str = ""
-    for i in range(0, len(bin_str), 8):
-        _bin_str = bin_str[i: i+8]
-        _terary_num = transHuffman(_bin_str)
 
-        ternary_str += _terary_num
+def readAsBin(read_file_path):
+    bits = np.unpackbits(np.fromfile(read_file_path, dtype=np.uint8))
+    return (bits + ord('0')).tobytes().decode()
+
+def bytesToTernary(data, block_size=1<<20):
+    """
+    bytes(bytes, uint8 array or memmap) >> 1-D uint8 array of the trits of their ternary codes
+    """
+    data = np.frombuffer(data, dtype=np.uint8) if isinstance(data, (bytes, bytearray)) else np.asarray(data, dtype=np.uint8)
+    trit_blocks = [trit_table[data[i:i+block_size]][trit_mask[data[i:i+block_size]]] for i in range(0, len(data), block_size)]
+    return np.concatenate(trit_blocks) if len(trit_blocks)>0 else np.zeros(0, dtype=np.uint8)
+
+def getTritNum(read_file_path, block_size=1<<24):
+    """
+    number of trits of the ternary codes of a file, 5 for every byte and 6 for the bytes over 235
+    """
+    data = np.memmap(read_file_path, dtype=np.uint8, mode='r') if os.path.getsize(read_file_path)>0 else np.zeros(0, dtype=np.uint8)
+    return 5*len(data) + sum(int(np.count_nonzero(data[i:i+block_size] > 235)) for i in range(0, len(data), block_size))
 
-    return ternary_str
+def transTernaryNum(bin_str):
+    data = np.packbits(np.frombuffer(bin_str.encode(), dtype=np.uint8) - ord('0'))
+    return (bytesToTernary(data) + ord('0')).tobytes().decode()
+
+def encodeNtArray(trit_segments):
+    """
+    2-D array of trits(a segment per row) >> 2-D uint8 array of base ascii codes, every row from "A"
+    """
+    return nt_table[np.cumsum(np.asarray(trit_segments, dtype=np.uint8) + 1, axis=1, dtype=np.uint8) % 4]
+
+def encodeNtList(trit_segments):
+    """
+    2-D array of trits >> list of DNA sequences
+    """
+    bases = encodeNtArray(trit_segments)
+    text = bases.tobytes().decode()
+    row_len = bases.shape[1]
+    return [text[i:i+row_len] for i in range(0, len(text), row_len)]
 
 def encodeNt(ternary_str):
-    last_nt="A"
-    rotate_codes_dic = {'A': ['C', 'G', 'T'], 'C': ['G', 'T', 'A'], 'G': ['T', 'A', 'C'], 'T': ['A', 'C', 'G']}
-
-    nt_seq = ""
-    for _terary_num in ternary_str:
-        _nt = rotate_codes_dic[last_nt][int(_terary_num)]
-        nt_seq += _nt
-        last_nt = _nt
-
-    return nt_seq
-
-
-def segment(ternary_str, ideal_len = 100):
-    total_len = len(ternary_str)
-
+    trits = np.frombuffer(ternary_str.encode(), dtype=np.uint8) - ord('0')
+    return encodeNtArray(trits.reshape(1, -1)).tobytes().decode()
+
+
+def getOverlapPlan(total_len, ideal_len):
+    """
+    plan of overlapping segments(Goldman): a segment of seg_len trits(a multiple of 4) starts every seg_len/4 trits,
+    so every trit is in 4 segments, and a ternary index fills the rest of ideal_len.
+    The last segment is filled with zeros, or dropped if the one before ends with the trits(3/4 of a segment left).
+    @param total_len: number of trits of the file
+    @return: segment length(trits of data), index length, number of segments, number of zeros filled
+    """
     n = 0
     while True:
         seg_len = int(ideal_len//4*4-4*n)
+        if seg_len <= 0:
+            raise ValueError("Too few trits({}) for segments of length {}".format(total_len, ideal_len))
         if total_len%seg_len == 0:
-            seg_num = int(total_len//(seg_len/4)-3)
-        else:
-            seg_num = int(total_len//(seg_len/4)-2)
-
-        idnex_len = len(transSystem(seg_num, 3))
-        if idnex_len > (ideal_len-seg_len):
-            n += 1
+            num = int(total_len//(seg_len/4)-3)
         else:
+            num = int(total_len//(seg_len/4)-2)
+        if num < 0:
+            raise ValueError("Too few trits({}) for segments of length {}".format(total_len, ideal_len))
+        index_len = 1
+        while 3**index_len <= num:
+            index_len += 1
+        if index_len <= ideal_len-seg_len:
             break
-    
+        n += 1
+    step = seg_len // 4
+    # the first segment shorter than seg_len
+    last = (total_len - seg_len)//step + 1 if total_len >= seg_len else 0
+    rest = total_len - last*step
+    if rest == 3*step:
+        return seg_len, index_len, last, 0
+    return seg_len, index_len, last + 1, seg_len - rest
+
+def splitOverlap(trits, first_seg, seg_num, seg_len, index_len):
+    """
+    overlapping segments(ternary index + data) from first_seg, see getOverlapPlan
+    @param trits: 1-D uint8 array of the trits from first_seg*seg_len/4, filled with zeros to the last segment
+    @return: 2-D uint8 array of trits, a segment per row
+    """
+    step = seg_len // 4
+    padded = np.zeros(max(len(trits), (seg_num - 1)*step + seg_len), dtype=np.uint8)
+    padded[:len(trits)] = trits
+    # views of the trits, only the segments are copied
+    windows = np.lib.stride_tricks.sliding_window_view(padded, seg_len)[::step][:seg_num]
+    indexes = (first_seg + np.arange(seg_num))[:, None] // (3 ** np.arange(index_len - 1, -1, -1)) % 3
+    return np.concatenate((indexes.astype(np.uint8), windows), axis=1)
+
+def getSegmentPlan(total_len, ideal_len = 100):
+    """
+    @return: segment length(trits of data), index length
+    """
+    seg_len, idnex_len, _, _ = getOverlapPlan(total_len, ideal_len)
+    return seg_len, idnex_len
+
+def segmentArray(trits, ideal_len = 100):
+    """
+    overlapping segments of the trits, see getOverlapPlan
+    @return: 2-D uint8 array of segments(ternary index + data), index length, number of zeros filled
+    """
+    seg_len, idnex_len, seg_num, add_len = getOverlapPlan(len(trits), ideal_len)
+    return splitOverlap(trits, 0, seg_num, seg_len, idnex_len), idnex_len, add_len
 
-    ternary_seg_list = []
-    step = int(seg_len/4)
-    _index = 0
-    add_len = 0
-    for i in tqdm(range(0, len(ternary_str), step)):
-        tag = False
-        seg_seq = ternary_str[i: i+seg_len]
-
-        # no remiander nt
-        if len(seg_seq) == 3*step:
-            return ternary_seg_list, idnex_len, seg_len-len(seg_seq)
-        # remainder nt
-        elif len(seg_seq) < seg_len:
-            tag = True
-            add_len = seg_len-len(seg_seq)
-            seg_seq += "0"*add_len
-            # for _i in range(seg_len-len(seg_seq)):
-            #     seg_seq += list({"A", "T", "C", "G"}-set(seg_seq[-1]))[0]
-
-        _index_num = transSystem(_index, 3)
-        _index_num = "0"*(idnex_len-len(_index_num))+_index_num
-        ternary_seg = _index_num + seg_seq
-        ternary_seg_list.append(ternary_seg)
-
-        _index += 1
-        if tag == True:
-            return ternary_seg_list, idnex_len, add_len
+def segment(ternary_str, ideal_len = 100):
+    trits = np.frombuffer(ternary_str.encode(), dtype=np.uint8) - ord('0')
+    trit_segments, idnex_len, add_len = segmentArray(trits, ideal_len)
+    text = (trit_segments + ord('0')).tobytes().decode()
+    row_len = trit_segments.shape[1]
+    ternary_seg_list = [text[i:i+row_len] for i in range(0, len(text), row_len)]
+    return ternary_seg_list, idnex_len, add_len
 
 
 def outputResult(output_path, nt_seq_list):
@@ -186,20 +230,24 @@ def outputResult(output_path, nt_seq_list):
 
 
 def goldmanEncode(bin_str, ideal_len = 100):
-    ternary_str = transTernaryNum(bin_str)
-    # print("ternary_str", len(ternary_str)) #bkp
-    ternary_seg_list, idnex_len, add_len = segment(ternary_str, ideal_len=ideal_len)
-    nt_seq_list = []
-    for ternary_seg in tqdm(ternary_seg_list):
-        nt_seq = encodeNt(ternary_seg)
-        nt_seq_list.append(nt_seq)
+    """
+    @param bin_str: binary string, or bytes(bytes, uint8 array or memmap)
+    """
+    data = np.packbits(np.frombuffer(bin_str.encode(), dtype=np.uint8) - ord('0')) if isinstance(bin_str, str) else bin_str
+    trits = bytesToTernary(data)
+    trit_segments, idnex_len, add_len = segmentArray(trits, ideal_len=ideal_len)
+    nt_seq_list = encodeNtList(trit_segments)
+    row_len = trit_segments.shape[1]
+    ternary_str = (trits + ord('0')).tobytes().decode()
+    ternary_text = (trit_segments + ord('0')).tobytes().decode()
+    ternary_seg_list = [ternary_text[i:i+row_len] for i in range(0, len(ternary_text), row_len)]
 
     return nt_seq_list, idnex_len, add_len, ternary_seg_list, ternary_str
 
 
 def goldmanMain(read_file_path, output_path, ideal_len=100):
-    bin_str = readAsBin(read_file_path)
-    nt_seq_list, idnex_len, add_len, ternary_seg_list, ternary_str = goldmanEncode(bin_str, ideal_len=ideal_len)
+    data = np.fromfile(read_file_path, dtype=np.uint8)
+    nt_seq_list, idnex_len, add_len, ternary_seg_list, ternary_str = goldmanEncode(data, ideal_len=ideal_len)
     print(idnex_len, add_len)
     outputResult(output_path, nt_seq_list)
 
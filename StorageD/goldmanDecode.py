@@ -6,7 +6,10 @@ Created on Thu Aug  5 10:37:21 2021
 """
 
 import argparse
-from tqdm import tqdm
+import numpy as np
+from collections import Counter
+import logging
+log = logging.getLogger('mylog')
 
 def linuxCommand():
     parser = argparse.ArgumentParser()
@@ -19,84 +22,165 @@ def linuxCommand():
     return args.i, args.o, args.il, args.al
 
 
-def decodeNt(nt_seq):
-    rotate_codes_dic = {'A': ['C', 'G', 'T'], 'C': ['G', 'T', 'A'], 'G': ['T', 'A', 'C'], 'T': ['A', 'C', 'G']}
-    last_nt = "A"
-
-    huffman_str = ""
-    for nt in nt_seq:
-        choose_list = rotate_codes_dic[last_nt]
-        huffman_str += str(choose_list.index(nt))
-        last_nt = nt
+# base numbers of 'ACGT', 4 for invalid bases
+nt_to_num = np.full(256, 4, dtype=np.uint8)
+for _num, _nt in enumerate('ACGT'):
+    nt_to_num[ord(_nt)] = nt_to_num[ord(_nt.lower())] = _num
+# trit of base c after base b(rotate_codes_dic of the encoder), 255 if c repeats b
+trans_table = (np.arange(4)[None, :] - np.arange(4)[:, None] - 1) % 4
+trans_table[trans_table == 3] = 255
+trans_table = trans_table.astype(np.uint8)
+# the 5 trits from a position: the byte of a 5-trit code, or the 6-trit code "222xx?" for 236-242
+prefix_len = np.where(np.arange(243) > 235, 6, 5)
+
+
+def decodeNtArray(nt_list):
+    """
+    DNA sequences of the same length >> 2-D uint8 array of trits, every row from "A",
+    255 for the trits of invalid bases(e.g. N) and of repeated bases
+    """
+    seq_len = len(nt_list[0]) if len(nt_list)>0 else 0
+    nums = nt_to_num[np.frombuffer(''.join(nt_list).encode(), dtype=np.uint8)].reshape(len(nt_list), seq_len)
+    last_nums = np.zeros_like(nums)
+    last_nums[:, 1:] = nums[:, :-1]
+    trits = trans_table[last_nums & 3, nums & 3]
+    trits[(nums > 3) | (last_nums > 3)] = 255
+    return trits
 
-    return huffman_str
+def decodeNt(nt_seq):
+    trits = decodeNtArray([nt_seq])[0]
+    if (trits > 2).any():
+        raise ValueError("Invalid base at {}".format(int(np.argmax(trits > 2))))
+    return (trits + ord('0')).tobytes().decode()
+
+def getTernaryIndexes(trit_segments, index_len):
+    """
+    parse the ternary index at the head of every segment, 3**index_len for the indexes with unknown trits(>2)
+    """
+    index_trits = trit_segments[:, :index_len]
+    indexes = index_trits.astype(np.int64) @ (3 ** np.arange(index_len - 1, -1, -1, dtype=np.int64))
+    indexes[(index_trits > 2).any(axis=1)] = 3**index_len
+    return indexes
+
+def voteOverlap(votes, trit_segments, index_len):
+    """
+    add the votes of overlapping segments to votes(a count of 0, 1 and 2 for every trit, e.g. a memmap),
+    unknown trits do not vote and segments out of votes are dropped
+    @return: end of the trits voted, 0 if none
+    """
+    seg_len = trit_segments.shape[1] - index_len
+    step = seg_len // 4
+    indexes = getTernaryIndexes(trit_segments, index_len)
+    valid = indexes*step + seg_len <= len(votes)
+    if not valid.any():
+        return 0
+    data = trit_segments[valid, index_len:]
+    pos = indexes[valid, None]*step + np.arange(seg_len)
+    first, stop = int(pos.min()), int(pos.max()) + 1
+    known = data < 3
+    counts = np.bincount((3*(pos - first) + data)[known], minlength=3*(stop - first)).reshape(-1, 3)
+    max_count = np.iinfo(votes.dtype).max
+    votes[first:stop] = np.minimum(votes[first:stop] + counts, max_count)
+    return stop
+
+def getOverlapTrits(votes, start=0, stop=None):
+    """
+    trits [start, stop) taking the majority of their votes
+    """
+    block = votes[start:stop]
+    missing = np.count_nonzero(block.sum(axis=1) == 0)
+    if missing > 0:
+        log.warning("{} trit(s) not covered by any segment".format(missing))
+    return block.argmax(axis=1).astype(np.uint8)
+
+def mergeOverlap(trit_segments, index_len, add_len, seg_num=None):
+    """
+    trits of the segments(2-D array, 255 for unknown trits) >> 1-D uint8 array of the trits of the file.
+    Every trit is in up to 4 segments(and their copies), they vote and the trit takes the majority.
+    Segments with unknown index trits or indexes from seg_num are dropped.
+    @param seg_num: number of segments, None to take it from the largest index
+    """
+    seg_len = trit_segments.shape[1] - index_len
+    if seg_num is None:
+        indexes = getTernaryIndexes(trit_segments, index_len)
+        indexes = indexes[indexes < 3**index_len]
+        if len(indexes) == 0:
+            return np.zeros(0, dtype=np.uint8)
+        seg_num = int(indexes.max()) + 1
+    votes = np.zeros(((seg_num - 1)*(seg_len // 4) + seg_len, 3), dtype=np.int64)
+    voteOverlap(votes, trit_segments, index_len)
+    return getOverlapTrits(votes, 0, len(votes) - add_len)
+
+def combineTrits(trit_segments, idnex_len, add_len):
+    """
+    trits of the segments(2-D array, 255 for unknown trits) >> 1-D uint8 array of the trits of the file,
+    see mergeOverlap
+    """
+    return mergeOverlap(trit_segments, idnex_len, add_len)
 
 def combineHuffman(huffman_str_list, idnex_len, add_len):
-    index_huffman_dic = {i[:idnex_len]:i[idnex_len:] for i in huffman_str_list}
-    idnex_list = list(index_huffman_dic.keys())
-    idnex_list.sort()
-
-    info_huffman_list = [index_huffman_dic[i] for i in idnex_list]
-
-
-    total_huffman_str = info_huffman_list[0]
-    len_info = int(len(total_huffman_str)/4)
-    for info_huffman in tqdm(info_huffman_list[1:]):
-        total_huffman_str += info_huffman[-len_info:]
-
-    if add_len != 0:
-        total_huffman_str = total_huffman_str[:-add_len]
-
-    return total_huffman_str 
+    trits = np.frombuffer(''.join(huffman_str_list).encode(), dtype=np.uint8) - ord('0')
+    trits = combineTrits(trits.reshape(len(huffman_str_list), -1), idnex_len, add_len)
+    return (trits + ord('0')).tobytes().decode()
+
+def parseTrits(trits):
+    """
+    trits of 5/6-trit codes >> bytearray, end of the last whole code.
+    The code length at every position comes from the prefix table, and the positions of the codes
+    (the chain of position+length from 0) are found by doubling the jumps, all in array operations.
+    """
+    trit_num = len(trits)
+    if trit_num < 5:
+        return bytearray(), 0
+    padded = np.zeros(trit_num + 6, dtype=np.int64)
+    padded[:trit_num] = trits
+    prefix = sum(padded[i:i+trit_num] * 3**(4-i) for i in range(5))
+    code_len = prefix_len[prefix]
+    jump = np.append(np.minimum(np.arange(trit_num) + code_len, trit_num), trit_num) # trit_num: the end
+    is_code = np.zeros(trit_num + 1, dtype=bool)
+    is_code[0] = True
+    while jump[0] != trit_num:
+        is_code[jump[is_code]] = True
+        jump = jump[jump]
+    starts = np.nonzero(is_code[:trit_num])[0]
+    whole = starts + code_len[starts] <= trit_num
+    # only the last code may be cut
+    end = trit_num if whole.all() else int(starts[~whole][0])
+    starts = starts[whole]
+    byte_values = np.where(code_len[starts] == 5, prefix[starts], 3*prefix[starts] + padded[starts + 5] - 472)
+    return bytearray(byte_values.astype(np.uint8).tobytes()), end
+
+def tritsToBytes(trits):
+    """
+    trits of 5/6-trit codes >> bytearray, see parseTrits
+    """
+    return parseTrits(trits)[0]
+
+def rsTritsToBytes(rs_trits):
+    """
+    6 trits of every byte of rscode >> uint8 array, and a bool array marking the invalid ones
+    """
+    rs_trits = np.asarray(rs_trits).reshape(len(rs_trits), -1, 6)
+    values = rs_trits.astype(np.int64) @ (3 ** np.arange(5, -1, -1, dtype=np.int64))
+    invalid = (rs_trits > 2).any(axis=2) | (values > 255)
+    return np.where(invalid, 0, values).astype(np.uint8), invalid
 
 def huffmanToByte(total_huffman_str):
-    byte_list = []
-    start = 0
-    n=0
-    while True:
-        hufffman_code = total_huffman_str[start: start+5]
-        step = 5
-        if hufffman_code > "22201":
-            hufffman_code = total_huffman_str[start: start+6]
-            step = 6
-
-        if len(hufffman_code) <5:
-            break
-
-        start += step
-        decimal_num =int(hufffman_code, 3)
-        if step == 6:
-            decimal_num -= 472
-        byte_list.append(decimal_num)
-        # print(n, step)
-        # if n == 51:
-        #     print(hufffman_code, step, decimal_num)
-        #     break
-        n += 1
-    return byte_list
-        # _bin_str = bin(decimal_num)[2:]
-        # _bin_str = "0"*(8-len(_bin_str)) + _bin_str
-        # bin_str
+    trits = np.frombuffer(total_huffman_str.encode(), dtype=np.uint8) - ord('0')
+    return list(tritsToBytes(trits))
 
 def saveResult(byte_list, save_path):
-    # print(byte_list)
     with open(save_path, "wb") as f:
-        for i in byte_list:
-            f.write(bytes([i]))
+        f.write(bytes(byte_list))
 
 
 def goldmanDecode(nt_list, save_path, idnex_len, add_len):
-    huffman_str_list = []
-    for nt_seq in tqdm(nt_list):
-        huffman_str = decodeNt(nt_seq)
-        huffman_str_list.append(huffman_str)
-
-    total_huffman_str = combineHuffman(huffman_str_list, idnex_len, add_len)
-    # return total_huffman_str
-    byte_list = huffmanToByte(total_huffman_str)
-    # return byte_list
-    # print("byte_list", len(byte_list)) #bkp
-    saveResult(byte_list, save_path)
+    seq_len = Counter(len(x) for x in nt_list).most_common(1)[0][0] if len(nt_list)>0 else 0
+    seqs = [x for x in nt_list if len(x)==seq_len]
+    if len(seqs)!=len(nt_list):
+        log.warning("drop {} sequence(s) whose length is not {}".format(len(nt_list)-len(seqs), seq_len))
+    trits = combineTrits(decodeNtArray(seqs), idnex_len, add_len)
+    saveResult(tritsToBytes(trits), save_path)
     
 
 def readInput(input_path):
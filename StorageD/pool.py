@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+import struct
+import numpy as np
+import logging
+
+from StorageD.bits import BLOCK_ROWS
+from StorageD.tools import CodecException
+
+log = logging.getLogger('mylog')
+
+# base codes of the packed pool, 4 bases per byte from the high bits
+PACK_BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+base_to_code = np.full(256, 255, dtype=np.uint8)
+base_to_code[PACK_BASES] = np.arange(4)
+base_to_code[np.frombuffer(b'acgt', dtype=np.uint8)] = np.arange(4)
+# the 4 bases of every byte value
+byte_to_bases = PACK_BASES[(np.arange(256)[:, None] >> np.array([6, 4, 2, 0])) & 3]
+
+
+class PackedPool:
+    """
+    Binary pool file, 4 bases per byte:
+    magic | header length(uint32) | parameter line | number of sequences(uint64) | sequence length(uint32, 0 if they differ)
+    | position of the offset index(uint64, 0 if none) | sequences, each from a byte boundary | offset index
+    The offset index keeps the byte offset of every sequence(uint64, and the end) and its length(uint32),
+    it is always written for sequences of different lengths. The sequences are read through a memory map.
+    Integers are little-endian.
+    """
+    MAGIC = b'SDPOOL\x01\n'
+    FIELDS = struct.Struct('<QIQ')
+
+    def __init__(self, pool_path):
+        self.pool_path = pool_path
+        with open(pool_path, 'rb') as f:
+            if f.read(len(self.MAGIC)) != self.MAGIC:
+                raise CodecException("Not a packed pool : {}".format(pool_path))
+            header_len, = struct.unpack('<I', f.read(4))
+            self.param_line = f.read(header_len).decode()
+            self.seq_num, self.seq_len, index_pos = self.FIELDS.unpack(f.read(self.FIELDS.size))
+            data_start = f.tell()
+        data_stop = index_pos if index_pos > 0 else None
+        self.data = np.memmap(pool_path, dtype=np.uint8, mode='r', offset=data_start,
+                              shape=((data_stop - data_start) if data_stop else None))
+        if index_pos > 0:
+            self.offsets = np.memmap(pool_path, dtype='<u8', mode='r', offset=index_pos, shape=(self.seq_num + 1,))
+            self.lengths = np.memmap(pool_path, dtype='<u4', mode='r', offset=index_pos + 8*(self.seq_num + 1),
+                                     shape=(self.seq_num,))
+        else:
+            self.offsets, self.lengths = None, None
+
+    def __len__(self):
+        return self.seq_num
+
+    @staticmethod
+    def is_packed(pool_path):
+        with open(pool_path, 'rb') as f:
+            return f.read(len(PackedPool.MAGIC)) == PackedPool.MAGIC
+
+    def read(self, start, stop):
+        """
+        sequences [start, stop)
+        """
+        stop = min(stop, self.seq_num)
+        if start >= stop:
+            return []
+        if self.offsets is None:
+            row_bytes = (self.seq_len + 3) // 4
+            rows = self.data[start*row_bytes:stop*row_bytes].reshape(-1, row_bytes)
+            text = byte_to_bases[rows].reshape(len(rows), -1)[:, :self.seq_len].tobytes().decode()
+            return [text[i:i+self.seq_len] for i in range(0, len(text), self.seq_len)]
+        first = int(self.offsets[start])
+        text = byte_to_bases[self.data[first:int(self.offsets[stop])]].tobytes().decode()
+        begins = (4*(self.offsets[start:stop] - first)).tolist()
+        return [text[begin:begin+length] for begin, length in zip(begins, self.lengths[start:stop].tolist())]
+
+    def iter_blocks(self, block_rows=BLOCK_ROWS):
+        for start in range(0, self.seq_num, block_rows):
+            yield self.read(start, start + block_rows)
+
+    def to_fasta(self, fasta_path):
+        """
+        export the pool as FASTA(the parameter line first) for synthesis
+        """
+        with open(fasta_path, 'w') as f:
+            f.write(self.param_line)
+            seq_num = 0
+            for seq_list in self.iter_blocks():
+                f.writelines(">seq_{}\n{}\n".format(seq_num + i + 1, seq) for i, seq in enumerate(seq_list))
+                seq_num += len(seq_list)
+        return fasta_path
+
+    @staticmethod
+    def _pack(seq_list):
+        """
+        @return: packed bytes of the sequences(each from a byte boundary), lengths of the sequences
+        """
+        lengths = np.array([len(x) for x in seq_list], dtype=np.int64)
+        max_len = (int(lengths.max()) + 3) // 4 * 4
+        codes = np.zeros((len(seq_list), max_len), dtype=np.uint8)
+        if (lengths == lengths[0]).all():
+            codes[:, :lengths[0]] = base_to_code[np.frombuffer(''.join(seq_list).encode(), dtype=np.uint8)].reshape(len(seq_list), -1)
+        else:
+            codes[np.arange(max_len) < lengths[:, None]] = base_to_code[np.frombuffer(''.join(seq_list).encode(), dtype=np.uint8)]
+        if (codes == 255).any():
+            raise CodecException("Packed pools hold A, C, G and T only")
+        packed = (codes.reshape(len(seq_list), -1, 4) << np.array([6, 4, 2, 0], dtype=np.uint8)).sum(axis=2, dtype=np.uint8)
+        return packed[np.arange(max_len // 4) < ((lengths + 3) // 4)[:, None]], lengths
+
+    @staticmethod
+    def write(pool_path, param_line, seq_blocks, offset_index=False):
+        """
+        write blocks(lists) of sequences to a packed pool
+        @param offset_index: write the offset index even if all the sequences have the same length
+        @return: number of sequences, number of bases
+        """
+        lengths_list = []
+        with open(pool_path, 'wb') as f:
+            header = param_line.encode()
+            f.write(PackedPool.MAGIC + struct.pack('<I', len(header)) + header)
+            fields_pos = f.tell()
+            f.write(PackedPool.FIELDS.pack(0, 0, 0))
+            for seq_list in seq_blocks:
+                if len(seq_list) == 0:
+                    continue
+                packed, lengths = PackedPool._pack(seq_list)
+                f.write(packed.tobytes())
+                lengths_list.append(lengths)
+            lengths = np.concatenate(lengths_list) if lengths_list else np.zeros(0, dtype=np.int64)
+            same_len = len(lengths) > 0 and (lengths == lengths[0]).all()
+            index_pos = 0
+            if offset_index or not same_len:
+                index_pos = f.tell()
+                offsets = np.concatenate(([0], np.cumsum((lengths + 3) // 4)))
+                f.write(offsets.astype('<u8').tobytes())
+                f.write(lengths.astype('<u4').tobytes())
+            f.seek(fields_pos)
+            f.write(PackedPool.FIELDS.pack(len(lengths), int(lengths[0]) if same_len else 0, index_pos))
+        return len(lengths), int(lengths.sum())
+
+    @staticmethod
+    def from_fasta(fasta_path, pool_path, offset_index=False):
+        """
+        pack a FASTA pool(the parameter line first)
+        """
+        def iter_blocks(file):
+            seq_list = []
+            for line in file:
+                if line[0] != '>':
+                    seq_list.append(line.strip())
+                    if len(seq_list) == BLOCK_ROWS:
+                        yield seq_list
+                        seq_list = []
+            yield seq_list
+        with open(fasta_path, 'r') as file:
+            param_line = file.readline()
+            PackedPool.write(pool_path, param_line, iter_blocks(file), offset_index)
+        return pool_path
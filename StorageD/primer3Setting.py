@@ -34,6 +34,16 @@ def setPrimerLen(iLen = 20):
     iPrimerLen = iLen
     global_args['PRIMER_OPT_SIZE'] = iPrimerLen
 
+def getArgs(iNumber = 50, iLen = 20):
+    '''
+    Copies of the sequence and global settings with the number of returned primer pairs and the optimal primer length,
+    so that every caller(e.g. a worker process) designs with its own settings
+    '''
+    dSeqArgs, dGlobalArgs = dict(seq_args), dict(global_args)
+    dGlobalArgs['PRIMER_NUM_RETURN'] = iNumber
+    dGlobalArgs['PRIMER_OPT_SIZE'] = iLen
+    return dSeqArgs, dGlobalArgs
+
 # ************************************************************
 # "Sequence" input tags start with SEQUENCE_... and describe a particular input sequence to Primer3. 
 # They are reset after every Boulder record. 
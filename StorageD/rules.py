@@ -3,12 +3,11 @@
 # 16!=20,922,789,888,000
 '''
 import random
+import numpy as np
+from functools import lru_cache
 import logging
 log = logging.getLogger('mylog')
 
-if 'ALL_RULES' not in locals().keys():
-    ALL_RULES = list()
-
 RULES_COUNT = 30000
 
 base_rules_ji = {"0000": "AC", "0001": "AA", "0010": "AT", "0011": "AG", "0100": "TC", "0101": "TT", "0110": "GC",
@@ -18,6 +17,13 @@ base_rules_ou = {"0000": "GG", "0001": "GC", "0010": "GT", "0011": "GA", "0100":
                        "0111": "CA", "1000": "TG", "1001": "TC", "1010": "TA", "1011": "TT", "1100": "AG", "1101": "AT",
                        "1110": "AC", "1111": "AA"}
 
+lBase = [[x + y for x in ['A', 'T', 'C', 'G'] for y in ['G', 'C', 'T', 'A']],
+         [x + y for x in ['T', 'A', 'G', 'C'] for y in ['A', 'C', 'G', 'T']],
+         [x + y for x in ['G', 'A', 'C', 'T'] for y in ['C', 'A', 'G', 'T']],
+         [x + y for x in ['C', 'T', 'G', 'A'] for y in ['T', 'G', 'A', 'C']]]
+
+lBit = [ x+y for x in ['00','01','10','11'] for y in ['00','01','10','11']]
+
 # The fixed binary bits are incremented in the order of 0-15, and the bases are sorted (or the numbers 0-15 are sorted),
 # and the corresponding relationship is obtained.
 def getRules(iTotalNum=10):
@@ -27,28 +33,74 @@ def getRules(iTotalNum=10):
     @return:
     """
     log.debug("getRules， total :{}".format(iTotalNum))
-    lBase = [[x + y for x in ['A', 'T', 'C', 'G'] for y in ['G', 'C', 'T', 'A']],
-             [x + y for x in ['T', 'A', 'G', 'C'] for y in ['A', 'C', 'G', 'T']],
-             [x + y for x in ['G', 'A', 'C', 'T'] for y in ['C', 'A', 'G', 'T']],
-             [x + y for x in ['C', 'T', 'G', 'A'] for y in ['T', 'G', 'A', 'C']]]
-
-    lBit = [ x+y for x in ['00','01','10','11'] for y in ['00','01','10','11']]
     lResJi = getRandomRulues(16, iTotalNum, 1953)
     lResOu = getRandomRulues(16, iTotalNum, 2022)
 
     lPair = list()
     lPair.append((base_rules_ji, base_rules_ou))
     for index in range(iTotalNum):
-        dict1,dict2 = dict(),dict()
-        lRule1 = [lBase[index%4][lResJi[index][i]] for i in range(16)] #Odd Correspondence Rule
-        lRule2 = [lBase[(index+2)%4][lResOu[index][i]] for i in range(16)] #even number rule
-
-        for index,bit in enumerate(lBit):
-            dict1[bit] = lRule1[index]
-            dict2[bit] = lRule2[index]
-        lPair.append((dict1,dict2))
+        lPair.append(_toDict(index, lResJi[index], lResOu[index]))
     return lPair
 
+def _toDict(index, lJi, lOu):
+    """
+    the index-th random rule as dicts, lJi and lOu are the orders of the bases in lBase
+    """
+    lRule1 = [lBase[index%4][lJi[i]] for i in range(16)] #Odd Correspondence Rule
+    lRule2 = [lBase[(index+2)%4][lOu[i]] for i in range(16)] #even number rule
+    return dict(zip(lBit, lRule1)), dict(zip(lBit, lRule2))
+
+def _iterRandomRules(member_num=16, seed=2022):
+    """
+    The same orders as getRandomRulues, without resetting the global random state
+    """
+    rand = random.Random(seed)
+    template = list(range(member_num))
+    while True:
+        yield rand.sample(template, member_num)
+
+@lru_cache(maxsize=8)
+def getRule(rule_num):
+    """
+    Get one rule, the same as getRules(RULES_COUNT)[rule_num], without building the others
+    @param rule_num: 0 is the base rule, 1-RULES_COUNT are the random rules
+    @return: (odd dict, even dict)
+    """
+    if rule_num < 0 or rule_num > RULES_COUNT:
+        raise IndexError('rule num {} out of index, max: {}'.format(rule_num, RULES_COUNT))
+    if rule_num == 0:
+        return base_rules_ji, base_rules_ou
+    index = rule_num - 1
+    for lJi, lOu, _ in zip(_iterRandomRules(16, 1953), _iterRandomRules(16, 2022), range(rule_num)):
+        pass
+    return _toDict(index, lJi, lOu)
+
+def getRuleTable(iTotalNum=RULES_COUNT):
+    """
+    Get the rules as a uint8 array of shape (iTotalNum+1, 2, 16),
+    table[rule_num][0 or 1][bits] is the position of the bases in lBase[rule_num-1 (+2 for even) % 4]
+    (for rule 0, in lBase[0]).
+    """
+    table = np.empty((iTotalNum + 1, 2, 16), dtype=np.uint8)
+    table[0, 0] = [lBase[0].index(base_rules_ji[bit]) for bit in lBit]
+    table[0, 1] = [lBase[0].index(base_rules_ou[bit]) for bit in lBit]
+    for index, lJi, lOu in zip(range(iTotalNum), _iterRandomRules(16, 1953), _iterRandomRules(16, 2022)):
+        table[index + 1, 0] = lJi
+        table[index + 1, 1] = lOu
+    return table
+
+class LazyRules:
+    """
+    Read-only list of all rules, a rule is built when it is used
+    """
+    def __len__(self):
+        return RULES_COUNT + 1
+
+    def __getitem__(self, rule_num):
+        if rule_num < 0:
+            rule_num += len(self)
+        return getRule(rule_num)
+
 def getRandomRulues(member_num=16, total_rules=20, seed = 2022):
     """
     Get rules by random number given random seed
@@ -64,15 +116,14 @@ def getRandomRulues(member_num=16, total_rules=20, seed = 2022):
         res_list.append(random.sample(template, member_num))
     return res_list
 
+ALL_RULES = LazyRules()
+
 # set rules
 def setRules():
     """
-    set rules in global variable
+    set all rules in global variable (rules are built on demand by default)
     @return:
     """
     global ALL_RULES
-    if len(ALL_RULES)==0:
-        ALL_RULES = getRules(RULES_COUNT)
-
-# run the function
-setRules()
\ No newline at end of file
+    if isinstance(ALL_RULES, LazyRules):
+        ALL_RULES = getRules(RULES_COUNT)
\ No newline at end of file
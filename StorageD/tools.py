@@ -1,9 +1,15 @@
 # -*- coding: utf-8 -*-
 import math
+import re
+import gzip
+import numpy as np
 from tqdm import tqdm
-from StorageD.ecc import ReedSolomon
-from functools import cmp_to_key
+from StorageD.ecc import ReedSolomon, OuterCode
+from StorageD.bits import BitSegments, BLOCK_ROWS
+from StorageD.goldman import getOverlapPlan, splitOverlap
+from StorageD.goldmanDecode import getTernaryIndexes, voteOverlap, getOverlapTrits, mergeOverlap
 from os import path
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import logging
 
 log = logging.getLogger('mylog')
@@ -12,6 +18,12 @@ bin_to_str_list = list()
 for i in range(256):
     bin_to_str_list.append(bin(i)[2:].rjust(8,'0'))
 
+# ascii code >> base number(A:0, C:1, G:2, T:3), 255 for other characters
+base_to_num = np.full(256, 255, dtype=np.uint8)
+for i, base in enumerate('ACGT'):
+    base_to_num[ord(base)] = i
+    base_to_num[ord(base.lower())] = i
+
 class CodecException(Exception):
     pass
     
@@ -63,13 +75,74 @@ class FileTools:
         binstring = ''.join(str_list)
         return binstring
 
+    @staticmethod
+    def file_to_bytes(read_path):
+        '''read file and return uint8 array (8 bits per byte)'''
+        return np.fromfile(read_path, dtype=np.uint8)
+
     @staticmethod
     def bin_to_file(binstring, write_path):
-        '''write binary data to file'''
-        bytearr = bytearray([int(binstring[i:i + 8], 2) for i in range(0,len(binstring),8)])
+        '''write binary data(binary string or bytes) to file'''
+        if isinstance(binstring, str):
+            bytearr = bytearray([int(binstring[i:i + 8], 2) for i in range(0,len(binstring),8)])
+        else:
+            bytearr = binstring
         with open(write_path, 'wb') as f:
             f.write(bytearr)
             
+    @staticmethod
+    def open_text(read_path):
+        '''open a text file for reading, gzip files(by magic bytes) are decompressed on the fly'''
+        with open(read_path, 'rb') as f:
+            magic = f.read(2)
+        return gzip.open(read_path, 'rt') if magic == b'\x1f\x8b' else open(read_path, 'r')
+
+    @staticmethod
+    def is_fastq(read_path):
+        '''FASTQ(plain or gzip) starts with @'''
+        with FileTools.open_text(read_path) as f:
+            return f.read(1) == '@'
+
+    @staticmethod
+    def iter_fastq(read_path, block_size=1<<22):
+        '''
+        read a FASTQ(plain or gzip) file by blocks of about block_size characters
+        @return: iterator of (bases list, quality strings list) of the complete records in every block
+        '''
+        tail = ''
+        with FileTools.open_text(read_path) as file:
+            while True:
+                text = file.read(block_size)
+                lines = (tail + text).split('\n')
+                if text:
+                    record_lines = (len(lines) - 1) // 4 * 4 # the last line may be incomplete
+                else:
+                    lines = [x for x in lines if x.strip()]
+                    record_lines = len(lines) // 4 * 4
+                if record_lines > 0:
+                    yield [x.strip() for x in lines[1:record_lines:4]], [x.strip() for x in lines[3:record_lines:4]]
+                tail = '\n'.join(lines[record_lines:])
+                if not text:
+                    break
+
+    @staticmethod
+    def get_phred(quality_list):
+        '''Phred scores(uint8 arrays) of FASTQ quality strings'''
+        scores = np.frombuffer(''.join(quality_list).encode(), dtype=np.uint8) - 33
+        return np.split(scores, np.cumsum([len(x) for x in quality_list])[:-1])
+
+    @staticmethod
+    def mask_bases(base_list, quality_list, min_quality):
+        '''replace the bases with Phred scores lower than min_quality by N(decoded as erasures)'''
+        bases = np.frombuffer(''.join(base_list).encode(), dtype=np.uint8).copy()
+        scores = np.frombuffer(''.join(quality_list).encode(), dtype=np.uint8)
+        if len(bases) != len(scores):
+            raise CodecException("Lengths of bases and qualities differ")
+        bases[scores < min_quality + 33] = ord('N')
+        text = bases.tobytes().decode()
+        ends = np.cumsum([len(x) for x in base_list]).tolist()
+        return [text[start:end] for start, end in zip([0] + ends[:-1], ends)]
+
     @staticmethod
     def get_file_name_extension(file_path_or_name):
         s = path.basename(file_path_or_name)
@@ -131,12 +204,28 @@ class SplitTools:
         # Considering that there is index redundancy, it is equivalent to the redundancy of the total length, which is subtracted from the data length
         true_seq_bin_length = seq_bin_length if index_redundancy == 0 else seq_bin_length - index_redundancy
 
-        compute_bit = ori_bin_length if not code_param.add_redundancy else (ori_bin_length + int(ori_bin_length / 2))
+        outer_code = OuterCode.get(code_param.add_redundancy)
+        if outer_code is not None and not outer_code.legacy:
+            # the longest data segments whose index could hold the number of segments
+            index_length = 0
+            while True:
+                data_bin_length = true_seq_bin_length - index_length
+                if outer_code.get_chunk_len(data_bin_length) <= 0:
+                    raise Exception('no split result')
+                seq_num = outer_code.get_segment_num(math.ceil(ori_bin_length / outer_code.get_chunk_len(data_bin_length)))
+                if math.ceil(math.log(seq_num, 2)) <= index_length:
+                    break
+                index_length = math.ceil(math.log(seq_num, 2))
+            index_length += index_redundancy
+            log.debug('index_length: {}, data_bin_length: {}, seq_num: {}'.format(index_length, data_bin_length, seq_num))
+            return index_length, data_bin_length, seq_num, rs_group
+
+        compute_bit = ori_bin_length if outer_code is None else (ori_bin_length + int(ori_bin_length / 2))
         index_length, data_bin_length, seq_num = SplitTools.get_split_info(compute_bit, true_seq_bin_length, 2)
         index_length += index_redundancy
         
         # check
-        if code_param.add_redundancy:
+        if outer_code is not None:
             while(1):
                 tmp_index_len = index_length
                 split_num = math.ceil(ori_bin_length / data_bin_length) + int(math.ceil(ori_bin_length / data_bin_length) / 2)
@@ -156,84 +245,164 @@ class SplitTools:
         """
         for decode
         """
-        tmp_num = math.ceil(total_bit / bin_seg_len)  # 向上取整，得到片段个数
-        segments_num = tmp_num if not add_redundancy else (tmp_num + int(tmp_num / 2))  # 判断冗余
+        outer_code = OuterCode.get(add_redundancy)
+        tmp_num = math.ceil(total_bit / SplitTools.get_chunk_len(bin_seg_len, outer_code))  # 向上取整，得到片段个数
+        segments_num = tmp_num if outer_code is None else outer_code.get_segment_num(tmp_num)  # 判断冗余
         index_len = math.ceil(math.log(segments_num, 2)) + index_redundancy
         
         log.debug("indexLen:{},segments_num:{}".format(index_len, segments_num))
         return index_len, segments_num
 
+    @staticmethod
+    def to_packed(binstring):
+        """
+        binary string or bytes >> (uint8 array, number of bits)
+        """
+        if isinstance(binstring, str):
+            bits = np.frombuffer(binstring.encode(), dtype=np.uint8) - ord('0')
+            return np.packbits(bits), len(binstring)
+        data = np.frombuffer(binstring, dtype=np.uint8) if isinstance(binstring, (bytes, bytearray)) else binstring
+        return data, 8 * len(data)
+
+    @staticmethod
+    def get_chunk_len(bin_seg_len, add_redundancy=False):
+        """
+        file bits in a data segment of bin_seg_len bits
+        """
+        outer_code = OuterCode.get(add_redundancy)
+        return bin_seg_len if outer_code is None else outer_code.get_chunk_len(bin_seg_len)
+
+    @staticmethod
+    def get_block_unit(add_redundancy=False):
+        """
+        blocks of a multiple of this rows start at byte boundaries of the file and hold whole redundancy groups
+        """
+        outer_code = OuterCode.get(add_redundancy)
+        return 24 if outer_code is None else outer_code.get_block_unit()
+
+    @staticmethod
+    def get_data_id(row, add_redundancy=False):
+        """
+        the number of data segments before the segment with index row
+        """
+        outer_code = OuterCode.get(add_redundancy)
+        return row if outer_code is None else outer_code.get_data_id(row)
+
+    @staticmethod
+    def get_block_range(first_row, row_num, bin_split_length, add_redundancy=False):
+        """
+        byte range of the file used by segments [first_row, first_row+row_num), first_row should be a multiple of get_block_unit
+        """
+        chunk_len = SplitTools.get_chunk_len(bin_split_length, add_redundancy)
+        start_id = SplitTools.get_data_id(first_row, add_redundancy)
+        stop_id = SplitTools.get_data_id(first_row + row_num, add_redundancy)
+        return int(start_id * chunk_len // 8), math.ceil(stop_id * chunk_len / 8)
+
+    @staticmethod
+    def split_block(data, first_row, row_num, bin_split_length, index_length, add_redundancy=False):
+        """
+        build segments [first_row, first_row+row_num)
+        @param data: uint8 array of the file bytes in get_block_range, zero-filled to the segment length at the end of file
+        @return: BitSegments
+        """
+        outer_code = OuterCode.get(add_redundancy)
+        chunk_len = SplitTools.get_chunk_len(bin_split_length, outer_code)
+        rows = np.arange(first_row, first_row + row_num, dtype=np.int64)
+        is_data = np.ones(row_num, dtype=bool) if outer_code is None else outer_code.is_data(rows)
+        data_num = np.count_nonzero(is_data)
+        bits = np.unpackbits(np.asarray(data, dtype=np.uint8))[:data_num * chunk_len]
+        if len(bits) < data_num * chunk_len:  # end, the last paragraph is not long enough
+            bits = np.concatenate((bits, np.zeros(data_num * chunk_len - len(bits), dtype=np.uint8)))
+        bits = bits.reshape(data_num, chunk_len)
+        if outer_code is not None:
+            data_bits = bits
+            bits = np.zeros((row_num, chunk_len), dtype=np.uint8)
+            bits[is_data] = data_bits
+            parity = outer_code.encode(BitSegments.from_bits(data_bits).packed)
+            bits[~is_data] = BitSegments(parity, chunk_len).to_bits()
+        if chunk_len < bin_split_length: # zero bits after the file bits
+            bits = np.concatenate((bits, np.zeros((row_num, bin_split_length - chunk_len), dtype=np.uint8)), axis=1)
+        index_bits = (rows[:, None] >> np.arange(index_length - 1, -1, -1, dtype=np.int64)) & 1
+        return BitSegments.from_bits(np.concatenate((index_bits.astype(np.uint8), bits), axis=1))
+
     @staticmethod
     def split(binstring, bin_split_length, add_redundancy=False, index_redundancy=0):
         """
-        split bin string to bin list
+        split bin string(or bytes of file) to bin segments
+        @return: BitSegments
         """
-        bin_len = len(binstring)
-        tmp_num = math.ceil(bin_len / bin_split_length)  # 向上取整，得到片段个数
-        segments_num = tmp_num if not add_redundancy else (tmp_num + int(tmp_num / 2))  # 判断冗余
+        data, bin_len = SplitTools.to_packed(binstring)
+        outer_code = OuterCode.get(add_redundancy)
+        tmp_num = math.ceil(bin_len / SplitTools.get_chunk_len(bin_split_length, outer_code))  # 向上取整，得到片段个数
+        segments_num = tmp_num if outer_code is None else outer_code.get_segment_num(tmp_num)  # 判断冗余
+        block_unit = SplitTools.get_block_unit(outer_code)
+        block_rows = max(block_unit, BLOCK_ROWS // block_unit * block_unit)
 
         index_length = math.ceil(math.log(segments_num, 2)) + index_redundancy
         
         log.debug('index:{}, data:{}'.format(index_length, bin_split_length))
-        bit_segments = []
-        tmp_length = 0
+        bit_segments = BitSegments(np.empty((segments_num, (index_length + bin_split_length + 7) // 8), dtype=np.uint8),
+                                   index_length + bin_split_length)
         pro_bar = tqdm(total=segments_num, desc="Spliting")
-        for i in range(segments_num):
-            bin_index = bin(i)[2:].zfill(index_length)  # index，转二进制，左补零
-            if add_redundancy and i % 3 == 2:
-                strAdd = ''.join([str(int(x) ^ int(y)) for x, y in
-                                  zip(bit_segments[-1][index_length:], bit_segments[-2][index_length:])])
-                bit_segments.append(bin_index + strAdd)
-            elif tmp_length + bin_split_length <= len(binstring):  # 未到结尾
-                strTemp = binstring[tmp_length:tmp_length + bin_split_length]
-                bit_segments.append(bin_index + strTemp)
-                tmp_length += bin_split_length
-            else:  # end, the last paragraph is not long enough
-                strTemp = binstring[tmp_length:].ljust(bin_split_length, '0')
-                bit_segments.append(
-                    bin_index + strTemp)  # if the length of last segments != bin_len , file zero on the right side of the sequence
-                tmp_length += bin_split_length
-            pro_bar.update()
+        for first_row in range(0, segments_num, block_rows):
+            row_num = min(block_rows, segments_num - first_row)
+            start, stop = SplitTools.get_block_range(first_row, row_num, bin_split_length, outer_code)
+            block = SplitTools.split_block(data[start:stop], first_row, row_num, bin_split_length, index_length, outer_code)
+            bit_segments.packed[first_row:first_row + row_num] = block.packed
+            pro_bar.update(row_num)
         pro_bar.close()
         return bit_segments
 
     @staticmethod
-    def repair_segment(index_length, bit_segments, split_num, is_redundancy):
-        dict_seg = dict() #exist index
-        for bit_str in bit_segments:
-            index = int(bit_str[:index_length], 2)
-            if index < split_num:
-                dict_seg[index] = bit_str[index_length:]
+    def place_segments(indexes, split_num):
+        """
+        slot array of segments in O(n): slot i is the row of the segment with index i, -1 if it is missing,
+        a later segment with the same index replaces the earlier one and indexes out of range are ignored
+        """
+        indexes = np.asarray(indexes, dtype=np.int64)
+        valid = np.nonzero((indexes >= 0) & (indexes < split_num))[0]
+        rows = np.full(split_num, -1, dtype=np.int64)
+        np.maximum.at(rows, indexes[valid], valid)
+        return rows
+
+    @staticmethod
+    def repair_segment(index_length, bit_segments, split_num, is_redundancy, indexes=None):
+        """
+        @param indexes: indexes of bit_segments if they are parsed already
+        """
+        if not isinstance(bit_segments, BitSegments):
+            bit_segments = BitSegments.from_strings(bit_segments)
+        outer_code = OuterCode.get(is_redundancy)
+        rows = SplitTools.place_segments(bit_segments.get_indexes(index_length) if indexes is None else indexes, split_num)
+        exist = rows >= 0
+        exist_indexes = np.nonzero(exist)[0]
+        chunk_len = SplitTools.get_chunk_len(bit_segments.bit_len - index_length, outer_code)
+        data_segments = bit_segments.cut(index_length, index_length + chunk_len)
+        seg_data = np.zeros((split_num, data_segments.byte_len), dtype=np.uint8)
+        seg_data[exist_indexes] = data_segments.packed[rows[exist_indexes]]
 
         repaired_indexs = []
         failed_indexs = []
-        res_segments = list()
-        if is_redundancy:  # try to repair
-            for seg_index in range(split_num):
-                if seg_index not in dict_seg.keys():
-                    if seg_index % 3 == 0:
-                        index1 = seg_index + 1
-                        index2 = seg_index + 2
-                    elif seg_index % 3 == 1:
-                        index1 = seg_index - 1
-                        index2 = seg_index + 1
-                    else:
-                        continue
-                    if index1 in dict_seg.keys() and index2 in dict_seg.keys():
-                        add_str = ''.join([str(int(x) ^ int(y)) for x, y in zip(dict_seg[index1], dict_seg[index2])])
-                        dict_seg[seg_index] = add_str
-                        log.info("repair segment {}".format(seg_index))
-                        repaired_indexs.append(seg_index)
-                    else:
-                        log.warning("error to repair segment {}".format(seg_index))
-                        failed_indexs.append(seg_index)
-            for index in sorted(dict_seg.keys()):
-                if index%3!=2: # delete redundancy and index
-                    res_segments.append(dict_seg[index])
+        if outer_code is not None:  # try to repair
+            is_data = outer_code.is_data(np.arange(split_num))
+            group_len = outer_code.group_len
+            for group in np.unique(np.nonzero(~exist)[0] // group_len).tolist():
+                group_rows = slice(group * group_len, (group + 1) * group_len)
+                missing = [x for x in range(group * group_len, min((group + 1) * group_len, split_num))
+                           if not exist[x] and is_data[x]]
+                # the last data segment of the XOR redundancy may have no parity segment
+                if (group + 1) * group_len <= split_num and outer_code.repair_group(seg_data[group_rows], exist[group_rows]):
+                    exist[group_rows] = True
+                    for seg_index in missing: log.info("repair segment {}".format(seg_index))
+                    repaired_indexs.extend(missing)
+                else:
+                    for seg_index in missing: log.warning("error to repair segment {}".format(seg_index))
+                    failed_indexs.extend(missing)
+            keep = exist & is_data # delete redundancy and index
         else:
-            failed_indexs = list(set(range(split_num)).difference(set(dict_seg.keys())))
-            for index in sorted(dict_seg.keys()):
-                res_segments.append(dict_seg[index])
+            failed_indexs = np.nonzero(~exist)[0].tolist()
+            keep = exist
+        res_segments = BitSegments(seg_data[keep], chunk_len)
         for index in failed_indexs: log.warning('missing segment, index:{}'.format(index))
 
         repaired_rate = len(repaired_indexs) / split_num
@@ -245,12 +414,136 @@ class SplitTools:
                 "failed_rate": failed_rate}
 
     @staticmethod
-    def merge(bit_segments):
+    def merge(bit_segments, total_bit=None):
+        """
+        merge bin list to bin string, or BitSegments to bytes
+        @param total_bit: keep the first total_bit bits
+        """
+        if not isinstance(bit_segments, BitSegments):
+            res_bitstr = ''.join(bit_segments)
+            return res_bitstr if total_bit is None else res_bitstr[:total_bit]
+        res_bytes = bytearray()
+        for start in range(0, len(bit_segments), BLOCK_ROWS):
+            res_bytes += np.packbits(bit_segments.to_bits(start, start + BLOCK_ROWS).ravel()).tobytes()
+        return bytes(res_bytes) if total_bit is None else bytes(res_bytes[:total_bit // 8])
+
+    @staticmethod
+    def _get_placement(data_ids, bin_seg_len):
+        """
+        byte positions (rows, width) and bit shifts of data segments placed at data_id*bin_seg_len bits
+        """
+        width = (bin_seg_len + 14) // 8
+        start_bits = np.asarray(data_ids, dtype=np.int64) * bin_seg_len
+        byte_pos = (start_bits // 8)[:, None] + np.arange(width, dtype=np.int64)
+        return byte_pos, start_bits % 8
+
+    @staticmethod
+    def get_buffer_len(data_num, bin_seg_len):
+        """
+        bytes of a buffer holding data_num data segments for write_segments
+        """
+        return math.ceil(data_num * bin_seg_len / 8) + (bin_seg_len + 14) // 8
+
+    @staticmethod
+    def write_segments(buffer, data_ids, data_segments):
         """
-        merge bin list to bin string
+        write data segments(BitSegments without index) into a byte buffer(or memmap) at data_id*bin_seg_len bits
         """
-        res_bitstr = ''.join(bit_segments)
-        return res_bitstr
+        bin_seg_len = data_segments.bit_len
+        data_ids = np.asarray(data_ids, dtype=np.int64)
+        # neighbouring segments may share a byte, write odd and even segments separately
+        for parity in [0, 1]:
+            rows = np.nonzero(data_ids % 2 == parity)[0]
+            if len(rows) == 0:
+                continue
+            byte_pos, shift = SplitTools._get_placement(data_ids[rows], bin_seg_len)
+            cols = shift[:, None] + np.arange(bin_seg_len)
+            value = np.zeros((len(rows), byte_pos.shape[1] * 8), dtype=np.uint8)
+            mask = np.zeros_like(value)
+            value[np.arange(len(rows))[:, None], cols] = data_segments.to_bits()[rows]
+            mask[np.arange(len(rows))[:, None], cols] = 1
+            value, mask = np.packbits(value, axis=1), np.packbits(mask, axis=1)
+            buffer[byte_pos] = (buffer[byte_pos] & ~mask) | value
+
+    @staticmethod
+    def read_segments(buffer, data_ids, bin_seg_len):
+        """
+        read data segments written by write_segments
+        """
+        byte_pos, shift = SplitTools._get_placement(data_ids, bin_seg_len)
+        bits = np.unpackbits(np.asarray(buffer[byte_pos], dtype=np.uint8), axis=1)
+        cols = shift[:, None] + np.arange(bin_seg_len)
+        return BitSegments.from_bits(bits[np.arange(len(byte_pos))[:, None], cols])
+
+    @staticmethod
+    def get_overlap_plan(total_len, ideal_len):
+        """
+        plan of overlapping segments(Goldman), see goldman.getOverlapPlan
+        @return: segment length(trits of data), index length, number of segments, number of zeros filled
+        """
+        return getOverlapPlan(total_len, ideal_len)
+
+    @staticmethod
+    def split_overlap(trits, first_seg, seg_num, seg_len, index_len):
+        """
+        overlapping segments(ternary index + data) from first_seg, see goldman.splitOverlap
+        """
+        return splitOverlap(trits, first_seg, seg_num, seg_len, index_len)
+
+    @staticmethod
+    def get_ternary_indexes(trit_segments, index_len):
+        """
+        parse the ternary index at the head of every segment, see goldmanDecode.getTernaryIndexes
+        """
+        return getTernaryIndexes(trit_segments, index_len)
+
+    @staticmethod
+    def trits_to_segments(trit_segments):
+        """
+        2-D array of trits >> BitSegments of 2 bits per trit, the trits over 2 are erasures
+        """
+        trit_segments = np.asarray(trit_segments, dtype=np.uint8)
+        bits = np.empty((len(trit_segments), 2*trit_segments.shape[1]), dtype=np.uint8)
+        bits[:, 0::2] = (trit_segments >> 1) & 1
+        bits[:, 1::2] = trit_segments & 1
+        bit_segments = BitSegments.from_bits(bits)
+        bit_segments.mark_erasures(np.repeat(trit_segments > 2, 2, axis=1))
+        return bit_segments
+
+    @staticmethod
+    def segments_to_trits(bit_segments, trit_num):
+        """
+        the first trit_num trits(2 bits per trit) of every segment, 255 for the erased or invalid(3) ones
+        """
+        bits = bit_segments.to_bits()[:, :2*trit_num]
+        trit_segments = 2*bits[:, 0::2] + bits[:, 1::2]
+        if bit_segments.erasures is not None:
+            erased = np.repeat(bit_segments.erasures, 8, axis=1)[:, bit_segments.pad:bit_segments.pad + 2*trit_num]
+            trit_segments[erased[:, 0::2] | erased[:, 1::2]] = 3
+        trit_segments[trit_segments > 2] = 255
+        return trit_segments
+
+    @staticmethod
+    def vote_overlap(votes, trit_segments, index_len):
+        """
+        add the votes of overlapping segments to votes, see goldmanDecode.voteOverlap
+        @return: end of the trits voted, 0 if none
+        """
+        return voteOverlap(votes, trit_segments, index_len)
+
+    @staticmethod
+    def get_overlap_trits(votes, start=0, stop=None):
+        """
+        trits [start, stop) taking the majority of their votes
+        """
+        return getOverlapTrits(votes, start, stop)
+
+    @staticmethod
+    def merge_overlap(trit_segments, index_len, add_len, seg_num=None):
+        """
+        trits of the segments >> trits of the file, see goldmanDecode.mergeOverlap
+        """
+        return mergeOverlap(trit_segments, index_len, add_len, seg_num)
 
 
 class RsTools:
@@ -263,13 +556,171 @@ class RsTools:
 
     @staticmethod
     def del_rs(binsstr_list, ori_len, check_bytes):
-        seq_bin_length = len(binsstr_list[0])
+        seq_bin_length = binsstr_list.bit_len if isinstance(binsstr_list, BitSegments) else len(binsstr_list[0])
         bytes_num = math.ceil(seq_bin_length / 8)
         rs_group = math.ceil(bytes_num / 255)
         rs = ReedSolomon(check_bytes)
         bit_segments = rs.remove(binsstr_list, ori_len, group=rs_group)
         return {"validate_bit_seg": bit_segments['bit'], "err_index": bit_segments['e_i'],
-                "err_rate": bit_segments['e_r']}
+                "err_rate": bit_segments['e_r'], "clean_num": rs.clean_num, "corrected_num": rs.corrected_num,
+                "failed_num": rs.failed_num}
+
+class ConstraintChecker:
+    """
+    Check GC content and homopolymer of DNA sequences in sliding windows,
+    windows start every `moving` bases and the last ones may be shorter than `window`.
+    Works on one sequence or a batch of sequences of the same length.
+    """
+
+    def __init__(self, max_homopolymer, min_gc, max_gc, window=150, moving=140):
+        self.max_homopolymer = max_homopolymer
+        self.min_gc = min_gc
+        self.max_gc = max_gc
+        self.window = window
+        self.moving = moving
+        # a base repeated more than max_homopolymer times
+        self._repeat_pattern = re.compile(r'(.)\1{%d}' % max_homopolymer)
+
+    def get_windows(self, seq_len):
+        """
+        (start, end) of the windows
+        """
+        return [(start, min(start + self.window, seq_len)) for start in range(0, seq_len, self.moving)]
+
+    @staticmethod
+    def to_array(seqs):
+        """
+        sequence, list of sequences or 2-D ascii array >> 2-D ascii array
+        """
+        if isinstance(seqs, str):
+            seqs = [seqs]
+        if isinstance(seqs, np.ndarray):
+            return seqs.reshape(-1, seqs.shape[-1])
+        return BaseTools.seqs_to_array(seqs)
+
+    @staticmethod
+    def get_gc_prefix(seq_array):
+        """
+        prefix sums of G/C counts, shape (rows, seq_len+1)
+        """
+        is_gc = (seq_array == ord('G')) | (seq_array == ord('C'))
+        prefix = np.zeros((len(seq_array), seq_array.shape[1] + 1), dtype=np.int32)
+        np.cumsum(is_gc, axis=1, out=prefix[:, 1:])
+        return prefix
+
+    @staticmethod
+    def get_run_start(seq_array):
+        """
+        start position of the homopolymer run every base belongs to
+        """
+        positions = np.arange(seq_array.shape[1], dtype=np.int32)
+        is_start = np.ones(seq_array.shape, dtype=bool)
+        is_start[:, 1:] = seq_array[:, 1:] != seq_array[:, :-1]
+        return np.maximum.accumulate(np.where(is_start, positions, 0), axis=1)
+
+    def check(self, seqs):
+        """
+        @param seqs: a sequence, or a list/2-D ascii array of sequences with the same length
+        @return: bool for a sequence, bool array for a batch
+        """
+        if isinstance(seqs, str):
+            for start, end in self.get_windows(len(seqs)):
+                check_str = seqs[start:end]
+                if self._repeat_pattern.search(check_str):
+                    return False
+                gc_content = BaseTools.get_gc(check_str)
+                if gc_content < self.min_gc or gc_content > self.max_gc:
+                    return False
+            return True
+        if isinstance(seqs, list) and len(seqs) <= 16:
+            # string search is faster for a few sequences
+            return np.array([self.check(x) for x in seqs], dtype=bool)
+        seq_array = self.to_array(seqs)
+        passed = np.ones(len(seq_array), dtype=bool)
+        if seq_array.shape[1] > 0 and len(seq_array) > 0:
+            prefix = self.get_gc_prefix(seq_array)
+            run_start = self.get_run_start(seq_array)
+            rows = np.arange(len(seq_array))
+            for start, end in self.get_windows(seq_array.shape[1]):
+                # early exit, failed sequences are not checked again
+                run_len = np.arange(start, end) + 1 - np.maximum(run_start[rows, start:end], start)
+                ok = run_len.max(axis=1) <= self.max_homopolymer
+                gc = (prefix[rows, end] - prefix[rows, start]) / (end - start)
+                ok &= (gc >= self.min_gc) & (gc <= self.max_gc)
+                passed[rows[~ok]] = False
+                rows = rows[ok]
+                if len(rows) == 0:
+                    break
+        return passed
+
+
+class SegmentExecutor:
+    """
+    Map a function over chunks of segments in a thread or process pool, and join the results in order.
+    The pool is started by the first map and kept until shutdown(codecs shut it down at the end of every flow),
+    it could be used as a context manager too.
+    For a process pool, the function(e.g. a function of a module with its state in functools.partial)
+    and the segments need to be picklable.
+    """
+
+    def __init__(self, workers=None, pool='process', chunk_size=1024):
+        """
+        @param workers: number of workers, None for the number of CPUs
+        @param pool: 'thread' or 'process'
+        @param chunk_size: number of segments in every call of the function
+        """
+        if pool not in ['thread', 'process']:
+            raise CodecException("pool should be 'thread' or 'process', but {}".format(pool))
+        if chunk_size <= 0:
+            raise CodecException("chunk_size must be greater than 0")
+        self.workers = workers
+        self.pool = pool
+        self.chunk_size = chunk_size
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+    def _get_executor(self):
+        if self._executor is None:
+            pool_class = ThreadPoolExecutor if self.pool == 'thread' else ProcessPoolExecutor
+            self._executor = pool_class(max_workers=self.workers)
+        return self._executor
+
+    def shutdown(self):
+        """
+        shut down the pool, the next map starts a new one
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def map(self, func, segments):
+        """
+        @param segments: list or BitSegments
+        @return: func results(lists or BitSegments) of the chunks joined
+        """
+        return self.join(self.map_chunks(func, segments))
+
+    def map_chunks(self, func, segments):
+        """
+        @param segments: list or BitSegments
+        @return: list of the func results of the chunks, in order
+        """
+        chunks = [segments[start:start + self.chunk_size] for start in range(0, len(segments), self.chunk_size)]
+        if len(chunks) <= 1 or self.workers == 1:
+            return [func(chunk) for chunk in chunks]
+        return list(self._get_executor().map(func, chunks))
+
+    @staticmethod
+    def join(results):
+        if len(results) > 0 and isinstance(results[0], BitSegments):
+            return BitSegments.concat(results)
+        return [x for result in results for x in result]
+
 
 class BaseTools:
     """
@@ -282,6 +733,23 @@ class BaseTools:
             res_dict[ori_dict[i]] = i
         return res_dict
 
+    @staticmethod
+    def seqs_to_array(seq_list):
+        """
+        DNA sequences of the same length >> 2-D uint8 array of ascii codes
+        """
+        seq_len = len(seq_list[0]) if len(seq_list) > 0 else 0
+        return np.frombuffer(''.join(seq_list).encode(), dtype=np.uint8).reshape(len(seq_list), seq_len)
+
+    @staticmethod
+    def array_to_seqs(seq_array):
+        """
+        2-D uint8 array of ascii codes >> DNA sequences
+        """
+        seq_str = np.ascontiguousarray(seq_array, dtype=np.uint8).tobytes().decode()
+        seq_len = seq_array.shape[1]
+        return [seq_str[i:i + seq_len] for i in range(0, len(seq_str), seq_len)]
+
     @staticmethod
     def get_repeat(dnastr):
         if len(dnastr) == 0:
@@ -312,17 +780,21 @@ class BaseTools:
         return (dnastr.count("C") + dnastr.count("G")) / len(dnastr)
 
     @staticmethod
-    def sort_segment(bit_segments, index_length):
-        def comp_by_index(x, y):
-            index_x = int(x[:index_length], 2)
-            index_y = int(y[:index_length], 2)
-            if index_x > index_y:
-                return 1
-            elif index_y > index_x:
-                return -1
-            else:
-                return 0
+    def radix_argsort(indexes, index_length):
+        """
+        stable argsort of indexes below 2**index_length, LSD radix sort by 16-bit digits
+        """
+        indexes = np.asarray(indexes, dtype=np.int64)
+        order = np.arange(len(indexes))
+        for shift in range(0, max(index_length, 1), 16):
+            digits = ((indexes[order] >> shift) & 0xffff).astype(np.uint16)
+            order = order[np.argsort(digits, kind='stable')] # radix sort for 16-bit keys
+        return order
 
-        bit_segments = sorted(bit_segments, key=cmp_to_key(comp_by_index))
-        return bit_segments
+    @staticmethod
+    def sort_segment(bit_segments, index_length):
+        if isinstance(bit_segments, BitSegments):
+            return bit_segments.take(BaseTools.radix_argsort(bit_segments.get_indexes(index_length), index_length))
+        indexes = np.fromiter((int(x[:index_length], 2) for x in bit_segments), dtype=np.int64, count=len(bit_segments))
+        return [bit_segments[i] for i in BaseTools.radix_argsort(indexes, index_length)]
     
\ No newline at end of file
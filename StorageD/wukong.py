@@ -1,11 +1,13 @@
 from tqdm import tqdm
 import random
-import math
+import numpy as np
+from collections import Counter
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from StorageD.tools import BaseTools as bt
-from StorageD.tools import CodecException
-from StorageD.rules import RULES_COUNT,ALL_RULES
+from StorageD.tools import CodecException, BitSegments, ConstraintChecker, BLOCK_ROWS, base_to_num
+from StorageD.rules import RULES_COUNT,getRule
 
 import logging
 log = logging.getLogger('mylog')
@@ -22,99 +24,266 @@ class Wukong():
             err = 'dict num {} out of index, max: {}'.format(rule_num, RULES_COUNT)
             log.error(err)
             raise CodecException(err)
-        self.dictji = ALL_RULES[rule_num][0]
-        self.dictou = ALL_RULES[rule_num][1]
+        self.rule_num = rule_num
+        self.dictji, self.dictou = getRule(rule_num)
         self.reverse_dictji = bt.creat_reverse_dict(self.dictji)
         self.reverse_dictou = bt.creat_reverse_dict(self.dictou)
+        self._set_tables()
 
         if window<100: log.warning("window is too small, reset to : {}".format(100))
         if moving<90: log.warning("moving is too small, reset to: {}".format(90))
         self._window = window if window>=100 else 100
         self._moving = moving if moving>=90 else 90
-        #create virtual segments by random as default. 
-        #when random section timeout, this value will be reset to True.
-        self.virtual_timeout = 20 #20 seconds
-        self._create_virtual_by_function = False
+        self.virtual_time = 0.0
         self.progress = 0.0
+        self.show_progress = True
+
+    def _set_tables(self):
+        """
+        byte(odd 4 bits + even 4 bits) >> 4 bases(ascii), and 4 bases(2 bits per base, A:0 C:1 G:2 T:3) >> byte
+        """
+        ji_list = [self.dictji[bin(i)[2:].zfill(4)] for i in range(16)]
+        ou_list = [self.dictou[bin(i)[2:].zfill(4)] for i in range(16)]
+        self._byte_to_bases = np.array([list((ji_list[i>>4] + ou_list[i&15]).encode()) for i in range(256)], dtype=np.uint8)
+        self._bases_to_byte = np.zeros(256, dtype=np.uint8)
+        word_nums = base_to_num[self._byte_to_bases].astype(np.uint16) @ np.array([64, 16, 4, 1], dtype=np.uint16)
+        self._bases_to_byte[word_nums] = np.arange(256, dtype=np.uint8)
 
     def __check_encode_param(self):
         if self.bin_split_length % 2 != 0:
             raise CodecException("sequence length need to be even")
 
     def wukong_encode(self,index_length, bit_segments, max_homopolymer, max_content,
-                 min_content, max_iterations=30, hasseed=True, seed=27):
+                 min_content, max_iterations=256, hasseed=True, seed=27, processes=None, shard_rows=BLOCK_ROWS,
+                 rank_candidates=True):
+        """
+        pair segments and encode every pair to one DNA sequence
+        @param max_iterations: number of candidate partners considered for a segment(30 before the candidates were ranked)
+        @param rank_candidates: check the candidates by their estimated GC content, or from the nearest one,
+            rank_candidates=False with max_iterations=30 pairs the segments as the first versions did
+        @param processes: None to pair all the segments together,
+            or number of worker processes pairing shards of shard_rows shuffled segments.
+            The result of shards only depends on seed and shard_rows.
+        """
+        if processes is not None:
+            return self._shard_encode(index_length, bit_segments, max_homopolymer, max_content, min_content,
+                                      max_iterations, hasseed, seed, processes, shard_rows, rank_candidates)
         self.index_length = index_length
         self.max_homopolymer = max_homopolymer
         self.max_content = max_content
         self.min_content = min_content
         self.max_iterations = max_iterations
+        self.rank_candidates = rank_candidates
         self.has_seed = hasseed
         self.seed = seed
-        self.bin_split_length = len(bit_segments[0])
+        if not isinstance(bit_segments, BitSegments):
+            bit_segments = BitSegments.from_strings(bit_segments)
+        self.bin_split_length = bit_segments.bit_len
+        self._checker = ConstraintChecker(max_homopolymer, min_content, max_content, window=self._window, moving=self._moving)
         self.total_count = len(bit_segments)
         self.__check_encode_param()
-        if self.has_seed:
-            random.seed(self.seed)
-        else:
-            random.seed()
-        self._enable_index = random.sample(list(range(self.total_count)), self.total_count) # get random indexs
+        # a random stream of its own(the same numbers as the module seeded), so that encodes in threads do not interfere
+        self._random = random.Random(self.seed) if self.has_seed else random.Random()
+        self._enable_index = self._random.sample(list(range(self.total_count)), self.total_count) # get random indexs
+        self._set_pair_features(bit_segments)
+        self.virtual_time = 0.0
 
-        pro_bar = tqdm(total=len(bit_segments), desc="Encoding")
+        pro_bar = tqdm(total=len(bit_segments), desc="Encoding", disable=not self.show_progress)
         res_dna_seq = []
         while(len(self._enable_index)>0):
             # try to encode
             start_num = len(self._enable_index)
-            is_succeed = False
-            first_enable_index = -1
-            first_index = self._enable_index[first_enable_index]
-            for iter_num in range(self.max_iterations):
-                # When only one remains, add the virtual fragment directly
-                if len(self._enable_index)==1:
-                    break
-                # When try all other segments, add the virtual fragment directly
-                if 2+iter_num > len(self._enable_index):
-                    break
-                # choose last two random indexs
-                encode_bin_segments = [bit_segments[first_index]]
-                second_enable_index = -2-iter_num
-                second_index = self._enable_index[second_enable_index]
-                encode_bin_segments.append(bit_segments[second_index])
-
-                binstr = self._assem_multi_to_one(encode_bin_segments)
-                dnaseq = self._jiouencode(binstr)
-
-                if self._check_segment(dnaseq):
-                    is_succeed = True
-                    res_dna_seq.append(dnaseq)
-                    # pop last two random indexs
-                    self._enable_index.pop(second_enable_index)
-                    self._enable_index.pop()
-                    break
+            second_enable_index, dnaseq = self._find_partner(bit_segments)
+            if second_enable_index is not None:
+                res_dna_seq.append(dnaseq)
+                # pop the two paired indexs
+                self._enable_index.pop(second_enable_index)
+                self._enable_index.pop()
             # If the encoding failed, add a virtual segment
-            if not is_succeed:
+            else:
                 res_dna_seq.append(self._addtion_improve(bit_segments))
             pro_bar.update(start_num - len(self._enable_index))
             self.progress = (self.total_count-len(self._enable_index)) / self.total_count
         pro_bar.close()
         self.addtion_num = len(res_dna_seq)*2 - self.total_count
         log.debug("There are " + str(self.addtion_num)
-                  + " random bit segment(s) adding for reliability.")
+                  + " random bit segment(s) adding for reliability, {:.1f} per second.".format(self.virtual_speed))
         return res_dna_seq
 
-    def wukong_decode(self,dna_segments):
-        bit_segments = []
-        pro_bar = tqdm(total=len(dna_segments), desc="Decoding")
-        for dna_sequence in dna_segments:
-            bit_seg_1, bit_seg_2 = self._jioudecode(dna_sequence)
-            bit_segments.append(bit_seg_1)
-            bit_segments.append(bit_seg_2)
-            pro_bar.update()
-            self.progress = int(len(bit_segments)/2) / len(dna_segments)
+    def _shard_encode(self, index_length, bit_segments, max_homopolymer, max_content, min_content,
+                      max_iterations, hasseed, seed, processes, shard_rows, rank_candidates=True):
+        """
+        shuffle the segments, and pair every shard in a worker process with a seed derived from seed and the shard id
+        """
+        if not isinstance(bit_segments, BitSegments):
+            bit_segments = BitSegments.from_strings(bit_segments)
+        self.bin_split_length = bit_segments.bit_len
+        self.total_count = len(bit_segments)
+        self.__check_encode_param()
+        order = (random.Random(seed) if hasseed else random.Random()).sample(range(self.total_count), self.total_count)
+        shards = [order[start:start+shard_rows] for start in range(0, self.total_count, shard_rows)]
+        params = [dict(index_length=index_length, bit_segments=bit_segments.take(shard), max_homopolymer=max_homopolymer,
+                       max_content=max_content, min_content=min_content, max_iterations=max_iterations, hasseed=hasseed,
+                       seed=self._shard_seed(seed, shard_id), rank_candidates=rank_candidates) for shard_id, shard in enumerate(shards)]
+        self.addtion_num, self.virtual_time = 0, 0.0
+        results = [None] * len(shards)
+        done_num = 0
+        pro_bar = tqdm(total=self.total_count, desc="Encoding", disable=not self.show_progress)
+        for shard_id, result in self._run_shards(_encode_shard, params, processes):
+            results[shard_id] = result[0]
+            self.addtion_num += result[1]
+            self.virtual_time += result[2]
+            done_num += len(shards[shard_id])
+            pro_bar.update(len(shards[shard_id]))
+            self.progress = done_num / self.total_count
+        pro_bar.close()
+        log.debug("There are " + str(self.addtion_num)
+                  + " random bit segment(s) adding for reliability, {:.1f} per second.".format(self.virtual_speed))
+        return [dnaseq for result in results for dnaseq in result]
+
+    @staticmethod
+    def _shard_seed(seed, shard_id):
+        return seed * 1000003 + shard_id
+
+    def _run_shards(self, func, params, processes):
+        """
+        run func(rule_num, window, moving, param) for every param,
+        in this process for 1 process or 1 shard, otherwise in a process pool
+        @return: iterator of (shard id, result) in the order of completion
+        """
+        if processes <= 1 or len(params) <= 1:
+            for shard_id, param in enumerate(params):
+                yield shard_id, func(self.rule_num, self._window, self._moving, param)
+            return
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = {executor.submit(func, self.rule_num, self._window, self._moving, param): shard_id
+                       for shard_id, param in enumerate(params)}
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
+    @property
+    def virtual_speed(self):
+        """
+        virtual segments produced per second in the last encoding
+        """
+        return self.addtion_num / self.virtual_time if self.virtual_time > 0 else 0.0
+
+    def _set_pair_features(self, bit_segments):
+        """
+        Estimate the GC bases each segment brings to every check window, as the first or the second one of a pair.
+        GC of a dinucleotide is split into (mean over the partner's 2 bits) for both segments,
+        so the GC content of a pair is about first + second.
+        """
+        self._windows = self._checker.get_windows(self.bin_split_length)
+        pair_num = self.bin_split_length // 2
+        # window sums over pair positions(2 bases at each position)
+        window_matrix = np.zeros((pair_num, len(self._windows)), dtype=np.float32)
+        for index, (start, end) in enumerate(self._windows):
+            window_matrix[(start+1)//2:end//2, index] = 1
+        self._window_lens = np.array([end - start for start, end in self._windows], dtype=np.float32)
+        # gc[rule(odd, even)][first 2 bits][second 2 bits]
+        gc_table = np.zeros((2, 4, 4), dtype=np.float32)
+        for first in range(4):
+            for second in range(4):
+                nibble = (first>>1)<<3 | second<<1 | (first&1)
+                for rule, bases in enumerate([self._byte_to_bases[nibble<<4, :2], self._byte_to_bases[nibble, 2:]]):
+                    gc_table[rule, first, second] = np.count_nonzero((bases==ord('G')) | (bases==ord('C')))
+        first_gc = gc_table.mean(axis=2)
+        second_gc = gc_table.mean(axis=1) - gc_table.mean(axis=(1, 2))[:, None]
+        rule_index = np.arange(pair_num) % 2
+        self._first_gc = np.empty((len(bit_segments), len(self._windows)), dtype=np.float32)
+        self._second_gc = np.empty((len(bit_segments), len(self._windows)), dtype=np.float32)
+        for start in range(0, len(bit_segments), BLOCK_ROWS):
+            bits = bit_segments.to_bits(start, start+BLOCK_ROWS)
+            symbols = bits[:, 0::2]*2 + bits[:, 1::2]
+            self._first_gc[start:start+BLOCK_ROWS] = first_gc[rule_index, symbols] @ window_matrix
+            self._second_gc[start:start+BLOCK_ROWS] = second_gc[rule_index, symbols] @ window_matrix
+        self._gc_center = (self.max_content + self.min_content) / 2
+
+    def _find_partner(self, bit_segments):
+        """
+        Find a partner for the last segment in _enable_index among the previous max_iterations segments.
+        The nearest segment is tried first, then the candidates are ranked by the estimated GC content of the pair,
+        and checked exactly in growing batches.
+        @return: position of the partner in _enable_index and the DNA sequence, (None, None) if no partner
+        """
+        enable_num = len(self._enable_index)
+        if enable_num < 2 or self.max_iterations < 1:
+            return None, None
+        first_index = self._enable_index[-1]
+        first_bits = bit_segments.row_bits(first_index)
+        dnaseq = self._jiouencode(self._assem_pairs(first_bits, bit_segments.row_bits(self._enable_index[-2])))
+        if self._checker.check(dnaseq):
+            return enable_num-2, dnaseq
+        first_position = max(0, enable_num-1-self.max_iterations)
+        # candidates from the nearest one, ties in the ranking keep this order
+        positions = np.arange(enable_num-2, first_position-1, -1)
+        candidates = np.array(self._enable_index[first_position:enable_num-1][::-1])
+        gc_error = (self._first_gc[first_index] + self._second_gc[candidates]) / self._window_lens - self._gc_center
+        order = np.argsort(np.abs(gc_error).max(axis=1), kind='stable') if self.rank_candidates else np.arange(len(candidates))
+        batch_start, batch_size = 0, 4
+        while batch_start < len(order):
+            batch = order[batch_start:batch_start+batch_size]
+            dna_list = self._jiouencode(self._assem_pairs(first_bits, bit_segments.take(candidates[batch]).to_bits()))
+            passed = self._checker.check(dna_list)
+            if passed.any():
+                best = int(np.argmax(passed))
+                return int(positions[batch[best]]), dna_list[best]
+            batch_start += batch_size
+            batch_size *= 4
+        return None, None
+
+    def wukong_decode(self,dna_segments, processes=None):
+        """
+        decode DNA sequences to BitSegments.
+        Sequences shorter than the most common length are filled with N, which are marked as erasures with invalid bases,
+        and longer ones are dropped.
+        @param processes: None to decode in this process, or number of worker processes decoding blocks
+        """
+        dna_len = Counter(len(x) for x in dna_segments).most_common(1)[0][0] if len(dna_segments)>0 else 0
+        if dna_len%2!=0:
+            raise CodecException("The DNA sequence length is incorrect，needs to be an even number")
+        blocks, block_lens = [], []
+        for start in range(0, len(dna_segments), BLOCK_ROWS):
+            block = dna_segments[start:start+BLOCK_ROWS]
+            dna_block = [x if len(x)==dna_len else x.ljust(dna_len, 'N') for x in block if len(x)<=dna_len]
+            if len(dna_block)!=len(block):
+                log.warning("drop {} sequence(s) longer than {}".format(len(block)-len(dna_block), dna_len))
+            if len(dna_block)>0:
+                blocks.append(dna_block)
+                block_lens.append(len(block))
+        if processes is None:
+            results = ((block_id, self._decode_block(dna_block)) for block_id, dna_block in enumerate(blocks))
+        else:
+            results = self._run_shards(_decode_block, blocks, processes)
+        block_segments = [None] * len(blocks)
+        done_num = 0
+        pro_bar = tqdm(total=len(dna_segments), desc="Decoding", disable=not self.show_progress)
+        for block_id, bit_segments in results:
+            block_segments[block_id] = bit_segments
+            done_num += block_lens[block_id]
+            pro_bar.update(block_lens[block_id])
+            self.progress = done_num / len(dna_segments)
         pro_bar.close()
-        return  bit_segments
+        if len(block_segments)==0:
+            return BitSegments(np.zeros((0, (dna_len+7)//8), dtype=np.uint8), dna_len)
+        return BitSegments.concat(block_segments)
+
+    def _decode_block(self, dna_block):
+        """
+        DNA sequences of the same length >> BitSegments of the two segments of every sequence
+        """
+        bit_seg_1, bit_seg_2, invalid_bits = self._jioudecode(dna_block, return_invalid=True)
+        bits = np.empty((2*len(dna_block), bit_seg_1.shape[1]), dtype=np.uint8)
+        bits[0::2], bits[1::2] = bit_seg_1, bit_seg_2
+        bit_segments = BitSegments.from_bits(bits)
+        bit_segments.mark_erasures(np.repeat(invalid_bits, 2, axis=0))
+        return bit_segments
 
     def _assem_multi_to_one(self, bin_str_list):
-        res = ''
+        """
+        interleave two segments(0/1 arrays or binary strings) to one 0/1 array
+        """
         if type(bin_str_list)!=list:
             raise CodecException("Type error, need list but {}".format(type(bin_str_list)))
         if len(bin_str_list) != 2:
@@ -126,124 +295,158 @@ class Wukong():
         str_len = len(bin_str_list[0])
         if str_len%2!=0:
             raise CodecException("Error, length of bin_str should be even")
-        for i in range(0,str_len,2):
-            res += bin_str_list[0][i] + bin_str_list[1][i] + bin_str_list[1][i + 1] + bin_str_list[0][i + 1]
+        first, second = [np.frombuffer(x.encode(), dtype=np.uint8) - ord('0') if isinstance(x, str) else x for x in bin_str_list]
+        return self._assem_pairs(first, second)
+
+    @staticmethod
+    def _assem_pairs(first, second):
+        """
+        interleave 0/1 arrays: one first segment with a 2-D array of second segments gives a 2-D array
+        """
+        shape = np.broadcast_shapes(first.shape, second.shape)
+        res = np.empty(shape[:-1] + (2*shape[-1],), dtype=np.uint8)
+        res[..., 0::4] = first[..., 0::2]
+        res[..., 1::4] = second[..., 0::2]
+        res[..., 2::4] = second[..., 1::2]
+        res[..., 3::4] = first[..., 1::2]
         return res
 
     def _jiouencode(self, binstr):
-        slen = len(binstr)
-        remainder = slen%8
-        res = ''.join([self.dictji[binstr[i:i+4]]+self.dictou[binstr[i+4:i+8]] for i in range(0,slen-remainder,8)])
-        if remainder==0:
-            pass
-        elif remainder==4:
-            res += self.dictji[binstr[-remainder:]]
-        else:
+        """
+        0/1 array(or binary string) >> DNA sequence, 4 bits >> 2 bases, odd and even rules are used in turn.
+        A 2-D array (one row per assembled segment) is translated in one pass and returns a list.
+        """
+        if isinstance(binstr, str):
+            binstr = np.frombuffer(binstr.encode(), dtype=np.uint8) - ord('0')
+        bits = binstr.reshape(-1, binstr.shape[-1])
+        slen = bits.shape[1]
+        if slen%8 not in [0, 4]:
             raise CodecException("Wrong length to encode")
-        return res
+        bases = self._byte_to_bases[np.packbits(bits, axis=1)].reshape(len(bits), -1)[:, :slen//2]
+        res = bt.array_to_seqs(bases)
+        return res if binstr.ndim==2 else res[0]
 
-    def _jioudecode(self, dna_sequence):
-        dna_len = len(dna_sequence)
+    def _jioudecode(self, dna_sequence, return_invalid=False):
+        """
+        DNA sequence >> two 0/1 arrays.
+        A list of DNA sequences (same length) is translated in one pass and returns two 2-D arrays.
+        Invalid bases(e.g. N) are read as A, return_invalid also returns a bool array marking the bits
+        decoded from them(the same positions in both segments).
+        """
+        dna_list = [dna_sequence] if isinstance(dna_sequence, str) else dna_sequence
+        dna_len = len(dna_list[0])
         if dna_len%2!=0:
             raise CodecException("The DNA sequence length is incorrect，needs to be an even number")
-        remainder = dna_len%4
-        bit_seg = ''.join([self.reverse_dictji[dna_sequence[i:i+2]]+self.reverse_dictou[dna_sequence[i+2:i+4]] for i in range(0, dna_len-remainder, 4)])
-        if remainder!=0:
-            bit_seg += self.reverse_dictji[dna_sequence[-remainder:]]
-        bit_len = len(bit_seg)
-        bit_seg_1 = "".join([bit_seg[i]+bit_seg[i+3] for i in range(0, bit_len, 4)])
-        bit_seg_2 = "".join([bit_seg[i+1] + bit_seg[i+2] for i in range(0, bit_len, 4)])
+        nums = base_to_num[bt.seqs_to_array(dna_list)]
+        invalid = nums>3
+        if invalid.any():
+            nums[invalid] = 0
+        if dna_len%4!=0:
+            nums = np.concatenate((nums, np.zeros((len(nums), 2), dtype=np.uint8)), axis=1)
+        words = nums.reshape(len(nums), -1, 4).astype(np.uint16) @ np.array([64, 16, 4, 1], dtype=np.uint16)
+        bit_seg = np.unpackbits(self._bases_to_byte[words], axis=1)[:, :2*dna_len].reshape(len(nums), -1, 4)
+        bit_seg_1 = bit_seg[:, :, [0, 3]].reshape(len(nums), -1)
+        bit_seg_2 = bit_seg[:, :, [1, 2]].reshape(len(nums), -1)
+        # a base pair holds 2 bits of every segment
+        invalid_bits = np.repeat(invalid.reshape(len(nums), -1, 2).any(axis=2), 2, axis=1)
+        if isinstance(dna_sequence, str):
+            bit_seg_1, bit_seg_2, invalid_bits = bit_seg_1[0], bit_seg_2[0], invalid_bits[0]
+        if return_invalid:
+            return bit_seg_1, bit_seg_2, invalid_bits
         return bit_seg_1,bit_seg_2
 
 
     def _check_segment(self, dnastr):
-        for index in range(0,len(dnastr), self._moving):
-            last = index+self._window
-            if last>=len(dnastr):
-                last=None
-            check_str = dnastr[index:last]
-            if bt.get_repeat(check_str) > self.max_homopolymer:
-                # log.debug("homopolymer false: {} - {}:{}".format(index,last,check_str))
-                return False
-            gc_content = bt.get_gc(check_str)
-            if gc_content < self.min_content or gc_content > self.max_content:
-                # log.debug("gc false: {} - {}:{}".format(index,last,check_str))
-                return False
-        return True
-
-    def _get_virtual_segment(self, bit_segment):
-        #TODO: better to generate a new segment
-        split_seg = [bit_segment[i:i+2] for i in range(0,len(bit_segment),2)]
-        for start in ['0','1']:
-            is_ji = True
-            first_bin = split_seg[0][0] + '1' + start + split_seg[0][1]
-            res_base = self.dictji[first_bin]
-            for seg in split_seg[1:]:
-                is_ji = not is_ji
-                tmp_base_list = list()
-                gc_delta_list = list()
-                for tmp1 in ['0','1']:
-                    for tmp2 in ['0','1']:
-                        tmp_bin = seg[0] + tmp1 + tmp2 + seg[1]
-                        tmp_base = self.dictji[tmp_bin] if is_ji else self.dictou[tmp_bin]
-                        check_str = res_base + tmp_base
-                        if len(check_str)>=self.max_homopolymer:
-                            if bt.check_equal(check_str[-self.max_homopolymer:]): # if homopolymer does not meet requirement, do not add in list
-                                break
-                        tmp_base_list.append(tmp_base)
-                        gc_delta_list.append(abs((self.max_content+self.min_content)/2 - bt.get_gc(check_str)))
-                if len(tmp_base_list)==0: # all segments's homopolymer do not meet requirement
-                    raise CodecException("Could not get virtual segment.\nConsider encoding with more relaxed conditions.")
-                else:
-                    no_repeat_bases = list()
-                    min_gc = 1
-                    res = ""
-                    # Priority is given to non-repetition
-                    for index, bases in enumerate(tmp_base_list):
-                        if bases[0]!=bases[1]: # Use data with GC content closing to 0.5
-                            if gc_delta_list[index] < min_gc:
-                                min_gc = gc_delta_list[index]
-                                res = bases
-                    if res == "":
-                        res = tmp_base_list[gc_delta_list.index(min(gc_delta_list))]
-                    res_base += tmp_base_list[gc_delta_list.index(min(gc_delta_list))]
-        return res_base
+        return self._checker.check(dnastr)
+
+    def _set_virtual_tables(self, first_bits):
+        """
+        Bases and GC counts of the 4 choices of the free 2 bits(of the virtual segment) at every base pair.
+        @return: bases(pair, choice, 2), window GC counts(pair, choice, window)
+        """
+        pair_num = len(first_bits) // 2
+        choices = np.repeat(np.array([[0, 0], [0, 1], [1, 0], [1, 1]], dtype=np.uint8), pair_num, axis=0).reshape(4, -1)
+        dna_list = self._jiouencode(self._assem_pairs(first_bits, choices))
+        bases = base_to_num[bt.seqs_to_array(dna_list)].reshape(4, pair_num, 2).transpose(1, 0, 2)
+        is_gc = ((bases == 1) | (bases == 2)).astype(np.int32)
+        in_window = np.zeros((2*pair_num, len(self._windows)), dtype=np.int32)
+        for index, (start, end) in enumerate(self._windows):
+            in_window[start:end, index] = 1
+        return bases, np.einsum('pck,pkw->pcw', is_gc, in_window.reshape(pair_num, 2, -1))
+
+    def _get_virtual_segment(self, first_bits, beam_width=32):
+        """
+        Construct a virtual segment for the first segment by beam search over the free 2 bits at every base pair.
+        States with the same last base, homopolymer run and window GC counts are merged, and a state is dropped
+        once a window could not reach the GC range any more, so the search takes pair_num steps at most.
+        The index of the virtual segment starts with 1, and ties are broken randomly.
+        @return: DNA sequence
+        """
+        bases, window_gc = self._set_virtual_tables(first_bits)
+        pair_num = len(bases)
+        window_lens = np.array([end - start for start, end in self._windows])
+        gc_min = np.array([min((c for c in range(n+1) if c/n >= self.min_content), default=n+1) for n in window_lens])
+        gc_max = np.array([max((c for c in range(n+1) if c/n <= self.max_content), default=-1) for n in window_lens])
+        # GC counts the rest pairs could still bring to every window
+        rest_min = np.zeros((pair_num+1, len(window_lens)), dtype=np.int32)
+        rest_max = np.zeros((pair_num+1, len(window_lens)), dtype=np.int32)
+        rest_min[:-1] = np.cumsum(window_gc.min(axis=1)[::-1], axis=0)[::-1]
+        rest_max[:-1] = np.cumsum(window_gc.max(axis=1)[::-1], axis=0)[::-1]
+        # bases of every window before a pair
+        covered = np.clip(2*np.arange(pair_num+1)[:, None] - np.array([start for start, _ in self._windows]), 0, window_lens)
+        rng = np.random.default_rng(self._random.getrandbits(64))
+
+        last_base = np.full(1, 4, dtype=np.int64)
+        run_len = np.zeros(1, dtype=np.int64)
+        gc_count = np.zeros((1, len(window_lens)), dtype=np.int64)
+        trace = []
+        for pair in range(pair_num):
+            # every state with every choice, the first bit of the index is 1
+            choice = np.tile(np.arange(2 if pair==0 else 0, 4), len(last_base))
+            parent = np.repeat(np.arange(len(last_base)), 4 - (2 if pair==0 else 0))
+            first, second = bases[pair, choice, 0], bases[pair, choice, 1]
+            run_first = np.where(first == last_base[parent], run_len[parent] + 1, 1)
+            new_run = np.where(second == first, run_first + 1, 1)
+            new_gc = gc_count[parent] + window_gc[pair, choice]
+            valid = (np.maximum(run_first, new_run) <= self.max_homopolymer) \
+                & ((new_gc + rest_max[pair+1]) >= gc_min).all(axis=1) & ((new_gc + rest_min[pair+1]) <= gc_max).all(axis=1)
+            if not valid.any():
+                raise CodecException("Could not get virtual segment.\nConsider encoding with more relaxed conditions.")
+            choice, parent, last, new_run, new_gc = choice[valid], parent[valid], second[valid], new_run[valid], new_gc[valid]
+            _, unique = np.unique(np.column_stack((last, new_run, new_gc)), axis=0, return_index=True)
+            score = np.abs(new_gc[unique] - self._gc_center*covered[pair+1]).sum(axis=1) + rng.random(len(unique))
+            keep = unique[np.argsort(score)[:beam_width]]
+            trace.append((choice[keep], parent[keep]))
+            last_base, run_len, gc_count = last[keep], new_run[keep], new_gc[keep]
+        # back track the choices of the best state
+        second_bits = np.empty((pair_num, 2), dtype=np.uint8)
+        state = 0
+        for pair in range(pair_num-1, -1, -1):
+            choice, parent = trace[pair]
+            second_bits[pair] = [choice[state]>>1, choice[state]&1]
+            state = parent[state]
+        return self._jiouencode(self._assem_pairs(first_bits, second_bits.reshape(-1)))
 
     def _addtion_improve(self, bit_segments):
-        
-        bit_segment = bit_segments[self._enable_index[-1]]
-        
-        # create virtual by random as default
-        if not self._create_virtual_by_function:
-            encode_bin_seg = []
-            encode_bin_seg.append(bit_segment)
-            tm_start = datetime.now()
-            while True:
-                if (datetime.now() - tm_start).seconds > self.virtual_timeout:
-                    log.debug("Get random virtual segments timeout. Change create mode, and this will continue till the end of encoding")
-                    self._create_virtual_by_function = True # Timeout. Change create mode, and this will continue till the end of encoding
-                    break
-                
-                # generate a virtual segment with an index first of 1
-                random_index = random.randint(math.pow(2, self.index_length - 1), math.pow(2, self.index_length) - 1)
-                created_bin = bin(random_index)[2:]
-                for i in range(self.bin_split_length - self.index_length):
-                    created_bin += str(random.randrange(0, 2))
-    
-                encode_bin_seg.append(created_bin)
-                binstr = self._assem_multi_to_one(encode_bin_seg)
-                dnaseq = self._jiouencode(binstr)
-    
-                if self._check_segment(dnaseq):
-                    self._enable_index.pop()
-                    return dnaseq
-                else:
-                    encode_bin_seg.pop() # If the combination is not available, delete the imaginary fragment and continue looking
-        
-        # create virtual by function: self._get_virtual_segment(bit_segment)
-        if self._create_virtual_by_function:
-            dnaseq = self._get_virtual_segment(bit_segment)
-            if not self._check_segment(dnaseq):
-                raise CodecException("Virtual segment error.\nConsider encoding with more relaxed parameter")
-            self._enable_index.pop()
-            return dnaseq
+        """
+        encode the last segment with a constructed virtual segment
+        """
+        tm_start = datetime.now()
+        dnaseq = self._get_virtual_segment(bit_segments.row_bits(self._enable_index[-1]))
+        if not self._check_segment(dnaseq):
+            raise CodecException("Virtual segment error.\nConsider encoding with more relaxed parameter")
+        self._enable_index.pop()
+        self.virtual_time += (datetime.now() - tm_start).total_seconds()
+        return dnaseq
+
+
+def _encode_shard(rule_num, window, moving, param):
+    worker = Wukong(rule_num=rule_num, window=window, moving=moving)
+    worker.show_progress = False
+    dna_list = worker.wukong_encode(**param)
+    return dna_list, worker.addtion_num, worker.virtual_time
+
+
+def _decode_block(rule_num, window, moving, dna_block):
+    worker = Wukong(rule_num=rule_num, window=window, moving=moving)
+    return worker._decode_block(dna_block)
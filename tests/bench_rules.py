@@ -0,0 +1,31 @@
+"""
+Import-time benchmark of the rule table, run from the tests directory:
+    python bench_rules.py
+"""
+import subprocess
+import sys
+import timeit
+from os import path
+
+root_dir = path.dirname(path.dirname(path.abspath(__file__)))
+
+
+def time_in_subprocess(statement, repeat=5):
+    code = "import sys, time; sys.path.insert(0, {!r}); t = time.perf_counter(); {}; print(time.perf_counter() - t)".format(
+        root_dir, statement)
+    return min(float(subprocess.check_output([sys.executable, "-c", code])) for _ in range(repeat))
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, root_dir)
+    from StorageD.rules import getRules, getRule, getRuleTable, RULES_COUNT
+
+    print("import StorageD.rules              : {:.4f}s".format(time_in_subprocess("import StorageD.rules")))
+    print("getRules(RULES_COUNT), old import  : {:.4f}s".format(
+        timeit.timeit(lambda: getRules(RULES_COUNT), number=1)))
+    print("getRule(1), first use              : {:.4f}s".format(
+        timeit.timeit(lambda: getRule.__wrapped__(1), number=1)))
+    print("getRule(RULES_COUNT), worst case   : {:.4f}s".format(
+        timeit.timeit(lambda: getRule.__wrapped__(RULES_COUNT), number=1)))
+    print("getRuleTable(), uint8 full table   : {:.4f}s, {} bytes".format(
+        timeit.timeit(getRuleTable, number=1), getRuleTable().nbytes))
@@ -1,8 +1,15 @@
 import unittest
 import logging
+import random
+import gzip
+import filecmp
+import numpy as np
+from os import remove, path
+from tempfile import TemporaryDirectory
 log = logging.getLogger('mylog')
 
 from StorageD.codec import WukongEncode,WukongDecode,GoldmanEncode,GoldmanDecode,ChurchEncode,ChurchDecode
+from StorageD.pool import PackedPool
 
 file_input = "testFile/dna.jpg"
 output_dir = "testResult/"
@@ -45,6 +52,21 @@ class TestCodec(unittest.TestCase):
         decode_worker = WukongDecode(input_file_path=encode_worker.output_file_path, output_dir=output_dir, rule_num=rule_num)
         res_file = decode_worker.common_decode()
 
+    def test_wukong_rscode(self):
+        with TemporaryDirectory() as tmp_dir:
+            encode_worker = WukongEncode(input_file_path=file_input, output_dir=tmp_dir, sequence_length=sequence_length,max_homopolymer=max_homopolymer,
+                                  min_gc=min_gc, max_gc=max_gc, rule_num=rule_num, rs_num=rs_num, add_redundancy=add_redundancy)
+            encode_worker.common_encode()
+            self.assertGreater(encode_worker.virtual_segment, 0)
+            decode_worker = WukongDecode(input_file_path=encode_worker.output_file_path, output_dir=tmp_dir, rule_num=rule_num)
+            # virtual segments are dropped before rscode, a clean pool has no failed segment
+            for decode in [decode_worker.common_decode, decode_worker.stream_decode, decode_worker.consensus_decode]:
+                res_file = decode()
+                self.assertTrue(filecmp.cmp(file_input, res_file, shallow=False))
+                self.assertEqual(decode_worker.rs_failed_num, 0)
+                self.assertEqual(decode_worker.rs_clean_num, encode_worker.seq_num)
+            self.assertEqual(decode_worker.orphan_num, 0)
+
     def test_church(self):
         encode_worker = ChurchEncode(input_file_path=file_input, output_dir=output_dir, sequence_length=sequence_length, max_homopolymer=max_homopolymer,
                               rs_num=rs_num, add_redundancy=add_redundancy, add_primer=add_primer, primer_length=primer_length)
@@ -58,6 +80,278 @@ class TestCodec(unittest.TestCase):
         decode_worder = GoldmanDecode(input_file_path=encode_worker.output_file_path, output_dir=output_dir)
         res_file = decode_worder.common_decode()
 
+    def test_goldman_overlap(self):
+        with TemporaryDirectory() as tmp_dir:
+            encode_worker = GoldmanEncode(input_file_path=file_input, output_dir=tmp_dir, sequence_length=sequence_length)
+            encode_worker.common_encode()
+            with open(encode_worker.output_file_path) as f:
+                lines = f.readlines()
+            rnd = random.Random(2)
+            seqs = [line.strip() for line in lines[2::2]]
+            del seqs[len(seqs)//2] # covered by the 3 overlapping segments left
+            for _ in range(200):
+                row = rnd.randrange(len(seqs))
+                col = rnd.randrange(encode_worker.index_length, len(seqs[row]))
+                seqs[row] = seqs[row][:col] + rnd.choice('ACGTN'.replace(seqs[row][col], '')) + seqs[row][col+1:]
+            rnd.shuffle(seqs)
+            with open(encode_worker.output_file_path, 'w') as f:
+                f.writelines([lines[0]] + [">seq_{}\n{}\n".format(i + 1, x) for i, x in enumerate(seqs)])
+            decode_worker = GoldmanDecode(input_file_path=encode_worker.output_file_path, output_dir=tmp_dir)
+            res_file = decode_worker.common_decode()
+            self.assertTrue(filecmp.cmp(file_input, res_file, shallow=False))
+
+    def test_goldman_index(self):
+        with TemporaryDirectory() as tmp_dir:
+            encode_worker = GoldmanEncode(input_file_path=file_input, output_dir=tmp_dir, sequence_length=sequence_length)
+            encode_worker.common_encode()
+            with open(encode_worker.output_file_path) as f:
+                lines = f.readlines()
+            index_length = encode_worker.index_length
+            seqs = [line.strip() for line in lines[2::2]]
+            # index trits of "2" from "A" are "TGCA...", an index out of range
+            seqs[5] = ('TGCA' * index_length)[:index_length] + seqs[5][index_length:]
+            rnd = random.Random(4)
+            for row in rnd.sample(range(len(seqs)), 20):
+                col = rnd.randrange(index_length)
+                seqs[row] = seqs[row][:col] + rnd.choice('ACGTN'.replace(seqs[row][col], '')) + seqs[row][col+1:]
+            with open(encode_worker.output_file_path, 'w') as f:
+                f.writelines([lines[0]] + [">seq_{}\n{}\n".format(i + 1, x) for i, x in enumerate(seqs)])
+            for decode_mode in ['common_decode', 'stream_decode']:
+                decode_worker = GoldmanDecode(input_file_path=encode_worker.output_file_path, output_dir=tmp_dir)
+                res_file = getattr(decode_worker, decode_mode)()
+                self.assertTrue(filecmp.cmp(file_input, res_file, shallow=False))
+            # without the last segment, the trits are counted from the parameter line instead of the largest index
+            with open(encode_worker.output_file_path, 'w') as f:
+                f.writelines([lines[0]] + [">seq_{}\n{}\n".format(i + 1, x) for i, x in enumerate(seqs[:-1])])
+            for decode_mode in ['common_decode', 'stream_decode']:
+                decode_worker = GoldmanDecode(input_file_path=encode_worker.output_file_path, output_dir=tmp_dir)
+                res_file = getattr(decode_worker, decode_mode)()
+                with open(file_input, 'rb') as f, open(res_file, 'rb') as g:
+                    data, res_data = f.read(), g.read()
+                # only the trits of the last step(less than 10 bytes) are in no other segment
+                self.assertEqual(len(res_data), len(data))
+                self.assertEqual(res_data[:-10], data[:-10])
+
+    def test_goldman_stream(self):
+        with TemporaryDirectory() as tmp_dir:
+            encode_worker = GoldmanEncode(input_file_path=file_input, output_dir=tmp_dir, sequence_length=sequence_length, rs_num=rs_num)
+            encode_worker.common_encode()
+            with open(encode_worker.output_file_path) as f:
+                lines = f.readlines()
+            encode_worker.set_executor(workers=2, pool='process', chunk_size=1000)
+            encode_worker.stream_encode(max_memory=1024*1024)
+            with open(encode_worker.output_file_path) as f:
+                self.assertEqual(f.readlines(), lines)
+            rnd = random.Random(3)
+            seqs = [line.strip() for line in lines[2::2]]
+            for row in rnd.sample(range(len(seqs)), len(seqs)//4):
+                col = rnd.randrange(len(seqs[row]))
+                seqs[row] = seqs[row][:col] + rnd.choice('ACGTN'.replace(seqs[row][col], '')) + seqs[row][col+1:]
+            with open(encode_worker.output_file_path, 'w') as f:
+                f.writelines([lines[0]] + [">seq_{}\n{}\n".format(i + 1, x) for i, x in enumerate(seqs)])
+            decode_worker = GoldmanDecode(input_file_path=encode_worker.output_file_path, output_dir=tmp_dir)
+            decode_worker.set_executor(workers=2, pool='thread', chunk_size=1000)
+            res_file = decode_worker.stream_decode(max_memory=1024*1024)
+            self.assertTrue(filecmp.cmp(file_input, res_file, shallow=False))
+            self.assertGreater(decode_worker.rs_corrected_num, 0)
+
+    def test_stream_encode(self):
+        with TemporaryDirectory() as tmp_dir:
+            encode_worker = WukongEncode(input_file_path=file_input, output_dir=tmp_dir, sequence_length=sequence_length,max_homopolymer=max_homopolymer,
+                                  min_gc=min_gc, max_gc=max_gc, rule_num=rule_num, rs_num=rs_num, add_redundancy=add_redundancy)
+            encode_worker.stream_encode(max_memory=1024*1024)
+            self.assertEqual(encode_worker.validate_pool()[1], [])
+            decode_worker = WukongDecode(input_file_path=encode_worker.output_file_path, output_dir=tmp_dir, rule_num=rule_num)
+            res_file = decode_worker.common_decode()
+            self.assertTrue(filecmp.cmp(file_input, res_file, shallow=False))
+
+    def test_stream_decode(self):
+        with TemporaryDirectory() as tmp_dir:
+            encode_worker = ChurchEncode(input_file_path=file_input, output_dir=tmp_dir, sequence_length=sequence_length, max_homopolymer=max_homopolymer,
+                                  rs_num=rs_num, add_redundancy=add_redundancy)
+            encode_worker.common_encode()
+            with open(encode_worker.output_file_path) as f:
+                lines = f.readlines()
+            with open(encode_worker.output_file_path, 'w') as f:
+                f.writelines(lines[:3] + lines[5:]) # lose one sequence
+            decode_worker = ChurchDecode(input_file_path=encode_worker.output_file_path, output_dir=tmp_dir)
+            res_file = decode_worker.stream_decode(max_memory=1024*1024)
+            self.assertEqual(decode_worker.repaired_indexs, [1])
+            self.assertTrue(filecmp.cmp(file_input, res_file, shallow=False))
+
+    def test_outer_code(self):
+        with TemporaryDirectory() as tmp_dir:
+            encode_worker = ChurchEncode(input_file_path=file_input, output_dir=tmp_dir, sequence_length=sequence_length, max_homopolymer=max_homopolymer,
+                                  rs_num=rs_num, add_redundancy=(8, 2))
+            encode_worker.common_encode()
+            with open(encode_worker.output_file_path) as f:
+                lines = f.readlines()
+            self.assertIn('bRedundancy:8-2', lines[0])
+            with open(encode_worker.output_file_path, 'w') as f:
+                f.writelines(lines[:3] + lines[5:17] + lines[19:]) # lose sequences 1, 8 and 9 of the first two groups
+            for decode in ['common_decode', 'stream_decode']:
+                decode_worker = ChurchDecode(input_file_path=encode_worker.output_file_path, output_dir=tmp_dir)
+                res_file = getattr(decode_worker, decode)()
+                self.assertEqual(decode_worker.repaired_indexs, [1])
+                self.assertTrue(filecmp.cmp(file_input, res_file, shallow=False))
+
+    def test_consensus_decode(self):
+        with TemporaryDirectory() as tmp_dir:
+            encode_worker = ChurchEncode(input_file_path=file_input, output_dir=tmp_dir, sequence_length=sequence_length, max_homopolymer=max_homopolymer,
+                                  rs_num=rs_num, add_redundancy=add_redundancy)
+            encode_worker.common_encode()
+            with open(encode_worker.output_file_path) as f:
+                lines = f.readlines()
+            rnd = random.Random(1)
+            reads = [''.join(rnd.choice('ACGT') if rnd.random() < 0.01 else base for base in line.strip())
+                     for line in lines[2::2] for _ in range(rnd.randint(4, 8))]
+            rnd.shuffle(reads)
+            with open(encode_worker.output_file_path, 'w') as f:
+                f.writelines([lines[0]] + [">read_{}\n{}\n".format(i, read) for i, read in enumerate(reads)])
+            decode_worker = ChurchDecode(input_file_path=encode_worker.output_file_path, output_dir=tmp_dir)
+            for two_pass in [False, True]:
+                res_file = decode_worker.consensus_decode(max_memory=16*1024*1024, two_pass=two_pass)
+                self.assertEqual(decode_worker.read_num, len(reads))
+                self.assertGreater(decode_worker.assigned_num, 0)
+                self.assertTrue(filecmp.cmp(file_input, res_file, shallow=False))
+                self.assertFalse(path.exists(res_file + '.votes'))
+
+    def test_consensus_quality(self):
+        with TemporaryDirectory() as tmp_dir:
+            encode_worker = ChurchEncode(input_file_path=file_input, output_dir=tmp_dir, sequence_length=sequence_length, max_homopolymer=max_homopolymer,
+                                  rs_num=rs_num, add_redundancy=add_redundancy)
+            encode_worker.common_encode()
+            with open(encode_worker.output_file_path) as f:
+                lines = f.readlines()
+            fastq_path = tmp_dir + '/reads.fastq'
+            with open(fastq_path, 'w') as f:
+                for i, line in enumerate(lines[2::2]):
+                    read = line.strip()
+                    # two copies with 3 wrong bits(more than rscode corrects) from bases with low qualities outvote
+                    # a good copy by number, but not by weight
+                    wrong = ''.join({'A': 'G', 'C': 'G', 'G': 'A', 'T': 'A'}[base] if j in (30, 60, 90) else base
+                                    for j, base in enumerate(read))
+                    quality = ''.join('#' if j in (30, 60, 90) else 'I' for j in range(len(read)))
+                    for copy_id, copy in enumerate([read, wrong, wrong]):
+                        f.write("@read_{}_{}\n{}\n+\n{}\n".format(i, copy_id, copy, 'I'*len(read) if copy_id==0 else quality))
+            decode_worker = ChurchDecode(input_file_path=fastq_path, output_dir=tmp_dir)
+            decode_worker.set_input(param=encode_worker.output_file_path)
+            res_file = decode_worker.consensus_decode()
+            self.assertEqual(decode_worker.rs_failed_num, 0)
+            self.assertTrue(filecmp.cmp(file_input, res_file, shallow=False))
+
+    def test_fastq_decode(self):
+        with TemporaryDirectory() as tmp_dir:
+            encode_worker = ChurchEncode(input_file_path=file_input, output_dir=tmp_dir, sequence_length=sequence_length, max_homopolymer=max_homopolymer,
+                                  rs_num=rs_num, add_redundancy=add_redundancy)
+            encode_worker.common_encode()
+            with open(encode_worker.output_file_path) as f:
+                lines = f.readlines()
+            fastq_path = tmp_dir + '/reads.fastq.gz'
+            with gzip.open(fastq_path, 'wt') as f:
+                for i, line in enumerate(lines[2::2]):
+                    read = line.strip()
+                    # 3 wrong bits(more than rscode corrects) from bases with low qualities
+                    read = ''.join({'A': 'G', 'C': 'G', 'G': 'A', 'T': 'A'}[base] if j in (10, 50, 90) else base
+                                   for j, base in enumerate(read)) if i % 10 == 0 else read
+                    quality = ''.join('#' if i % 10 == 0 and j in (10, 50, 90) else 'I' for j in range(len(read)))
+                    f.write("@read_{}\n{}\n+\n{}\n".format(i, read, quality))
+            decode_worker = ChurchDecode(input_file_path=fastq_path, output_dir=tmp_dir)
+            decode_worker.set_input(param=encode_worker.output_file_path, min_quality=10)
+            res_file = decode_worker.common_decode()
+            self.assertEqual(res_file, tmp_dir + '/reads_decode.jpg')
+            self.assertEqual(decode_worker.rs_failed_num, 0)
+            self.assertTrue(filecmp.cmp(file_input, res_file, shallow=False))
+
+    def test_packed_pool(self):
+        with TemporaryDirectory() as tmp_dir:
+            encode_worker = WukongEncode(input_file_path=file_input, output_dir=tmp_dir, sequence_length=sequence_length,max_homopolymer=max_homopolymer,
+                                  min_gc=min_gc, max_gc=max_gc, rule_num=rule_num, rs_num=rs_num, add_redundancy=add_redundancy)
+            encode_worker.common_encode()
+            with open(encode_worker.output_file_path) as f:
+                fasta = f.read()
+            encode_worker.set_pool_format('packed')
+            pool_path = encode_worker.stream_encode()
+            self.assertTrue(pool_path.endswith('.sdpool'))
+            self.assertEqual(PackedPool(pool_path).to_fasta(tmp_dir + '/export.fasta'), tmp_dir + '/export.fasta')
+            with open(tmp_dir + '/export.fasta') as f:
+                self.assertEqual(f.read(), fasta)
+            decode_worker = WukongDecode(input_file_path=pool_path, output_dir=tmp_dir, rule_num=rule_num)
+            res_file = decode_worker.common_decode()
+            self.assertTrue(filecmp.cmp(file_input, res_file, shallow=False))
+
+    def test_decode_range(self):
+        with open(file_input, 'rb') as f:
+            data = f.read()
+        with TemporaryDirectory() as tmp_dir:
+            encode_worker = WukongEncode(input_file_path=file_input, output_dir=tmp_dir, sequence_length=sequence_length,max_homopolymer=max_homopolymer,
+                                  min_gc=min_gc, max_gc=max_gc, rule_num=rule_num, rs_num=rs_num, add_redundancy=(4, 1))
+            encode_worker.set_pool_format('packed', read_index=True)
+            pool_path = encode_worker.stream_encode()
+            self.assertTrue((np.load(pool_path + '.index.npy') >= 0).all())
+            decode_worker = WukongDecode(input_file_path=pool_path, output_dir=tmp_dir, rule_num=rule_num)
+            for offset, length in [(0, 1), (12345, 1000), (len(data) - 77, 77)]:
+                self.assertEqual(decode_worker.decode_range(offset, length), data[offset:offset+length])
+            self.assertLess(decode_worker.rs_clean_num, encode_worker.seq_num // 10) # only a few sequences decoded
+
+            encode_worker = ChurchEncode(input_file_path=file_input, output_dir=tmp_dir, sequence_length=sequence_length, max_homopolymer=max_homopolymer,
+                                  rs_num=rs_num, add_redundancy=add_redundancy)
+            encode_worker.set_pool_format('fasta', read_index=True)
+            encode_worker.common_encode()
+            with open(encode_worker.output_file_path) as f:
+                lines = f.readlines()
+            with open(encode_worker.output_file_path, 'w') as f:
+                f.writelines(lines[:3] + lines[5:]) # lose sequence 1, repaired from its group
+            decode_worker = ChurchDecode(input_file_path=encode_worker.output_file_path, output_dir=tmp_dir)
+            self.assertEqual(decode_worker.decode_range(30, 50), data[30:80])
+            self.assertEqual(decode_worker.repaired_indexs, [1])
+            remove(encode_worker.output_file_path + '.index.npy')
+            self.assertEqual(decode_worker.decode_range(5000, 3000), data[5000:8000])
+
+    def test_executor(self):
+        with TemporaryDirectory() as tmp_dir:
+            encode_worker = ChurchEncode(input_file_path=file_input, output_dir=tmp_dir, sequence_length=sequence_length, max_homopolymer=max_homopolymer,
+                                  rs_num=rs_num, add_redundancy=add_redundancy)
+            encode_worker.common_encode()
+            with open(encode_worker.output_file_path) as f:
+                lines = f.readlines()
+            encode_worker.set_executor(workers=2, pool='process', chunk_size=1000)
+            encode_worker.common_encode()
+            with open(encode_worker.output_file_path) as f:
+                self.assertEqual(f.readlines(), lines)
+            # the pool is shut down at the end of the flow
+            self.assertIsNone(encode_worker.executor._executor)
+            decode_worker = ChurchDecode(input_file_path=encode_worker.output_file_path, output_dir=tmp_dir)
+            decode_worker.set_executor(workers=2, pool='thread', chunk_size=1000)
+            res_file = decode_worker.common_decode()
+            self.assertTrue(filecmp.cmp(file_input, res_file, shallow=False))
+            decode_worker.set_executor(workers=2, pool='process', chunk_size=1000)
+            res_file = decode_worker.stream_decode(max_memory=64*1024)
+            self.assertTrue(filecmp.cmp(file_input, res_file, shallow=False))
+            self.assertIsNone(decode_worker.executor._executor)
+
+    def test_wukong_executor(self):
+        with TemporaryDirectory() as tmp_dir:
+            virtual_segments, pools = [], []
+            for pool in [None, 'thread', 'process']:
+                encode_worker = WukongEncode(input_file_path=file_input, output_dir=tmp_dir, sequence_length=sequence_length,max_homopolymer=max_homopolymer,
+                                      min_gc=min_gc, max_gc=max_gc, rule_num=rule_num, rs_num=rs_num, add_redundancy=add_redundancy)
+                if pool is not None:
+                    encode_worker.set_executor(workers=2, pool=pool, chunk_size=1000)
+                encode_worker.common_encode()
+                with open(encode_worker.output_file_path) as f:
+                    pools.append(f.read())
+                # a sequence holds two segments, real or virtual
+                seq_num = len(pools[-1].splitlines()[2::2])
+                self.assertEqual(encode_worker.virtual_segment, 2*seq_num - encode_worker.seq_num)
+                virtual_segments.append(encode_worker.virtual_segment)
+                decode_worker = WukongDecode(input_file_path=encode_worker.output_file_path, output_dir=tmp_dir, rule_num=rule_num)
+                res_file = decode_worker.common_decode()
+                self.assertTrue(filecmp.cmp(file_input, res_file, shallow=False))
+            # segments are paired within each chunk, the same chunks in threads and processes
+            self.assertEqual(pools[1], pools[2])
+            self.assertEqual(virtual_segments[1], virtual_segments[2])
+
 
 if __name__ == '__main__':
     unittest.main()
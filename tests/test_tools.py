@@ -0,0 +1,260 @@
+import unittest
+import random
+import gzip
+import multiprocessing
+import numpy as np
+from tempfile import TemporaryDirectory
+from reedsolo import RSCodec
+
+from StorageD.ecc import ReedSolomon
+from StorageD.tools import SplitTools, RsTools, BaseTools, BitSegments, ConstraintChecker, FileTools
+from StorageD.rules import getRules, getRule, getRuleTable, lBase
+from StorageD.wukong import Wukong
+from StorageD.church import churchEncode, seqEncode
+from StorageD.churchDecode import churchDecode, seqDecode
+from StorageD.goldman import goldmanEncode, transHuffman, transTernaryNum
+from StorageD.pool import PackedPool
+from StorageD.getPrimerPair import getAllTemplateFasta, writeTemplateFasta, getPrimerPair, getRandomSeq, check3End, PrimerDesign
+
+
+def random_bin(bit_len, seed=1):
+    random.seed(seed)
+    return ''.join(random.choice('01') for _ in range(bit_len))
+
+
+class TestTools(unittest.TestCase):
+    def test_bit_segments(self):
+        str_list = [random_bin(61, seed) for seed in range(10)]
+        bit_segments = BitSegments.from_strings(str_list)
+        self.assertEqual(bit_segments.to_strings(), str_list)
+        self.assertEqual(bit_segments.get_indexes(7).tolist(), [int(x[:7], 2) for x in str_list])
+        self.assertEqual(bit_segments.cut(7).to_strings(), [x[7:] for x in str_list])
+
+    def test_split_merge(self):
+        binstring = random_bin(8 * 1000)
+        bit_segments = SplitTools.split(binstring, 53, add_redundancy=True)
+        bytes_segments = SplitTools.split(SplitTools.to_packed(binstring)[0], 53, add_redundancy=True)
+        self.assertEqual(bit_segments.to_strings(), bytes_segments.to_strings())
+        seg_num = len(bit_segments)
+        index_length = bit_segments.bit_len - 53
+        segments = [x for i, x in enumerate(bit_segments) if i not in (0, 4, 8)]
+        res = SplitTools.repair_segment(index_length, segments, seg_num, True)
+        self.assertEqual(res['repaired_indexs'], [0, 4])
+        self.assertEqual(SplitTools.merge(res['res_segments'], len(binstring)),
+                         SplitTools.to_packed(binstring)[0].tobytes())
+
+    def test_outer_code(self):
+        binstring = random_bin(8 * 1000)
+        bit_segments = SplitTools.split(binstring, 53, add_redundancy=(4, 2))
+        seg_num = len(bit_segments)
+        self.assertEqual(seg_num, SplitTools.get_indexlen_and_segnum(len(binstring), 53, '4-2')[1])
+        index_length = bit_segments.bit_len - 53
+        segments = [x for i, x in enumerate(bit_segments) if i not in (0, 3, 7, 12, 13, 14)]
+        res = SplitTools.repair_segment(index_length, segments, seg_num, (4, 2))
+        self.assertEqual((res['repaired_indexs'], res['failed_indexs']), ([0, 3, 7], [12, 13, 14]))
+        segments = [x for i, x in enumerate(bit_segments) if i not in (0, 3, 7)]
+        res = SplitTools.repair_segment(index_length, segments, seg_num, (4, 2))
+        self.assertEqual(SplitTools.merge(res['res_segments'], len(binstring)),
+                         SplitTools.to_packed(binstring)[0].tobytes())
+
+    def test_fastq(self):
+        reads = [random_bin(30 + seed, seed).replace('0', 'A').replace('1', 'G') for seed in range(50)]
+        qualities = [''.join(chr(33 + (i * 7 + seed) % 41) for i in range(len(read))) for seed, read in enumerate(reads)]
+        with TemporaryDirectory() as tmp_dir:
+            fastq_path = tmp_dir + '/reads.fastq.gz'
+            with gzip.open(fastq_path, 'wt') as f:
+                f.writelines("@read_{}\n{}\n+\n{}\n".format(i, x, y) for i, (x, y) in enumerate(zip(reads, qualities)))
+            self.assertTrue(FileTools.is_fastq(fastq_path))
+            blocks = list(FileTools.iter_fastq(fastq_path, block_size=100))
+        self.assertGreater(len(blocks), 1)
+        self.assertEqual(sum([x[0] for x in blocks], []), reads)
+        self.assertEqual(sum([x[1] for x in blocks], []), qualities)
+        phred = FileTools.get_phred(qualities)
+        self.assertEqual(phred[3].tolist(), [ord(x) - 33 for x in qualities[3]])
+        masked = FileTools.mask_bases(reads, qualities, 20)
+        self.assertEqual(masked[5], ''.join('N' if q < 20 else b for b, q in zip(reads[5], phred[5])))
+
+    def test_packed_pool(self):
+        random.seed(1)
+        seq_lists = [[''.join(random.choice('ACGT') for _ in range(random.randint(0, 13) if varied else 13)) for _ in range(20)]
+                     for varied in [False, True]]
+        with TemporaryDirectory() as tmp_dir:
+            for seq_list in seq_lists:
+                for offset_index in [False, True]:
+                    pool_path = tmp_dir + '/pool.sdpool'
+                    self.assertEqual(PackedPool.write(pool_path, '>param\n', [seq_list[:7], seq_list[7:]], offset_index),
+                                     (20, sum(len(x) for x in seq_list)))
+                    self.assertTrue(PackedPool.is_packed(pool_path))
+                    pool = PackedPool(pool_path)
+                    self.assertEqual(pool.param_line, '>param\n')
+                    self.assertEqual(pool.read(0, 20), seq_list)
+                    self.assertEqual(pool.read(5, 9), seq_list[5:9])
+                    self.assertEqual(sum(pool.iter_blocks(6), []), seq_list)
+            pool.to_fasta(tmp_dir + '/pool.fasta')
+            with open(tmp_dir + '/pool.fasta') as f:
+                self.assertEqual(f.read().split('\n')[2:-1:2], seq_lists[1])
+            PackedPool.from_fasta(tmp_dir + '/pool.fasta', pool_path)
+            self.assertEqual(PackedPool(pool_path).read(0, 20), seq_lists[1])
+
+    def test_template_fasta(self):
+        random.seed(4)
+        seq_list = [''.join(random.choice('ACGT') for _ in range(30)) for _ in range(10)]
+        with TemporaryDirectory() as tmp_dir:
+            with open(tmp_dir + '/pool.fasta', 'w') as f:
+                f.writelines(['>param\n'] + [">seq_{}\n{}\n".format(i + 1, x) for i, x in enumerate(seq_list)])
+            getAllTemplateFasta([tmp_dir + '/pool.fasta'], tmp_dir + '/file.fasta')
+            writeTemplateFasta(seq_list, tmp_dir + '/memory.fasta')
+            with open(tmp_dir + '/file.fasta') as f, open(tmp_dir + '/memory.fasta') as g:
+                self.assertEqual(f.read(), g.read())
+
+    def test_primer_pair_seed(self):
+        # a worker designs from the random templates of its own seed
+        self.assertEqual(getRandomSeq(3, 200, random.Random(7)), getRandomSeq(3, 200, random.Random(7)))
+        primer_pairs = getPrimerPair(1, 200, 20, 2, iSeed=7)
+        self.assertTrue(all(check3End(left) and check3End(right) for left, right in primer_pairs))
+
+    def test_primer_workers(self):
+        random.seed(5)
+        with TemporaryDirectory() as tmp_dir:
+            primer_designer = PrimerDesign([], iBreakNum=1, sBaseDir=tmp_dir, bTimeTempName=False, iWorkers=2)
+            primer_pairs = primer_designer._primerDesign(1, 200, 5, 1, 300)
+            # the design returns once the workers are done
+            self.assertEqual(multiprocessing.active_children(), [])
+        self.assertTrue(all(check3End(left) and check3End(right) for left, right in primer_pairs))
+
+    def test_rs(self):
+        str_list = [random_bin(61, seed) for seed in range(10)]
+        rs_segments = RsTools.add_rs(BitSegments.from_strings(str_list), 4, 1)
+        self.assertEqual(rs_segments.to_strings(), RsTools.add_rs(str_list, 4, 1))
+        res = RsTools.del_rs(rs_segments, 61, 4)
+        self.assertEqual(res['validate_bit_seg'].to_strings(), str_list)
+        self.assertEqual(BaseTools.sort_segment(rs_segments, 7).to_strings(),
+                         BaseTools.sort_segment(rs_segments.to_strings(), 7))
+
+    def test_place_segments(self):
+        rng = np.random.default_rng(1)
+        indexes = rng.integers(0, 1 << 20, 5000)
+        self.assertEqual(BaseTools.radix_argsort(indexes, 20).tolist(), np.argsort(indexes, kind='stable').tolist())
+        rows = SplitTools.place_segments([3, 0, 9, 3, 1, 12], 10)
+        self.assertEqual(rows.tolist(), [1, 4, -1, 3, -1, -1, -1, -1, -1, 2])
+
+    def test_rs_matrix(self):
+        rng = np.random.default_rng(1)
+        for check_bytes, byte_len in [(4, 25), (10, 300)]:
+            rs = ReedSolomon(check_bytes)
+            data = rng.integers(0, 256, (20, byte_len), dtype=np.uint8)
+            codewords = rs.encode_matrix(data)
+            self.assertEqual([bytes(x) for x in codewords], [bytes(RSCodec(check_bytes).encode(bytearray(x))) for x in data])
+            codewords[0:10:2, 3] ^= 1
+            codewords[1, :check_bytes+2] ^= 1 # irreparable
+            decoded, is_succeed = rs.decode_matrix(codewords)
+            self.assertEqual(np.nonzero(~is_succeed)[0].tolist(), [1])
+            self.assertTrue((decoded[is_succeed] == data[is_succeed]).all())
+            self.assertEqual((rs.clean_num, rs.corrected_num, rs.failed_num), (14, 5, 1))
+
+    def test_rs_erasures(self):
+        str_list = [random_bin(61, seed) for seed in range(10)]
+        rs_segments = RsTools.add_rs(BitSegments.from_strings(str_list), 4, 1)
+        invalid_bits = np.zeros((len(rs_segments), rs_segments.bit_len), dtype=bool)
+        invalid_bits[3, 5:37] = True # bytes 1-4, more than 2 errors
+        rs_segments.packed[3, 1:5] ^= 0xff
+        self.assertEqual(RsTools.del_rs(rs_segments, 61, 4)['err_index'], [3])
+        rs_segments.mark_erasures(invalid_bits)
+        self.assertEqual(rs_segments.has_erasures().tolist(), [i == 3 for i in range(10)])
+        self.assertEqual(rs_segments.take([3]).erasures[0].tolist(), [i in range(1, 5) for i in range(rs_segments.byte_len)])
+        res = RsTools.del_rs(rs_segments, 61, 4)
+        self.assertEqual(res['validate_bit_seg'].to_strings(), str_list)
+        self.assertEqual((res['clean_num'], res['corrected_num']), (9, 1))
+
+    def test_rules(self):
+        all_rules = getRules(50)
+        table = getRuleTable(50)
+        self.assertEqual(table.shape, (51, 2, 16))
+        for rule_num in [0, 1, 2, 17, 50]:
+            self.assertEqual(getRule(rule_num), all_rules[rule_num])
+        for rule_num in [1, 2, 17, 50]:
+            self.assertEqual(list(all_rules[rule_num][0].values()), [lBase[(rule_num-1)%4][i] for i in table[rule_num][0]])
+            self.assertEqual(list(all_rules[rule_num][1].values()), [lBase[(rule_num+1)%4][i] for i in table[rule_num][1]])
+
+    def test_wukong_tables(self):
+        wukong = Wukong(rule_num=3)
+        for bit_len in [96, 100]:
+            binstr = random_bin(bit_len)
+            dna = ''.join([(wukong.dictji if i % 8 == 0 else wukong.dictou)[binstr[i:i+4]] for i in range(0, bit_len, 4)])
+            self.assertEqual(wukong._jiouencode(binstr), dna)
+            bit_seg_1, bit_seg_2 = wukong._jioudecode([dna, dna])
+            self.assertEqual(''.join(map(str, bit_seg_1[1])), ''.join([binstr[i] + binstr[i+3] for i in range(0, bit_len, 4)]))
+            self.assertEqual(''.join(map(str, bit_seg_2[1])), ''.join([binstr[i+1] + binstr[i+2] for i in range(0, bit_len, 4)]))
+
+    def test_church_tables(self):
+        str_list = [random_bin(seed * 7, seed).replace('10', '11') for seed in range(20)] # long runs
+        for rep_num in [1, 3, 4]:
+            self.assertEqual(churchEncode(str_list, rep_num=rep_num), [seqEncode(x, rep_num=rep_num) for x in str_list])
+        bit_segments = BitSegments.from_strings([random_bin(61, seed) for seed in range(10)])
+        self.assertEqual(churchEncode(bit_segments), [seqEncode(x) for x in bit_segments.to_strings()])
+        random.seed(5)
+        seqs = [''.join(random.choice('ACGT') for _ in range(seed)) for seed in range(30)]
+        self.assertEqual(churchDecode(seqs), [seqDecode(x) for x in seqs])
+        # invalid bases raise out of the codec, ChurchDecode marks them as erasures
+        self.assertRaises(KeyError, churchDecode, seqs + ['ACNT'])
+        self.assertRaises(KeyError, seqDecode, 'ACNT')
+
+    def test_goldman_tables(self):
+        bin_str = ''.join(format(x, '08b') for x in range(256))
+        ternary_str = transTernaryNum(bin_str)
+        self.assertEqual(ternary_str, ''.join(transHuffman(bin_str[i:i+8]) for i in range(0, len(bin_str), 8)))
+        nt_seq_list, index_len, add_len, ternary_seg_list, _ = goldmanEncode(bytes(range(256)), 100)
+        self.assertEqual(goldmanEncode(bin_str, 100)[0], nt_seq_list)
+        rotate_codes_dic = {'A': ['C', 'G', 'T'], 'C': ['G', 'T', 'A'], 'G': ['T', 'A', 'C'], 'T': ['A', 'C', 'G']}
+        seg_len = len(ternary_seg_list[0]) - index_len
+        for i, (nt_seq, ternary_seg) in enumerate(zip(nt_seq_list, ternary_seg_list)):
+            self.assertEqual(int(ternary_seg[:index_len], 3), i)
+            self.assertEqual(ternary_seg[index_len:], ternary_str[i*seg_len//4:i*seg_len//4 + seg_len].ljust(seg_len, '0'))
+            last_nt, expected = 'A', ''
+            for trit in ternary_seg:
+                last_nt = rotate_codes_dic[last_nt][int(trit)]
+                expected += last_nt
+            self.assertEqual(nt_seq, expected)
+        self.assertEqual(len(ternary_str) + add_len, (len(nt_seq_list) + 3) * seg_len // 4)
+
+    def test_virtual_segment(self):
+        wukong = Wukong(rule_num=1)
+        bit_segments = BitSegments.from_strings([random_bin(200, seed) for seed in range(20)])
+        wukong.wukong_encode(16, bit_segments, 2, 0.52, 0.48)
+        random.seed(3)
+        for row in range(len(bit_segments)):
+            dna = wukong._get_virtual_segment(bit_segments.row_bits(row))
+            self.assertTrue(ConstraintChecker(2, 0.48, 0.52).check(dna))
+            bit_seg_1, bit_seg_2 = wukong._jioudecode(dna)
+            self.assertEqual(bit_seg_1.tolist(), bit_segments.row_bits(row).tolist())
+            self.assertEqual(bit_seg_2[0], 1)
+
+    def test_wukong_shards(self):
+        bit_segments = BitSegments.from_strings([random_bin(200, seed) for seed in range(120)])
+        results = [Wukong(rule_num=1).wukong_encode(16, bit_segments, 4, 0.6, 0.4, processes=processes, shard_rows=50)
+                   for processes in [1, 2]]
+        self.assertEqual(results[0], results[1])
+        wukong = Wukong(rule_num=1)
+        decoded = wukong.wukong_decode(results[0], processes=2)
+        self.assertEqual(decoded.to_strings(), wukong.wukong_decode(results[0]).to_strings())
+        self.assertTrue(set(bit_segments.to_strings()) <= set(decoded.to_strings()))
+
+    def test_constraint_checker(self):
+        random.seed(2)
+        seqs = [''.join(random.choice('AACGT') for _ in range(200)) for _ in range(300)]
+        checker = ConstraintChecker(4, 0.3, 0.6)
+
+        def check(dnastr):
+            for start in range(0, len(dnastr), 140):
+                check_str = dnastr[start:start + 150]
+                gc = BaseTools.get_gc(check_str)
+                if BaseTools.get_repeat(check_str) > 4 or gc < 0.3 or gc > 0.6:
+                    return False
+            return True
+        expected = [check(x) for x in seqs]
+        self.assertEqual([checker.check(x) for x in seqs], expected)
+        self.assertEqual(checker.check(seqs).tolist(), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()